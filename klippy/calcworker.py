@@ -0,0 +1,241 @@
+# Persistent background processes for long running calculations
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging, multiprocessing, traceback, socket, errno, struct, pickle
+import queuelogger
+
+MAX_WORKERS = 4
+PRESTART_DELAY = 5.
+
+# Messages are pickled (func, args) requests and (is_err, result)
+# responses, each prefixed with its length
+MSG_HEADER = struct.Struct('<Q')
+
+def _encode_msg(msg):
+    data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    return MSG_HEADER.pack(len(data)) + data
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return bytes(data)
+
+# Main loop of a worker process - runs requested calculations until
+# the host closes the connection
+def _worker_main(sock, host_socks):
+    queuelogger.clear_bg_logging()
+    for host_sock in host_socks:
+        host_sock.close()
+    try:
+        # Load numpy before the first calculation arrives
+        import numpy
+    except ImportError:
+        pass
+    while 1:
+        try:
+            msg_len = MSG_HEADER.unpack(_recv_exact(sock, MSG_HEADER.size))[0]
+            req = pickle.loads(_recv_exact(sock, msg_len))
+        except (EOFError, socket.error):
+            break
+        func, args = req
+        try:
+            res = _encode_msg((False, func(*args)))
+        except:
+            res = _encode_msg((True, traceback.format_exc()))
+        try:
+            sock.sendall(res)
+        except socket.error:
+            break
+    sock.close()
+
+class CalcWorker:
+    def __init__(self, workers):
+        self.workers = workers
+        self.reactor = workers.reactor
+        self.sock, child_sock = socket.socketpair()
+        host_socks = [w.sock for w in workers.workers] + [self.sock]
+        self.proc = multiprocessing.Process(target=_worker_main,
+                                            args=(child_sock, host_socks))
+        self.proc.daemon = True
+        self.proc.start()
+        child_sock.close()
+        self.sock.setblocking(0)
+        self.completion = None
+        self.partial_data = bytearray()
+        self.send_buffer = bytearray()
+        self.is_blocking = False
+        self.fd_handle = self.reactor.register_fd(
+            self.sock.fileno(), self._process_received, self._do_send)
+    def start_calc(self, func, args, completion):
+        try:
+            msg = _encode_msg((func, args))
+        except:
+            completion.complete((True, traceback.format_exc()))
+            return False
+        self.completion = completion
+        self.send_buffer += msg
+        if not self.is_blocking:
+            self._do_send()
+        return True
+    def _do_send(self, eventtime=None):
+        if self.fd_handle is None:
+            return
+        try:
+            sent = self.sock.send(self.send_buffer)
+        except socket.error as e:
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                self._handle_exit()
+                return
+            sent = 0
+        if sent < len(self.send_buffer):
+            if not self.is_blocking:
+                self.reactor.set_fd_wake(self.fd_handle, False, True)
+                self.is_blocking = True
+        elif self.is_blocking:
+            self.reactor.set_fd_wake(self.fd_handle, True, False)
+            self.is_blocking = False
+        del self.send_buffer[:sent]
+    def _process_received(self, eventtime):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            data = b""
+        if not data:
+            self._handle_exit()
+            return
+        self.partial_data += data
+        if len(self.partial_data) < MSG_HEADER.size:
+            return
+        msg_len = MSG_HEADER.size + MSG_HEADER.unpack_from(
+            self.partial_data)[0]
+        if len(self.partial_data) < msg_len:
+            return
+        msg = bytes(self.partial_data[MSG_HEADER.size:msg_len])
+        del self.partial_data[:msg_len]
+        completion = self.completion
+        self.completion = None
+        try:
+            res = pickle.loads(msg)
+        except:
+            res = (True, traceback.format_exc())
+        self.workers.note_worker_idle(self)
+        if completion is not None:
+            completion.complete(res)
+    def _handle_exit(self):
+        logging.error("Background calculation process exited")
+        completion = self.completion
+        self.completion = None
+        self.close()
+        self.workers.note_worker_exit(self)
+        if completion is not None:
+            completion.complete(
+                (True, "Calculation process exited unexpectedly"))
+    def close(self):
+        if self.fd_handle is None:
+            return
+        self.reactor.unregister_fd(self.fd_handle)
+        self.fd_handle = None
+        self.sock.close()
+        # Don't wait for the process - it is reaped by multiprocessing
+        self.proc.terminate()
+
+# Pool of worker processes shared by all calibration code
+class CalcWorkers:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.max_workers = max(1, min(MAX_WORKERS,
+                                      multiprocessing.cpu_count()))
+        self.workers = []
+        self.idle_workers = []
+        self.pending = []
+        self.is_active = True
+        printer.register_event_handler("klippy:ready", self._handle_ready)
+        printer.register_event_handler("klippy:disconnect",
+                                       self._handle_disconnect)
+    def _handle_ready(self):
+        # Start one worker shortly after startup so that the first
+        # calculation doesn't wait for a fork.  Additional workers are
+        # only started when calculations are submitted.
+        mcu = self.printer.lookup_object('mcu')
+        if mcu.is_fileoutput():
+            return
+        self.reactor.register_callback(
+            self._prestart_worker, self.reactor.monotonic() + PRESTART_DELAY)
+    def _prestart_worker(self, eventtime):
+        if self.is_active and not self.workers:
+            self._start_worker()
+    def _handle_disconnect(self):
+        self.is_active = False
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+        self.idle_workers = []
+        for func, args, completion in self.pending:
+            completion.complete((True, "Calculation aborted"))
+        self.pending = []
+        # Reap any exited worker processes without blocking
+        multiprocessing.active_children()
+    def get_worker_count(self):
+        return self.max_workers
+    def _start_worker(self):
+        worker = CalcWorker(self)
+        self.workers.append(worker)
+        self.idle_workers.append(worker)
+    def _dispatch(self):
+        while self.pending:
+            if not self.idle_workers:
+                if len(self.workers) >= self.max_workers:
+                    return
+                # Replace workers that have exited
+                self._start_worker()
+            worker = self.idle_workers.pop()
+            func, args, completion = self.pending.pop(0)
+            if not worker.start_calc(func, args, completion):
+                self.idle_workers.append(worker)
+    def note_worker_idle(self, worker):
+        self.idle_workers.append(worker)
+        self._dispatch()
+    def note_worker_exit(self, worker):
+        self.workers.remove(worker)
+        if worker in self.idle_workers:
+            self.idle_workers.remove(worker)
+        multiprocessing.active_children()
+        self._dispatch()
+    def submit(self, func, args):
+        # Queue a calculation - the function and its arguments must be
+        # picklable.  Returns a completion that receives (is_err, result)
+        completion = self.reactor.completion()
+        self.pending.append((func, args, completion))
+        self._dispatch()
+        return completion
+    def wait_all(self, completions, wait_msg="Wait for calculations.."):
+        # Wait for a list of submitted calculations to finish.  Returns
+        # a list of (is_err, result) tuples.
+        gcode = self.printer.lookup_object("gcode")
+        results = []
+        for completion in completions:
+            while 1:
+                waketime = self.reactor.monotonic() + 5.
+                res = completion.wait(waketime, None)
+                if res is not None:
+                    break
+                gcode.respond_info(wait_msg, log=False)
+            results.append(res)
+        return results
+    def run_all(self, calls, wait_msg="Wait for calculations.."):
+        # Run a list of (func, args) calculations and wait for all of
+        # them to finish.  Returns a list of (is_err, result) tuples.
+        completions = [self.submit(func, args) for func, args in calls]
+        return self.wait_all(completions, wait_msg)
+    def run(self, func, args, wait_msg="Wait for calculations.."):
+        return self.run_all([(func, args)], wait_msg)[0]
+
+def add_early_printer_objects(printer):
+    printer.add_object('calc_workers', CalcWorkers(printer))
@@ -21,12 +21,12 @@ SOURCE_FILES = [
     'pollreactor.c', 'msgblock.c', 'trdispatch.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_deltesian.c', 'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c',
-    'kin_extruder.c', 'kin_shaper.c',
+    'kin_extruder.c', 'kin_shaper.c', 'accel_decode.c', 'angle_decode.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
-    'trapq.h', 'pollreactor.h', 'msgblock.h'
+    'trapq.h', 'pollreactor.h', 'msgblock.h', 'accel_decode.h'
 ]
 
 defs_stepcompress = """
@@ -97,6 +97,9 @@ defs_trapq = """
         , double pos_x, double pos_y, double pos_z);
     int trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
         , double start_time, double end_time);
+    void trapq_set_history(struct trapq *tq, double expire_time
+        , int max_moves);
+    int trapq_get_history_memory(struct trapq *tq);
 """
 
 defs_kin_cartesian = """
@@ -197,6 +200,30 @@ defs_trdispatch = """
         , uint64_t expire_ticks, uint64_t min_extend_ticks);
 """
 
+defs_accel_decode = """
+    int accel_decode_adxl345(double *out, const uint8_t *data, int count
+        , double time_base, double msg_cdiff, double inv_freq
+        , int x_pos, double x_scale, int y_pos, double y_scale
+        , int z_pos, double z_scale);
+    int accel_decode_mpu9250(double *out, const uint8_t *data, int count
+        , double time_base, double msg_cdiff, double inv_freq
+        , int x_pos, double x_scale, int y_pos, double y_scale
+        , int z_pos, double z_scale);
+"""
+
+defs_angle_decode = """
+    int angle_decode(double *times, int64_t *angles, const uint8_t *data
+        , int count, int64_t *last_angle, int64_t msg_mclock
+        , int64_t sample_ticks
+        , double time_base, double inv_freq, double static_delay
+        , int is_tcode_absolute, int time_shift
+        , int64_t last_chip_mcu_clock, int64_t last_chip_clock
+        , double chip_freq);
+    void angle_calibrate(int64_t *angles, int count
+        , const int32_t *calibration, int calibration_bits
+        , int is_reversed);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
@@ -211,7 +238,8 @@ defs_all = [
     defs_itersolve, defs_trapq, defs_trdispatch,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
     defs_kin_deltesian, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
-    defs_kin_extruder, defs_kin_shaper,
+    defs_kin_extruder, defs_kin_shaper, defs_accel_decode,
+    defs_angle_decode,
 ]
 
 # Update filenames to an absolute path
@@ -0,0 +1,82 @@
+// Bulk decoding of accelerometer sample blocks
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // fma
+#include <stdint.h> // uint8_t
+#include "accel_decode.h" // decode_round6
+#include "compiler.h" // __visible
+
+// Round a value to six decimal places (matching Python's round(v, 6))
+double
+decode_round6(double v)
+{
+    double p = v * 1000000., err = fma(v, 1000000., -p);
+    if (!(fabs(p) < 4503599627370496.))
+        return v;
+    // Round p+err to the nearest integer (ties to even)
+    double n = floor(p), half = p - n - .5;
+    if (half > 0. || (!half && (err > 0. || (!err && fmod(n, 2.)))))
+        n += 1.;
+    return copysign(n / 1000000., v);
+}
+
+// Store a (time, x, y, z) measurement in the output array
+static inline double *
+store_sample(double *out, double ptime, const int32_t *raw
+             , int x_pos, double x_scale, int y_pos, double y_scale
+             , int z_pos, double z_scale)
+{
+    out[0] = decode_round6(ptime);
+    out[1] = decode_round6(raw[x_pos] * x_scale);
+    out[2] = decode_round6(raw[y_pos] * y_scale);
+    out[3] = decode_round6(raw[z_pos] * z_scale);
+    return out + 4;
+}
+
+// Decode an adxl345 data block - returns the number of valid samples
+int __visible
+accel_decode_adxl345(double *out, const uint8_t *data, int count
+                     , double time_base, double msg_cdiff, double inv_freq
+                     , int x_pos, double x_scale, int y_pos, double y_scale
+                     , int z_pos, double z_scale)
+{
+    int i, res = 0;
+    for (i=0; i<count; i++, data+=5) {
+        uint32_t xlow = data[0], ylow = data[1], zlow = data[2];
+        uint32_t xzhigh = data[3], yzhigh = data[4];
+        if (yzhigh & 0x80)
+            // Sample flagged as invalid by the mcu
+            continue;
+        int32_t raw[3];
+        raw[0] = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9);
+        raw[1] = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9);
+        raw[2] = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+                  - ((yzhigh & 0x40) << 7));
+        double ptime = time_base + (msg_cdiff + i) * inv_freq;
+        out = store_sample(out, ptime, raw, x_pos, x_scale, y_pos, y_scale
+                           , z_pos, z_scale);
+        res++;
+    }
+    return res;
+}
+
+// Decode an mpu9250 data block - returns the number of valid samples
+int __visible
+accel_decode_mpu9250(double *out, const uint8_t *data, int count
+                     , double time_base, double msg_cdiff, double inv_freq
+                     , int x_pos, double x_scale, int y_pos, double y_scale
+                     , int z_pos, double z_scale)
+{
+    int i;
+    for (i=0; i<count; i++, data+=6) {
+        int32_t raw[3];
+        raw[0] = (int16_t)((data[0] << 8) | data[1]);
+        raw[1] = (int16_t)((data[2] << 8) | data[3]);
+        raw[2] = (int16_t)((data[4] << 8) | data[5]);
+        double ptime = time_base + (msg_cdiff + i) * inv_freq;
+        out = store_sample(out, ptime, raw, x_pos, x_scale, y_pos, y_scale
+                           , z_pos, z_scale);
+    }
+    return count;
+}
@@ -0,0 +1,6 @@
+#ifndef ACCEL_DECODE_H
+#define ACCEL_DECODE_H
+
+double decode_round6(double v);
+
+#endif // accel_decode.h
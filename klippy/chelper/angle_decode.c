@@ -0,0 +1,77 @@
+// Bulk decoding and calibration of angle sensor sample blocks
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdint.h> // uint8_t
+#include "accel_decode.h" // decode_round6
+#include "compiler.h" // __visible
+
+#define TCODE_ERROR 0xff
+
+// Decode a spi_angle data block into arrays of times and angles -
+// returns the number of valid samples.  The unwrapped angle is tracked
+// in last_angle.
+int __visible
+angle_decode(double *times, int64_t *angles, const uint8_t *data, int count
+             , int64_t *last_angle, int64_t msg_mclock, int64_t sample_ticks
+             , double time_base, double inv_freq, double static_delay
+             , int is_tcode_absolute, int time_shift
+             , int64_t last_chip_mcu_clock, int64_t last_chip_clock
+             , double chip_freq)
+{
+    double inv_chip_freq = is_tcode_absolute ? 1. / chip_freq : 0.;
+    int64_t angle = *last_angle;
+    int i, res = 0;
+    for (i=0; i<count; i++, data+=3) {
+        uint32_t tcode = data[0];
+        if (tcode == TCODE_ERROR)
+            continue;
+        uint32_t raw_angle = data[1] | (data[2] << 8);
+        int32_t angle_diff = (angle - raw_angle) & 0xffff;
+        angle_diff -= (angle_diff & 0x8000) << 1;
+        angle -= angle_diff;
+        int64_t mclock = msg_mclock + i * sample_ticks;
+        double sclock_diff;
+        if (is_tcode_absolute) {
+            // tcode is tle5012b frame counter
+            int64_t mdiff = mclock - last_chip_mcu_clock;
+            int64_t chip_mclock = (last_chip_clock
+                                   + (int64_t)(mdiff * chip_freq + .5));
+            int32_t cdiff = ((tcode << 10) - chip_mclock) & 0xffff;
+            cdiff -= (cdiff & 0x8000) << 1;
+            sclock_diff = (i * sample_ticks
+                           + (cdiff - 0x800) * inv_chip_freq);
+        } else {
+            // tcode is mcu clock offset shifted by time_shift
+            sclock_diff = i * sample_ticks + ((int64_t)tcode << time_shift);
+        }
+        times[res] = decode_round6(time_base + sclock_diff * inv_freq
+                                   - static_delay);
+        angles[res] = angle;
+        res++;
+    }
+    *last_angle = angle;
+    return res;
+}
+
+// Apply a linear interpolation calibration table to an array of angles
+void __visible
+angle_calibrate(int64_t *angles, int count, const int32_t *calibration
+                , int calibration_bits, int is_reversed)
+{
+    int interp_bits = 16 - calibration_bits;
+    int64_t interp_mask = (1 << interp_bits) - 1;
+    int64_t interp_round = 1 << (interp_bits - 1);
+    int i;
+    for (i=0; i<count; i++) {
+        int64_t angle = angles[i];
+        int bucket = (angle & 0xffff) >> interp_bits;
+        int64_t cal1 = calibration[bucket], cal2 = calibration[bucket + 1];
+        int64_t adj = (angle & interp_mask) * (cal2 - cal1);
+        adj = cal1 + ((adj + interp_round) >> interp_bits);
+        int64_t angle_diff = (angle - adj) & 0xffff;
+        angle_diff -= (angle_diff & 0x8000) << 1;
+        int64_t new_angle = angle - angle_diff;
+        angles[i] = is_reversed ? -new_angle : new_angle;
+    }
+}
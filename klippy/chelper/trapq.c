@@ -39,6 +39,9 @@ move_get_coord(struct move *m, double move_time)
 }
 
 #define NEVER_TIME 9999999999999999.9
+#define HISTORY_EXPIRE (30.0)
+#define HISTORY_MAX_MOVES 32768
+#define HISTORY_MIN_ALLOC 64
 
 // Allocate a new 'trapq' object
 struct trapq * __visible
@@ -47,7 +50,8 @@ trapq_alloc(void)
     struct trapq *tq = malloc(sizeof(*tq));
     memset(tq, 0, sizeof(*tq));
     list_init(&tq->moves);
-    list_init(&tq->history);
+    tq->history_expire = HISTORY_EXPIRE;
+    tq->history_max = HISTORY_MAX_MOVES;
     struct move *head_sentinel = move_alloc(), *tail_sentinel = move_alloc();
     tail_sentinel->print_time = tail_sentinel->move_t = NEVER_TIME;
     list_add_head(&head_sentinel->node, &tq->moves);
@@ -64,11 +68,7 @@ trapq_free(struct trapq *tq)
         list_del(&m->node);
         free(m);
     }
-    while (!list_empty(&tq->history)) {
-        struct move *m = list_first_entry(&tq->history, struct move, node);
-        list_del(&m->node);
-        free(m);
-    }
+    free(tq->history);
     free(tq);
 }
 
@@ -163,7 +163,81 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
-#define HISTORY_EXPIRE (30.0)
+/****************************************************************
+ * Move history
+ ****************************************************************/
+
+// Return a history entry (index zero is the oldest stored move)
+static struct pull_move *
+history_get(struct trapq *tq, int idx)
+{
+    idx += tq->history_pos;
+    if (idx >= tq->history_alloc)
+        idx -= tq->history_alloc;
+    return &tq->history[idx];
+}
+
+// Discard the oldest entry in the history
+static void
+history_drop_oldest(struct trapq *tq)
+{
+    tq->history_pos++;
+    if (tq->history_pos >= tq->history_alloc)
+        tq->history_pos = 0;
+    tq->history_count--;
+}
+
+// Reallocate the history buffer (storing entries in order)
+static int
+history_resize(struct trapq *tq, int new_alloc)
+{
+    struct pull_move *h = malloc(sizeof(*h) * new_alloc);
+    if (!h)
+        return -1;
+    int i;
+    for (i=0; i<tq->history_count; i++)
+        h[i] = *history_get(tq, i);
+    free(tq->history);
+    tq->history = h;
+    tq->history_alloc = new_alloc;
+    tq->history_pos = 0;
+    return 0;
+}
+
+// Add an entry to the history (replacing the oldest entry if full)
+static struct pull_move *
+history_add(struct trapq *tq)
+{
+    if (tq->history_count >= tq->history_alloc) {
+        int new_alloc = tq->history_alloc * 2;
+        if (new_alloc < HISTORY_MIN_ALLOC)
+            new_alloc = HISTORY_MIN_ALLOC;
+        if (new_alloc > tq->history_max)
+            new_alloc = tq->history_max;
+        if (new_alloc <= tq->history_alloc || history_resize(tq, new_alloc))
+            history_drop_oldest(tq);
+    }
+    struct pull_move *p = history_get(tq, tq->history_count++);
+    memset(p, 0, sizeof(*p));
+    return p;
+}
+
+// Store a completed move in the history
+static void
+history_add_move(struct trapq *tq, struct move *m)
+{
+    struct pull_move *p = history_add(tq);
+    p->print_time = m->print_time;
+    p->move_t = m->move_t;
+    p->start_v = m->start_v;
+    p->accel = 2. * m->half_accel;
+    p->start_x = m->start_pos.x;
+    p->start_y = m->start_pos.y;
+    p->start_z = m->start_pos.z;
+    p->x_r = m->axes_r.x;
+    p->y_r = m->axes_r.y;
+    p->z_r = m->axes_r.z;
+}
 
 // Expire any moves older than `print_time` from the trapezoid velocity queue
 void __visible
@@ -171,7 +245,7 @@ trapq_finalize_moves(struct trapq *tq, double print_time)
 {
     struct move *head_sentinel = list_first_entry(&tq->moves, struct move,node);
     struct move *tail_sentinel = list_last_entry(&tq->moves, struct move, node);
-    // Move expired moves from main "moves" list to "history" list
+    // Move expired moves from main "moves" list to history
     for (;;) {
         struct move *m = list_next_entry(head_sentinel, node);
         if (m == tail_sentinel) {
@@ -182,21 +256,20 @@ trapq_finalize_moves(struct trapq *tq, double print_time)
             break;
         list_del(&m->node);
         if (m->start_v || m->half_accel)
-            list_add_head(&m->node, &tq->history);
-        else
-            free(m);
+            history_add_move(tq, m);
+        free(m);
     }
-    // Free old moves from history list
-    if (list_empty(&tq->history))
+    // Discard old moves from history
+    if (!tq->history_count)
         return;
-    struct move *latest = list_first_entry(&tq->history, struct move, node);
-    double expire_time = latest->print_time + latest->move_t - HISTORY_EXPIRE;
-    for (;;) {
-        struct move *m = list_last_entry(&tq->history, struct move, node);
-        if (m == latest || m->print_time + m->move_t > expire_time)
+    struct pull_move *latest = history_get(tq, tq->history_count - 1);
+    double expire_time = (latest->print_time + latest->move_t
+                          - tq->history_expire);
+    while (tq->history_count > 1) {
+        struct pull_move *p = history_get(tq, 0);
+        if (p->print_time + p->move_t > expire_time)
             break;
-        list_del(&m->node);
-        free(m);
+        history_drop_oldest(tq);
     }
 }
 
@@ -209,50 +282,67 @@ trapq_set_position(struct trapq *tq, double print_time
     trapq_finalize_moves(tq, NEVER_TIME);
 
     // Prune any moves in the trapq history that were interrupted
-    while (!list_empty(&tq->history)) {
-        struct move *m = list_first_entry(&tq->history, struct move, node);
-        if (m->print_time < print_time) {
-            if (m->print_time + m->move_t > print_time)
-                m->move_t = print_time - m->print_time;
+    while (tq->history_count) {
+        struct pull_move *p = history_get(tq, tq->history_count - 1);
+        if (p->print_time < print_time) {
+            if (p->print_time + p->move_t > print_time)
+                p->move_t = print_time - p->print_time;
             break;
         }
-        list_del(&m->node);
-        free(m);
+        tq->history_count--;
     }
 
     // Add a marker to the trapq history
-    struct move *m = move_alloc();
-    m->print_time = print_time;
-    m->start_pos.x = pos_x;
-    m->start_pos.y = pos_y;
-    m->start_pos.z = pos_z;
-    list_add_head(&m->node, &tq->history);
+    struct pull_move *p = history_add(tq);
+    p->print_time = print_time;
+    p->start_x = pos_x;
+    p->start_y = pos_y;
+    p->start_z = pos_z;
 }
 
-// Return history of movement queue
+// Return history of movement queue (newest moves first)
 int __visible
 trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
                   , double start_time, double end_time)
 {
-    int res = 0;
-    struct move *m;
-    list_for_each_entry(m, &tq->history, node) {
-        if (start_time >= m->print_time + m->move_t || res >= max)
+    // Find the first stored move that starts at or after end_time
+    int low = 0, high = tq->history_count;
+    while (low < high) {
+        int mid = (low + high) / 2;
+        if (history_get(tq, mid)->print_time < end_time)
+            low = mid + 1;
+        else
+            high = mid;
+    }
+    // Copy moves (walking backwards in time) until start_time is reached
+    int res = 0, idx;
+    for (idx = low - 1; idx >= 0 && res < max; idx--) {
+        struct pull_move *m = history_get(tq, idx);
+        if (start_time >= m->print_time + m->move_t)
             break;
-        if (end_time <= m->print_time)
-            continue;
-        p->print_time = m->print_time;
-        p->move_t = m->move_t;
-        p->start_v = m->start_v;
-        p->accel = 2. * m->half_accel;
-        p->start_x = m->start_pos.x;
-        p->start_y = m->start_pos.y;
-        p->start_z = m->start_pos.z;
-        p->x_r = m->axes_r.x;
-        p->y_r = m->axes_r.y;
-        p->z_r = m->axes_r.z;
-        p++;
+        *p++ = *m;
         res++;
     }
     return res;
 }
+
+// Configure the amount of time and maximum number of moves kept in history
+void __visible
+trapq_set_history(struct trapq *tq, double expire_time, int max_moves)
+{
+    if (max_moves < 1)
+        max_moves = 1;
+    tq->history_expire = expire_time;
+    tq->history_max = max_moves;
+    while (tq->history_count > max_moves)
+        history_drop_oldest(tq);
+    if (tq->history_alloc > max_moves)
+        history_resize(tq, max_moves);
+}
+
+// Report the number of bytes allocated for the move history
+int __visible
+trapq_get_history_memory(struct trapq *tq)
+{
+    return tq->history_alloc * sizeof(*tq->history);
+}
@@ -20,10 +20,6 @@ struct move {
     struct list_node node;
 };
 
-struct trapq {
-    struct list_head moves, history;
-};
-
 struct pull_move {
     double print_time, move_t;
     double start_v, accel;
@@ -31,6 +27,14 @@ struct pull_move {
     double x_r, y_r, z_r;
 };
 
+struct trapq {
+    struct list_head moves;
+    // Ring buffer of completed moves (oldest at history_pos)
+    struct pull_move *history;
+    int history_pos, history_count, history_alloc, history_max;
+    double history_expire;
+};
+
 struct move *move_alloc(void);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
@@ -48,5 +52,7 @@ void trapq_set_position(struct trapq *tq, double print_time
                         , double pos_x, double pos_y, double pos_z);
 int trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
                       , double start_time, double end_time);
+void trapq_set_history(struct trapq *tq, double expire_time, int max_moves);
+int trapq_get_history_memory(struct trapq *tq);
 
 #endif // trapq.h
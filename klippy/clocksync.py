@@ -144,6 +144,12 @@ class ClockSync:
         return last_clock - clock_diff
     def is_active(self):
         return self.queries_pending <= 4
+    def get_sync_uncertainty(self):
+        # Estimated worst case error (in seconds) of the clock prediction
+        if self.get_clock_cmd is None:
+            return 0.
+        pred_stddev = math.sqrt(self.prediction_variance)
+        return self.min_half_rtt + 3. * pred_stddev / self.mcu_freq
     def dump_debug(self):
         sample_time, clock, freq = self.clock_est
         return ("clocksync state: mcu_freq=%d last_clock=%d"
@@ -195,6 +201,9 @@ class SecondarySync(ClockSync):
     def stats(self, eventtime):
         adjusted_offset, adjusted_freq = self.clock_adj
         return "%s adj=%d" % (ClockSync.stats(self, eventtime), adjusted_freq)
+    def get_sync_uncertainty(self):
+        return (ClockSync.get_sync_uncertainty(self)
+                + self.main_sync.get_sync_uncertainty())
     def calibrate_clock(self, print_time, eventtime):
         # Calculate: est_print_time = main_sync.estimatated_print_time()
         ser_time, ser_clock, ser_freq = self.main_sync.clock_est
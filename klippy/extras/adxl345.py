@@ -3,7 +3,8 @@
 # Copyright (C) 2020-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, threading, multiprocessing, os
+import logging, time, collections, threading, multiprocessing, os, struct
+import chelper
 from . import bus, motion_report
 
 # ADXL345 registers
@@ -38,17 +39,64 @@ class AccelQueryHelper:
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
         self.samples = self.raw_samples = []
-    def finish_measurements(self):
+        self.sample_consumer = None
+        self.stream_end_time = motion_report.NEVER_TIME
+        self.stream_count = 0
+        self.stream_error = None
+        self.is_ended = False
+    def end_measurements(self):
+        # Limit the measurements to the currently queued moves without
+        # waiting for them to complete (further moves may be queued
+        # before calling finish_measurements)
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
-        toolhead.wait_moves()
+        self.stream_end_time = self.request_end_time
+        self.is_ended = True
+    def finish_measurements(self):
+        if not self.is_ended:
+            self.end_measurements()
+            self.printer.lookup_object('toolhead').wait_moves()
+        else:
+            self._wait_end_time()
         self.cconn.finalize()
+    def _wait_end_time(self):
+        mcu = self.printer.lookup_object('mcu')
+        if mcu.is_fileoutput():
+            return
+        reactor = self.printer.get_reactor()
+        eventtime = reactor.monotonic()
+        while mcu.estimated_print_time(eventtime) <= self.request_end_time:
+            eventtime = reactor.pause(eventtime + 0.100)
+    def stream_samples(self, consumer):
+        # Pass samples to consumer.add_samples() as they arrive instead
+        # of storing them for a later get_samples() call
+        self.sample_consumer = consumer
+        self.cconn.set_message_callback(self._handle_stream_msg)
+    def _handle_stream_msg(self, msg):
+        if self.stream_error is not None:
+            return
+        start_time = self.request_start_time
+        end_time = self.stream_end_time
+        samples = [s for s in msg['params']['data']
+                   if s[0] >= start_time and s[0] <= end_time]
+        if samples:
+            self.stream_count += len(samples)
+            try:
+                self.sample_consumer.add_samples(samples)
+            except Exception as e:
+                # Stop streaming - the error is reported by the caller
+                logging.exception("Error processing accelerometer samples")
+                self.stream_error = str(e)
+    def get_stream_error(self):
+        return self.stream_error
     def _get_raw_samples(self):
         raw_samples = self.cconn.get_messages()
         if raw_samples:
             self.raw_samples = raw_samples
         return self.raw_samples
     def has_valid_samples(self):
+        if self.sample_consumer is not None:
+            return self.stream_count > 0
         raw_samples = self._get_raw_samples()
         for msg in raw_samples:
             data = msg['params']['data']
@@ -83,24 +131,49 @@ class AccelQueryHelper:
                 count += 1
         del samples[count:]
         return self.samples
-    def write_to_file(self, filename):
+    def write_to_file(self, filename, file_format="npy"):
         def write_impl():
             try:
                 # Try to re-nice writing process
                 os.nice(20)
             except:
                 pass
-            f = open(filename, "w")
-            f.write("#time,accel_x,accel_y,accel_z\n")
             samples = self.samples or self.get_samples()
-            for t, accel_x, accel_y, accel_z in samples:
-                f.write("%.6f,%.6f,%.6f,%.6f\n" % (
-                    t, accel_x, accel_y, accel_z))
-            f.close()
+            if file_format == "csv":
+                _write_csv(filename, samples)
+            else:
+                _write_npy(filename, samples)
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
         write_proc.start()
 
+ACCEL_FILE_FORMATS = ["npy", "csv"]
+
+def _write_csv(filename, samples):
+    f = open(filename, "w")
+    f.write("#time,accel_x,accel_y,accel_z\n")
+    for t, accel_x, accel_y, accel_z in samples:
+        f.write("%.6f,%.6f,%.6f,%.6f\n" % (t, accel_x, accel_y, accel_z))
+    f.close()
+
+# Write samples in the numpy ".npy" format (without requiring numpy).
+# Each record is a float64 time followed by three float32 accelerations.
+NPY_DESCR = ("[('time', '<f8'), ('accel_x', '<f4'), ('accel_y', '<f4'),"
+             " ('accel_z', '<f4')]")
+
+def _write_npy(filename, samples):
+    header = "{'descr': %s, 'fortran_order': False, 'shape': (%d,), }" % (
+        NPY_DESCR, len(samples))
+    # Magic, version, and header length are followed by a header that is
+    # padded with spaces so that the data is aligned to 64 bytes
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+    pack = struct.Struct('<dfff').pack
+    f = open(filename, "wb")
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header))
+            + header.encode())
+    f.write(b''.join([pack(*s) for s in samples]))
+    f.close()
+
 # Helper class for G-Code commands
 class AccelCommandHelper:
     def __init__(self, config, chip):
@@ -140,15 +213,19 @@ class AccelCommandHelper:
         name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
         if not name.replace('-', '').replace('_', '').isalnum():
             raise gcmd.error("Invalid NAME parameter")
+        file_format = gcmd.get("FORMAT", "npy").lower()
+        if file_format not in ACCEL_FILE_FORMATS:
+            raise gcmd.error("Invalid FORMAT parameter")
         bg_client = self.bg_client
         self.bg_client = None
         bg_client.finish_measurements()
         # Write data to file
         if self.base_name == self.name:
-            filename = "/tmp/%s-%s.csv" % (self.base_name, name)
+            filename = "/tmp/%s-%s.%s" % (self.base_name, name, file_format)
         else:
-            filename = "/tmp/%s-%s-%s.csv" % (self.base_name, self.name, name)
-        bg_client.write_to_file(filename)
+            filename = "/tmp/%s-%s-%s.%s" % (self.base_name, self.name, name,
+                                            file_format)
+        bg_client.write_to_file(filename, file_format)
         gcmd.respond_info("Writing raw accelerometer data to %s file"
                           % (filename,))
     cmd_ACCELEROMETER_QUERY_help = "Query accelerometer for the current values"
@@ -303,35 +380,32 @@ class ADXL345:
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         last_sequence = self.last_sequence
         time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
-        # Process every message in raw_samples
-        count = seq = 0
-        samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        decode = ffi_lib.accel_decode_adxl345
+        # Decode every message in raw_samples into a flat array
+        total = sum([len(params['data']) for params in raw_samples])
+        out = ffi_main.new('double[]', (total // BYTES_PER_SAMPLE) * 4 + 1)
+        count = seq = i = 0
         for params in raw_samples:
             seq_diff = (last_sequence - params['sequence']) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence - seq_diff
-            d = bytearray(params['data'])
+            d = params['data']
+            msg_count = len(d) // BYTES_PER_SAMPLE
+            if not msg_count:
+                continue
             msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
-            for i in range(len(d) // BYTES_PER_SAMPLE):
-                d_xyz = d[i*BYTES_PER_SAMPLE:(i+1)*BYTES_PER_SAMPLE]
-                xlow, ylow, zlow, xzhigh, yzhigh = d_xyz
-                if yzhigh & 0x80:
-                    self.last_error_count += 1
-                    continue
-                rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
-                ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
-                rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
-                      - ((yzhigh & 0x40) << 7))
-                raw_xyz = (rx, ry, rz)
-                x = round(raw_xyz[x_pos] * x_scale, 6)
-                y = round(raw_xyz[y_pos] * y_scale, 6)
-                z = round(raw_xyz[z_pos] * z_scale, 6)
-                ptime = round(time_base + (msg_cdiff + i) * inv_freq, 6)
-                samples[count] = (ptime, x, y, z)
-                count += 1
+            valid = decode(out + count * 4, d, msg_count,
+                           time_base, msg_cdiff, inv_freq,
+                           x_pos, x_scale, y_pos, y_scale, z_pos, z_scale)
+            self.last_error_count += msg_count - valid
+            count += valid
+            i = msg_count - 1
         self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + i)
-        del samples[count:]
-        return samples
+        # Group the decoded values into (time, x, y, z) tuples - the same
+        # message is sent to API clients as a list of [time, x, y, z]
+        data = iter(ffi_main.unpack(out, count * 4))
+        return list(zip(data, data, data, data))
     def _update_clock(self, minclock=0):
         # Query current state
         for retry in range(5):
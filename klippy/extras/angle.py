@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, threading
+import chelper
 from . import bus, motion_report
 
 MIN_MSG_TIME = 0.100
@@ -70,28 +71,18 @@ class AngleCalibration:
             phase_diff -= phases
         # Store final offset
         self.mcu_pos_offset = mcu_pos - (angle_mpos - phase_diff)
-    def apply_calibration(self, samples):
+    def apply_calibration(self, times, angles, count):
+        # Update the angles array (as filled by the angle_decode() C
+        # helper) in place
         calibration = self.calibration
         if not calibration:
             return None
-        calibration_reversed = self.calibration_reversed
-        interp_bits = ANGLE_BITS - CALIBRATION_BITS
-        interp_mask = (1 << interp_bits) - 1
-        interp_round = 1 << (interp_bits - 1)
-        for i, (samp_time, angle) in enumerate(samples):
-            bucket = (angle & 0xffff) >> interp_bits
-            cal1 = calibration[bucket]
-            cal2 = calibration[bucket + 1]
-            adj = (angle & interp_mask) * (cal2 - cal1)
-            adj = cal1 + ((adj + interp_round) >> interp_bits)
-            angle_diff = (angle - adj) & 0xffff
-            angle_diff -= (angle_diff & 0x8000) << 1
-            new_angle = angle - angle_diff
-            if calibration_reversed:
-                new_angle = -new_angle
-            samples[i] = (samp_time, new_angle)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        c_calibration = ffi_main.new('int32_t[]', calibration)
+        ffi_lib.angle_calibrate(angles, count, c_calibration,
+                                CALIBRATION_BITS, self.calibration_reversed)
         if self.mcu_pos_offset is None:
-            self.calc_mcu_pos_offset(samples[0])
+            self.calc_mcu_pos_offset((times[0], angles[0]))
             if self.mcu_pos_offset is None:
                 return None
         return self.mcu_stepper.mcu_to_commanded_position(self.mcu_pos_offset)
@@ -192,15 +183,20 @@ class AngleCalibration:
         cconn.finalize()
         msgs = cconn.get_messages()
         # Correlate query responses
-        cal = {}
-        step = 0
-        for msg in msgs:
-            for query_time, pos in msg['params']['data']:
-                # Add to step tracking
-                while step < len(times) and query_time > times[step][1]:
-                    step += 1
-                if step < len(times) and query_time >= times[step][0]:
-                    cal.setdefault(step, []).append(pos)
+        import numpy
+        data = [s for msg in msgs for s in msg['params']['data']]
+        query_times = numpy.array([s[0] for s in data])
+        positions = numpy.array([s[1] for s in data], dtype=numpy.int64)
+        start_times = numpy.array([t[0] for t in times])
+        end_times = numpy.array([t[1] for t in times])
+        steps = numpy.searchsorted(end_times, query_times)
+        valid = steps < len(times)
+        valid[valid] = query_times[valid] >= start_times[steps[valid]]
+        order = numpy.argsort(steps[valid], kind='stable')
+        steps, positions = steps[valid][order], positions[valid][order]
+        step_ids, first = numpy.unique(steps, return_index=True)
+        cal = {int(step): p.tolist() for step, p in zip(
+            step_ids, numpy.split(positions, first[1:]))}
         if len(cal) != len(times):
             raise self.printer.command_error(
                 "Failed calibration - incomplete sensor data")
@@ -208,14 +204,16 @@ class AngleCalibration:
         rcal = { full_steps-i-1: cal[i+full_steps] for i in range(full_steps) }
         return fcal, rcal
     def calc_angles(self, meas):
-        total_count = total_variance = 0
-        angles = {}
-        for step, data in meas.items():
-            count = len(data)
-            angle_avg = float(sum(data)) / count
-            angles[step] = angle_avg
-            total_count += count
-            total_variance += sum([(d - angle_avg)**2 for d in data])
+        import numpy
+        steps = list(meas.keys())
+        counts = numpy.array([len(meas[step]) for step in steps])
+        data = numpy.concatenate([meas[step] for step in steps]).astype(float)
+        # Calculate the average and variance of all steps at once
+        step_ids = numpy.repeat(numpy.arange(len(steps)), counts)
+        angle_avgs = numpy.bincount(step_ids, weights=data) / counts
+        total_variance = numpy.sum((data - angle_avgs[step_ids])**2)
+        total_count = len(data)
+        angles = {step: float(a) for step, a in zip(steps, angle_avgs)}
         return angles, math.sqrt(total_variance / total_count), total_count
     cmd_ANGLE_CALIBRATE_help = "Calibrate angle sensor to stepper motor"
     def cmd_ANGLE_CALIBRATE(self, gcmd):
@@ -472,55 +470,47 @@ class Angle:
         start_clock = self.start_clock
         clock_to_print_time = self.mcu.clock_to_print_time
         last_sequence = self.last_sequence
-        last_angle = self.last_angle
         time_shift = 0
         static_delay = 0.
-        last_chip_mcu_clock = last_chip_clock = chip_freq = inv_chip_freq = 0.
+        last_chip_mcu_clock = last_chip_clock = 0
+        chip_freq = 0.
         is_tcode_absolute = self.sensor_helper.is_tcode_absolute
         if is_tcode_absolute:
             tparams = self.sensor_helper.get_tcode_params()
             last_chip_mcu_clock, last_chip_clock, chip_freq = tparams
-            inv_chip_freq = 1. / chip_freq
         else:
             time_shift = self.time_shift
             static_delay = self.sensor_helper.get_static_delay()
-        # Process every message in raw_samples
+        # Clock to print_time conversion rate (relative to each message)
+        freq = self.mcu.seconds_to_clock(1.)
+        inv_freq = (clock_to_print_time(start_clock + freq)
+                    - clock_to_print_time(start_clock)) / freq
+        # Decode every message in raw_samples into arrays
+        ffi_main, ffi_lib = chelper.get_ffi()
+        decode = ffi_lib.angle_decode
+        total = sum([len(params['data']) for params in raw_samples]) // 3
+        times = ffi_main.new('double[]', total + 1)
+        angles = ffi_main.new('int64_t[]', total + 1)
+        last_angle = ffi_main.new('int64_t *', self.last_angle)
         count = error_count = 0
-        samples = [None] * (len(raw_samples) * 16)
         for params in raw_samples:
             seq = (last_sequence & ~0xffff) | params['sequence']
             if seq < last_sequence:
                 seq += 0x10000
             last_sequence = seq
-            d = bytearray(params['data'])
+            d = params['data']
+            msg_count = len(d) // 3
             msg_mclock = start_clock + seq*16*sample_ticks
-            for i in range(len(d) // 3):
-                tcode = d[i*3]
-                if tcode == TCODE_ERROR:
-                    error_count += 1
-                    continue
-                raw_angle = d[i*3 + 1] | (d[i*3 + 2] << 8)
-                angle_diff = (last_angle - raw_angle) & 0xffff
-                angle_diff -= (angle_diff & 0x8000) << 1
-                last_angle -= angle_diff
-                mclock = msg_mclock + i*sample_ticks
-                if is_tcode_absolute:
-                    # tcode is tle5012b frame counter
-                    mdiff = mclock - last_chip_mcu_clock
-                    chip_mclock = last_chip_clock + int(mdiff * chip_freq + .5)
-                    cdiff = ((tcode << 10) - chip_mclock) & 0xffff
-                    cdiff -= (cdiff & 0x8000) << 1
-                    sclock = mclock + (cdiff - 0x800) * inv_chip_freq
-                else:
-                    # tcode is mcu clock offset shifted by time_shift
-                    sclock = mclock + (tcode<<time_shift)
-                ptime = round(clock_to_print_time(sclock) - static_delay, 6)
-                samples[count] = (ptime, last_angle)
-                count += 1
+            valid = decode(times + count, angles + count, d, msg_count,
+                           last_angle, msg_mclock, sample_ticks,
+                           clock_to_print_time(msg_mclock), inv_freq,
+                           static_delay, is_tcode_absolute, time_shift,
+                           last_chip_mcu_clock, last_chip_clock, chip_freq)
+            error_count += msg_count - valid
+            count += valid
         self.last_sequence = last_sequence
-        self.last_angle = last_angle
-        del samples[count:]
-        return samples, error_count
+        self.last_angle = last_angle[0]
+        return times, angles, count, error_count
     # API interface
     def _api_update(self, eventtime):
         if self.sensor_helper.is_tcode_absolute:
@@ -530,10 +520,13 @@ class Angle:
             self.raw_samples = []
         if not raw_samples:
             return {}
-        samples, error_count = self._extract_samples(raw_samples)
-        if not samples:
+        times, angles, count, error_count = self._extract_samples(raw_samples)
+        if not count:
             return {}
-        offset = self.calibration.apply_calibration(samples)
+        offset = self.calibration.apply_calibration(times, angles, count)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        samples = list(zip(ffi_main.unpack(times, count),
+                           ffi_main.unpack(angles, count)))
         return {'data': samples, 'errors': error_count,
                 'position_offset': offset}
     def _start_measurements(self):
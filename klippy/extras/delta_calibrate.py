@@ -3,7 +3,7 @@
 # Copyright (C) 2017-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, collections
+import math, logging, collections, functools
 import mathutil
 from . import probe
 
@@ -71,6 +71,33 @@ def measurements_to_distances(measured_params, delta_params):
     return center_positions + outer_positions
 
 
+# Residual function for the least squares solver (run in a background
+# process).  The points are evaluated one at a time with the kinematics'
+# get_position_from_stable() so that linear and rotary deltas share this
+# code and the solver still works without numpy.
+def delta_residuals(orig_delta_params, height_positions, distances,
+                    z_weight, params):
+    try:
+        # Build new delta_params for params under test
+        delta_params = orig_delta_params.new_calibration(params)
+        getpos = delta_params.get_position_from_stable
+        # Calculate z height errors
+        height_scale = math.sqrt(z_weight)
+        residuals = []
+        for z_offset, stable_pos in height_positions:
+            x, y, z = getpos(stable_pos)
+            residuals.append((z - z_offset) * height_scale)
+        # Calculate distance errors
+        for dist, stable_pos1, stable_pos2 in distances:
+            x1, y1, z1 = getpos(stable_pos1)
+            x2, y2, z2 = getpos(stable_pos2)
+            d = math.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
+            residuals.append(d - dist)
+        return residuals
+    except ValueError:
+        return None
+
+
 ######################################################################
 # Delta Calibrate class
 ######################################################################
@@ -163,7 +190,7 @@ class DeltaCalibrate:
         self.calculate_params(probe_positions, self.last_distances)
     def calculate_params(self, probe_positions, distances):
         height_positions = self.manual_heights + probe_positions
-        # Setup for coordinate descent analysis
+        # Setup for least squares analysis
         kin = self.printer.lookup_object('toolhead').get_kinematics()
         orig_delta_params = odp = kin.get_calibration()
         adj_params, params = odp.coordinate_descent_params(distances)
@@ -173,29 +200,12 @@ class DeltaCalibrate:
         z_weight = 1.
         if distances:
             z_weight = len(distances) / (MEASURE_WEIGHT * len(probe_positions))
-        # Perform coordinate descent
-        def delta_errorfunc(params):
-            try:
-                # Build new delta_params for params under test
-                delta_params = orig_delta_params.new_calibration(params)
-                getpos = delta_params.get_position_from_stable
-                # Calculate z height errors
-                total_error = 0.
-                for z_offset, stable_pos in height_positions:
-                    x, y, z = getpos(stable_pos)
-                    total_error += (z - z_offset)**2
-                total_error *= z_weight
-                # Calculate distance errors
-                for dist, stable_pos1, stable_pos2 in distances:
-                    x1, y1, z1 = getpos(stable_pos1)
-                    x2, y2, z2 = getpos(stable_pos2)
-                    d = math.sqrt((x1-x2)**2 + (y1-y2)**2 + (z1-z2)**2)
-                    total_error += (d - dist)**2
-                return total_error
-            except ValueError:
-                return 9999999999999.9
-        new_params = mathutil.background_coordinate_descent(
-            self.printer, adj_params, params, delta_errorfunc)
+        # Perform least squares fit
+        residual_func = functools.partial(
+            delta_residuals, orig_delta_params, height_positions, distances,
+            z_weight)
+        new_params = mathutil.background_least_squares(
+            self.printer, adj_params, params, residual_func)
         # Log and report results
         logging.info("Calculated delta_calibrate parameters: %s", new_params)
         new_delta_params = orig_delta_params.new_calibration(new_params)
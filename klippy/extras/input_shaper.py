@@ -100,6 +100,7 @@ class InputShaper:
                         AxisInputShaper('y', config)]
         self.stepper_kinematics = []
         self.orig_stepper_kinematics = []
+        self.steppers = []
         # Register gcode commands
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SET_INPUT_SHAPER",
@@ -122,6 +123,7 @@ class InputShaper:
                 continue
             self.stepper_kinematics.append(sk)
             self.orig_stepper_kinematics.append(orig_sk)
+            self.steppers.append(s)
         # Configure initial values
         self.old_delay = 0.
         self._update_input_shaping(error=self.printer.config_error)
@@ -129,7 +131,9 @@ class InputShaper:
         self.toolhead.flush_step_generation()
         new_delay = max([s.get_step_generation_window() for s in self.shapers])
         self.toolhead.note_step_generation_scan_time(new_delay,
-                                                     old_delay=self.old_delay)
+                                                     old_delay=self.old_delay,
+                                                     steppers=self.steppers)
+        self.old_delay = new_delay
         failed = []
         for sk in self.stepper_kinematics:
             for shaper in self.shapers:
@@ -86,14 +86,21 @@ class APIDumpHelper:
 class InternalDumpClient:
     def __init__(self):
         self.msgs = []
+        self.msg_cb = None
         self.is_done = False
     def get_messages(self):
         return self.msgs
+    def set_message_callback(self, msg_cb):
+        # Deliver messages to msg_cb instead of storing them
+        self.msg_cb = msg_cb
     def finalize(self):
         self.is_done = True
     def is_closed(self):
         return self.is_done
     def send(self, msg):
+        if self.msg_cb is not None:
+            self.msg_cb(msg)
+            return
         self.msgs.append(msg)
         if len(self.msgs) >= 10000:
             # Avoid filling up memory with too many samples
@@ -235,13 +242,16 @@ class PrinterMotionReport:
         self.printer = config.get_printer()
         self.steppers = {}
         self.trapqs = {}
+        # Trapq history retention
+        self.history_time = config.getfloat('history_time', 30., above=0.)
+        self.history_moves = config.getint('history_moves', 32768, minval=16)
         # get_status information
         self.next_status_time = 0.
         gcode = self.printer.lookup_object('gcode')
         self.last_status = {
             'live_position': gcode.Coord(0., 0., 0., 0.),
             'live_velocity': 0., 'live_extruder_velocity': 0.,
-            'steppers': [], 'trapq': [],
+            'steppers': [], 'trapq': [], 'trapq_history_memory': 0,
         }
         # Register handlers
         self.printer.register_event_handler("klippy:connect", self._connect)
@@ -264,6 +274,10 @@ class PrinterMotionReport:
                 break
             etrapq = extruder.get_trapq()
             self.trapqs[ename] = DumpTrapQ(self.printer, ename, etrapq)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        for dtrapq in self.trapqs.values():
+            ffi_lib.trapq_set_history(dtrapq.trapq, self.history_time,
+                                      self.history_moves)
         # Populate 'trapq' and 'steppers' in get_status result
         self.last_status['steppers'] = list(sorted(self.steppers.keys()))
         self.last_status['trapq'] = list(sorted(self.trapqs.keys()))
@@ -322,8 +336,13 @@ class PrinterMotionReport:
             if pos is not None:
                 epos = (pos[0],)
                 evelocity = velocity
+        # Report history memory usage
+        ffi_main, ffi_lib = chelper.get_ffi()
+        history_memory = sum([ffi_lib.trapq_get_history_memory(dtrapq.trapq)
+                              for dtrapq in self.trapqs.values()])
         # Report status
         self.last_status = dict(self.last_status)
+        self.last_status['trapq_history_memory'] = history_memory
         self.last_status['live_position'] = toolhead.Coord(*(xyzpos + epos))
         self.last_status['live_velocity'] = xyzvelocity
         self.last_status['live_extruder_velocity'] = evelocity
@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, time, collections, threading, multiprocessing, os
+import chelper
 from . import bus, motion_report, adxl345
 
 MPU9250_ADDR =      0x68
@@ -128,34 +129,30 @@ class MPU9250:
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         last_sequence = self.last_sequence
         time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
-        # Process every message in raw_samples
-        count = seq = 0
-        samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        decode = ffi_lib.accel_decode_mpu9250
+        # Decode every message in raw_samples into a flat array
+        total = sum([len(params['data']) for params in raw_samples])
+        out = ffi_main.new('double[]', (total // BYTES_PER_SAMPLE) * 4 + 1)
+        count = seq = i = 0
         for params in raw_samples:
             seq_diff = (last_sequence - params['sequence']) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence - seq_diff
-            d = bytearray(params['data'])
+            d = params['data']
+            msg_count = len(d) // BYTES_PER_SAMPLE
+            if not msg_count:
+                continue
             msg_cdiff = seq * SAMPLES_PER_BLOCK - chip_base
-
-            for i in range(len(d) // BYTES_PER_SAMPLE):
-                d_xyz = d[i*BYTES_PER_SAMPLE:(i+1)*BYTES_PER_SAMPLE]
-                xhigh, xlow, yhigh, ylow, zhigh, zlow = d_xyz
-                # Merge and perform twos-complement
-                rx = ((xhigh << 8) | xlow) - ((xhigh & 0x80) << 9)
-                ry = ((yhigh << 8) | ylow) - ((yhigh & 0x80) << 9)
-                rz = ((zhigh << 8) | zlow) - ((zhigh & 0x80) << 9)
-
-                raw_xyz = (rx, ry, rz)
-                x = round(raw_xyz[x_pos] * x_scale, 6)
-                y = round(raw_xyz[y_pos] * y_scale, 6)
-                z = round(raw_xyz[z_pos] * z_scale, 6)
-                ptime = round(time_base + (msg_cdiff + i) * inv_freq, 6)
-                samples[count] = (ptime, x, y, z)
-                count += 1
+            count += decode(out + count * 4, d, msg_count,
+                            time_base, msg_cdiff, inv_freq,
+                            x_pos, x_scale, y_pos, y_scale, z_pos, z_scale)
+            i = msg_count - 1
         self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + i)
-        del samples[count:]
-        return samples
+        # Group the decoded values into (time, x, y, z) tuples - the same
+        # message is sent to API clients as a list of [time, x, y, z]
+        data = iter(ffi_main.unpack(out, count * 4))
+        return list(zip(data, data, data, data))
 
     def _update_clock(self, minclock=0):
         # Query current state
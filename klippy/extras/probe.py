@@ -3,7 +3,7 @@
 # Copyright (C) 2017-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, math
 import pins
 from . import manual_probe
 
@@ -349,6 +349,53 @@ class ProbeEndstopWrapper:
     def get_position_endstop(self):
         return self.position_endstop
 
+# Return the total XY travel distance of a path through the given points
+def calc_path_length(start_pos, points, order):
+    pos = start_pos
+    total = 0.
+    for i in order:
+        total += math.hypot(points[i][0] - pos[0], points[i][1] - pos[1])
+        pos = points[i]
+    return total
+
+# Find a short path (starting from start_pos) that visits all points.
+# Builds a nearest neighbor path and then improves it using 2-opt.
+def optimize_probe_order(start_pos, points, max_passes=20):
+    def dist(a, b):
+        return math.hypot(a[0] - b[0], a[1] - b[1])
+    # Nearest neighbor path
+    remaining = list(range(len(points)))
+    order = []
+    pos = start_pos
+    while remaining:
+        i = min(remaining, key=lambda i: dist(pos, points[i]))
+        remaining.remove(i)
+        order.append(i)
+        pos = points[i]
+    # Improve the (open ended) path by reversing segments
+    path = [start_pos] + [points[i] for i in order]
+    count = len(path)
+    for p in range(max_passes):
+        improved = False
+        for i in range(1, count - 1):
+            a, b = path[i-1], path[i]
+            d_ab = dist(a, b)
+            for j in range(i + 1, count):
+                c = path[j]
+                change = dist(a, c) - d_ab
+                if j + 1 < count:
+                    d = path[j+1]
+                    change += dist(b, d) - dist(c, d)
+                if change < -0.000001:
+                    path[i:j+1] = path[i:j+1][::-1]
+                    order[i-1:j] = order[i-1:j][::-1]
+                    b = path[i]
+                    d_ab = dist(a, b)
+                    improved = True
+        if not improved:
+            break
+    return order
+
 # Helper code that can probe a series of points and report the
 # position at each point.
 class ProbePointsHelper:
@@ -365,9 +412,13 @@ class ProbePointsHelper:
         self.horizontal_move_z = config.getfloat('horizontal_move_z', 5.)
         self.speed = config.getfloat('speed', 50., above=0.)
         self.use_offsets = False
+        self.optimize_order = config.getboolean('optimize_probe_order', False)
         # Internal probing state
         self.lift_speed = self.speed
         self.probe_offsets = (0., 0., 0.)
+        self.probe_subset = None
+        self.probe_order = []
+        self.order_savings = None
         self.results = []
     def minimum_points(self,n):
         if len(self.probe_points) < n:
@@ -376,6 +427,10 @@ class ProbePointsHelper:
     def update_probe_points(self, points, min_points):
         self.probe_points = points
         self.minimum_points(min_points)
+    def set_probe_subset(self, indices):
+        # Only probe the given points on the next round (the positions
+        # of the skipped points are reported as None)
+        self.probe_subset = indices
     def use_xy_offsets(self, use_offsets):
         self.use_offsets = use_offsets
     def get_lift_speed(self):
@@ -389,29 +444,67 @@ class ProbePointsHelper:
             speed = self.speed
         toolhead.manual_move([None, None, self.horizontal_move_z], speed)
         # Check if done probing
-        if len(self.results) >= len(self.probe_points):
+        if len(self.results) >= len(self.probe_order):
             toolhead.get_last_move_time()
-            res = self.finalize_callback(self.probe_offsets, self.results)
+            # Report results in the order of the configured points
+            results = [None] * len(self.probe_points)
+            for i, pos in zip(self.probe_order, self.results):
+                results[i] = pos
+            self._report_order_savings()
+            res = self.finalize_callback(self.probe_offsets, results)
             if res != "retry":
                 return True
             self.results = []
+            self._setup_probe_order()
         # Move to next XY probe point
-        nextpos = list(self.probe_points[len(self.results)])
+        nextpos = list(self.probe_points[self.probe_order[len(self.results)]])
         if self.use_offsets:
             nextpos[0] -= self.probe_offsets[0]
             nextpos[1] -= self.probe_offsets[1]
         toolhead.manual_move(nextpos, self.speed)
         return False
+    def _setup_probe_order(self):
+        indices = self.probe_subset
+        self.probe_subset = None
+        if indices is None:
+            indices = list(range(len(self.probe_points)))
+        self.probe_order = list(indices)
+        self.order_savings = None
+        if not self.optimize_order or len(indices) < 3:
+            return
+        # Travel distances are the same in nozzle and probe coordinates,
+        # so only the start position needs to account for probe offsets
+        toolhead = self.printer.lookup_object('toolhead')
+        start_pos = toolhead.get_position()[:2]
+        if self.use_offsets:
+            start_pos = [start_pos[0] + self.probe_offsets[0],
+                         start_pos[1] + self.probe_offsets[1]]
+        points = [self.probe_points[i] for i in indices]
+        orig_dist = calc_path_length(start_pos, points, range(len(points)))
+        order = optimize_probe_order(start_pos, points)
+        new_dist = calc_path_length(start_pos, points, order)
+        if new_dist < orig_dist:
+            self.probe_order = [indices[i] for i in order]
+            self.order_savings = (orig_dist, new_dist)
+    def _report_order_savings(self):
+        if self.order_savings is None:
+            return
+        orig_dist, new_dist = self.order_savings
+        self.gcode.respond_info(
+            "Optimized probe order: travel %.1fmm -> %.1fmm (%.1fs saved)"
+            % (orig_dist, new_dist, (orig_dist - new_dist) / self.speed))
     def start_probe(self, gcmd):
         manual_probe.verify_no_manual_probe(self.printer)
         # Lookup objects
         probe = self.printer.lookup_object('probe', None)
         method = gcmd.get('METHOD', 'automatic').lower()
         self.results = []
+        self.probe_subset = None
         if probe is None or method != 'automatic':
             # Manual probe
             self.lift_speed = self.speed
             self.probe_offsets = (0., 0., 0.)
+            self._setup_probe_order()
             self._manual_probe_start()
             return
         # Perform automatic probing
@@ -420,6 +513,7 @@ class ProbePointsHelper:
         if self.horizontal_move_z < self.probe_offsets[2]:
             raise gcmd.error("horizontal_move_z can't be less than"
                              " probe's z_offset")
+        self._setup_probe_order()
         probe.multi_probe_begin()
         while 1:
             done = self._move_next()
@@ -35,6 +35,7 @@ class QuadGantryLevel:
                 "Need exactly 4 probe points for quad_gantry_level")
         self.z_status = z_tilt.ZAdjustStatus(self.printer)
         self.z_helper = z_tilt.ZAdjustHelper(config, 4)
+        self.predictor = z_tilt.ZAdjustPredictor(config, 4)
         self.gantry_corners = config.getlists('gantry_corners', parser=float,
                                               seps=(',', '\n'), count=2)
         if len(self.gantry_corners) < 2:
@@ -50,8 +51,10 @@ class QuadGantryLevel:
     def cmd_QUAD_GANTRY_LEVEL(self, gcmd):
         self.z_status.reset()
         self.retry_helper.start(gcmd)
+        self.predictor.start()
         self.probe_helper.start_probe(gcmd)
     def probe_finalize(self, offsets, positions):
+        self.predictor.note_positions(positions)
         # Mirror our perspective so the adjustments make sense
         # from the perspective of the gantry
         z_positions = [self.horizontal_move_z - p[2] for p in positions]
@@ -99,6 +102,7 @@ class QuadGantryLevel:
         z_adjust = []
         for z in z_height:
             z_adjust.append(z_ave - z)
+        z_adjust = self.predictor.calc_adjustments(z_adjust)
 
         adjust_max = max(z_adjust)
         if adjust_max > self.max_adjust:
@@ -109,8 +113,8 @@ class QuadGantryLevel:
 
         speed = self.probe_helper.get_lift_speed()
         self.z_helper.adjust_steppers(z_adjust, speed)
-        return self.z_status.check_retry_result(
-            self.retry_helper.check_retry(z_positions))
+        res = self.retry_helper.check_retry(z_positions)
+        return self.z_status.check_retry_result(self.predictor.finish(res))
 
     def linefit(self,p1,p2):
         if p1[1] == p2[1]:
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, os, time
-from . import shaper_calibrate
+from . import adxl345, shaper_calibrate
 
 class TestAxis:
     def __init__(self, axis=None, vib_dir=None):
@@ -147,8 +147,32 @@ class ResonanceTester:
                 (chip_axis, self.printer.lookup_object(chip_name))
                 for chip_axis, chip_name in self.accel_chip_names]
 
+    def _finish_test(self, gcmd, helper, test, unfinished, raw_files):
+        # Finish the measurements of a test and start processing its data
+        axis, raw_values, psd_streams, raw_names, raw_format = test
+        for (chip_axis, aclient, chip_name), raw_name in zip(raw_values,
+                                                             raw_names):
+            aclient.finish_measurements()
+            if raw_name is not None:
+                raw_files.append((aclient, raw_name, raw_format))
+        unfinished.remove(raw_values)
+        if helper is None:
+            return (axis, [])
+        pending = []
+        for chip_axis, aclient, chip_name in raw_values:
+            if aclient.get_stream_error() is not None:
+                raise gcmd.error(
+                    "error processing accelerometer '%s' data: %s" % (
+                        chip_name, aclient.get_stream_error()))
+            if not aclient.has_valid_samples():
+                raise gcmd.error(
+                    "accelerometer '%s' measured no data" % (
+                        chip_name,))
+            pending.append(helper.start_accelerometer_data_processing(
+                    psd_streams.get(aclient, aclient)))
+        return (axis, pending)
     def _run_test(self, gcmd, axes, helper, raw_name_suffix=None,
-                  accel_chips=None, test_point=None):
+                  raw_format="npy", accel_chips=None, test_point=None):
         toolhead = self.printer.lookup_object('toolhead')
         calibration_data = {axis: None for axis in axes}
 
@@ -159,53 +183,91 @@ class ResonanceTester:
         else:
             test_points = self.test.get_start_test_points()
 
-        for point in test_points:
-            toolhead.manual_move(point, self.move_speed)
-            if len(test_points) > 1 or test_point is not None:
-                gcmd.respond_info(
-                        "Probing point (%.3f, %.3f, %.3f)" % tuple(point))
-            for axis in axes:
-                toolhead.wait_moves()
-                toolhead.dwell(0.500)
-                if len(axes) > 1:
-                    gcmd.respond_info("Testing axis %s" % axis.get_name())
+        # Each test is finished (and its data processing is started)
+        # while the moves of the next test are running
+        last_test = None
+        finished_tests = []
+        unfinished = []
+        raw_files = []
+        try:
+            for point in test_points:
+                toolhead.manual_move(point, self.move_speed)
+                if len(test_points) > 1 or test_point is not None:
+                    gcmd.respond_info(
+                            "Probing point (%.3f, %.3f, %.3f)" % tuple(point))
+                for axis in axes:
+                    toolhead.dwell(0.500)
+                    if len(axes) > 1:
+                        gcmd.respond_info("Testing axis %s" % axis.get_name())
 
-                raw_values = []
-                if accel_chips is None:
-                    for chip_axis, chip in self.accel_chips:
-                        if axis.matches(chip_axis):
+                    raw_values = []
+                    unfinished.append(raw_values)
+                    if accel_chips is None:
+                        for chip_axis, chip in self.accel_chips:
+                            if axis.matches(chip_axis):
+                                aclient = chip.start_internal_client()
+                                raw_values.append(
+                                        (chip_axis, aclient, chip.name))
+                    else:
+                        for chip in accel_chips:
                             aclient = chip.start_internal_client()
-                            raw_values.append((chip_axis, aclient, chip.name))
-                else:
-                    for chip in accel_chips:
-                        aclient = chip.start_internal_client()
-                        raw_values.append((axis, aclient, chip.name))
+                            raw_values.append((axis, aclient, chip.name))
 
-                # Generate moves
-                self.test.run_test(axis, gcmd)
-                for chip_axis, aclient, chip_name in raw_values:
-                    aclient.finish_measurements()
-                    if raw_name_suffix is not None:
-                        raw_name = self.get_filename(
+                    # Calculate the PSD while the test moves are running
+                    psd_streams = {}
+                    if helper is not None and raw_name_suffix is None:
+                        for chip_axis, aclient, chip_name in raw_values:
+                            psd = helper.create_psd_accumulator()
+                            aclient.stream_samples(psd)
+                            psd_streams[aclient] = psd
+
+                    # Generate moves
+                    self.test.run_test(axis, gcmd)
+                    raw_names = []
+                    for chip_axis, aclient, chip_name in raw_values:
+                        aclient.end_measurements()
+                        raw_name = None
+                        if raw_name_suffix is not None:
+                            raw_name = self.get_filename(
                                 'raw_data', raw_name_suffix, axis,
                                 point if len(test_points) > 1 else None,
-                                chip_name if accel_chips is not None else None,)
-                        aclient.write_to_file(raw_name)
-                        gcmd.respond_info(
-                                "Writing raw accelerometer data to "
-                                "%s file" % (raw_name,))
-                if helper is None:
-                    continue
+                                chip_name if accel_chips is not None else None,
+                                ext=raw_format)
+                        raw_names.append(raw_name)
+                    test = (axis, raw_values, psd_streams, raw_names,
+                            raw_format)
+                    if last_test is not None:
+                        finished_tests.append(self._finish_test(
+                                gcmd, helper, last_test, unfinished, raw_files))
+                    last_test = test
+            if last_test is not None:
+                finished_tests.append(self._finish_test(
+                        gcmd, helper, last_test, unfinished, raw_files))
+        finally:
+            # Release the clients of any tests interrupted by an error
+            for raw_values in unfinished:
                 for chip_axis, aclient, chip_name in raw_values:
-                    if not aclient.has_valid_samples():
-                        raise gcmd.error(
-                            "accelerometer '%s' measured no data" % (
-                                chip_name,))
-                    new_data = helper.process_accelerometer_data(aclient)
-                    if calibration_data[axis] is None:
-                        calibration_data[axis] = new_data
-                    else:
-                        calibration_data[axis].add_data(new_data)
+                    try:
+                        aclient.finish_measurements()
+                    except:
+                        logging.exception(
+                                "Error finishing accelerometer measurements")
+        # Write the raw data once the test moves are complete so that the
+        # writer threads don't compete with the test
+        for aclient, raw_name, raw_format in raw_files:
+            aclient.write_to_file(raw_name, raw_format)
+            gcmd.respond_info("Writing raw accelerometer data to %s file"
+                              % (raw_name,))
+        if helper is None:
+            return calibration_data
+        # Merge the results in the order the tests were run
+        for axis, pending in finished_tests:
+            for new_data in helper.finish_accelerometer_data_processing(
+                    pending):
+                if calibration_data[axis] is None:
+                    calibration_data[axis] = new_data
+                else:
+                    calibration_data[axis].add_data(new_data)
         return calibration_data
     cmd_TEST_RESONANCES_help = ("Runs the resonance test for a specifed axis")
     def cmd_TEST_RESONANCES(self, gcmd):
@@ -247,6 +309,9 @@ class ResonanceTester:
             raise gcmd.error("Invalid NAME parameter")
         csv_output = 'resonances' in outputs
         raw_output = 'raw_data' in outputs
+        raw_format = gcmd.get("RAW_FORMAT", "npy").lower()
+        if raw_format not in adxl345.ACCEL_FILE_FORMATS:
+            raise gcmd.error("Invalid RAW_FORMAT parameter")
 
         # Setup calculation of resonances
         if csv_output:
@@ -257,6 +322,7 @@ class ResonanceTester:
         data = self._run_test(
                 gcmd, [axis], helper,
                 raw_name_suffix=name_suffix if raw_output else None,
+                raw_format=raw_format,
                 accel_chips=parsed_chips if accel_chips else None,
                 test_point=test_point)[axis]
         if csv_output:
@@ -322,12 +388,15 @@ class ResonanceTester:
         for chip_axis, aclient in raw_values:
             aclient.finish_measurements()
         helper = shaper_calibrate.ShaperCalibrate(self.printer)
+        pending = []
         for chip_axis, aclient in raw_values:
             if not aclient.has_valid_samples():
                 raise gcmd.error(
                         "%s-axis accelerometer measured no data" % (
                             chip_axis,))
-            data = helper.process_accelerometer_data(aclient)
+            pending.append(helper.start_accelerometer_data_processing(aclient))
+        results = helper.finish_accelerometer_data_processing(pending)
+        for (chip_axis, aclient), data in zip(raw_values, results):
             vx = data.psd_x.mean()
             vy = data.psd_y.mean()
             vz = data.psd_z.mean()
@@ -339,7 +408,7 @@ class ResonanceTester:
         return name_suffix.replace('-', '').replace('_', '').isalnum()
 
     def get_filename(self, base, name_suffix, axis=None,
-                     point=None, chip_name=None):
+                     point=None, chip_name=None, ext="csv"):
         name = base
         if axis:
             name += '_' + axis.get_name()
@@ -348,7 +417,7 @@ class ResonanceTester:
         if point:
             name += "_%.3f_%.3f_%.3f" % (point[0], point[1], point[2])
         name += '_' + name_suffix
-        return os.path.join("/tmp", name + ".csv")
+        return os.path.join("/tmp", name + "." + ext)
 
     def save_calibration_data(self, base_name, name_suffix, shaper_calibrate,
                               axis, calibration_data,
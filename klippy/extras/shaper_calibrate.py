@@ -3,12 +3,13 @@
 # Copyright (C) 2020  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing, traceback
+import collections, importlib, logging, math
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
 WINDOW_T_SEC = 0.5
+STREAM_MAX_WINDOWS = 2
 MAX_SHAPER_FREQ = 150.
 
 TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
@@ -41,6 +42,11 @@ class CalibrationData:
             psd *= self.data_sets
             psd[:] = (psd + other_normalized) * (1. / joined_data_sets)
         self.data_sets = joined_data_sets
+    def __getstate__(self):
+        # The numpy module can not be pickled
+        state = dict(self.__dict__)
+        state.pop('numpy', None)
+        return state
     def set_numpy(self, numpy):
         self.numpy = numpy
     def normalize_to_frequencies(self):
@@ -53,14 +59,102 @@ class CalibrationData:
         return self._psd_map[axis]
 
 
+# Incremental Welch PSD calculation from a stream of accelerometer
+# samples.  Only the unprocessed tail of the stream and the running
+# sums of the window spectra are kept in memory.
+class PSDAccumulator:
+    def __init__(self, helper):
+        self.helper = helper
+        self.numpy = helper.numpy
+        self.buffer = None
+        self.window = self.psd_sums = None
+        self.window_size = self.window_count = 0
+        self.sample_count = 0
+        self.first_time = self.last_time = 0.
+    def _setup_window(self):
+        np = self.numpy
+        # Select the window size from the sampling rate observed so far
+        sampling_freq = self.sample_count / (self.last_time - self.first_time)
+        M = 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+        self.window_size = M
+        self.window = np.kaiser(M, 6.)
+        self.psd_sums = np.zeros(shape=(3, M // 2 + 1))
+    def _process_windows(self, max_windows=None):
+        np = self.numpy
+        M = self.window_size
+        overlap = M // 2
+        step_between_windows = M - overlap
+        n_windows = (self.buffer.shape[0] - overlap) // step_between_windows
+        if max_windows is not None:
+            n_windows = min(n_windows, max_windows)
+        if n_windows <= 0:
+            return
+        for i in range(3):
+            x = self.helper._split_into_windows(
+                    self.buffer[:step_between_windows * n_windows + overlap, i],
+                    M, overlap)
+            # Detrend, apply windowing function and accumulate the response
+            x = self.window[:, None] * (x - np.mean(x, axis=0))
+            result = np.fft.rfft(x, n=M, axis=0)
+            self.psd_sums[i] += (np.conjugate(result) * result).real.sum(
+                    axis=-1)
+        self.window_count += n_windows
+        self.buffer = self.buffer[step_between_windows * n_windows:].copy()
+    def add_samples(self, samples):
+        np = self.numpy
+        if not self.sample_count:
+            self.first_time = samples[0][0]
+        self.sample_count += len(samples)
+        self.last_time = samples[-1][0]
+        data = np.array(samples)[:, 1:]
+        if self.buffer is not None:
+            data = np.concatenate((self.buffer, data))
+        self.buffer = data
+        if not self.window_size:
+            if self.last_time - self.first_time < 2. * WINDOW_T_SEC:
+                return
+            self._setup_window()
+        # Limit the work done per message - any remaining windows are
+        # processed with later samples or in get_calibration_data()
+        self._process_windows(STREAM_MAX_WINDOWS)
+    def get_calibration_data(self):
+        np = self.numpy
+        N = self.sample_count
+        T = self.last_time - self.first_time
+        if N < 2 or T <= 0.:
+            return None
+        if not self.window_size:
+            self._setup_window()
+        M = self.window_size
+        if N <= M:
+            return None
+        self._process_windows()
+        SAMPLING_FREQ = N / T
+        # Compensation for windowing loss
+        scale = 1.0 / (self.window**2).sum()
+        psd = self.psd_sums * (scale / SAMPLING_FREQ / self.window_count)
+        # For one-sided FFT output the response must be doubled, except
+        # the last point for unpaired Nyquist frequency and the 'DC' term
+        psd[:, 1:-1] *= 2.
+        freqs = np.fft.rfftfreq(M, 1. / SAMPLING_FREQ)
+        px, py, pz = psd
+        return CalibrationData(freqs, px+py+pz, px, py, pz)
+
+
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score', 'max_accel'))
 
+ShaperResponses = collections.namedtuple(
+        'ShaperResponses',
+        ('test_freqs', 'smoothing', 'vals'))
+
 class ShaperCalibrate:
     def __init__(self, printer):
         self.printer = printer
         self.error = printer.command_error if printer else Exception
+        self.responses_key = None
+        self.shaper_responses = {}
         try:
             self.numpy = importlib.import_module('numpy')
         except ImportError:
@@ -69,41 +163,24 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
+    def __reduce__(self):
+        # Background calculations do not need access to the printer and
+        # share one instance per process (to reuse the shaper responses)
+        return (_get_worker_helper, ())
+
     def background_process_exec(self, method, args):
+        return self.background_process_exec_all([(method, args)])[0]
+
+    def background_process_exec_all(self, calls):
+        # Run a list of (method, args) calculations in parallel
         if self.printer is None:
-            return method(*args)
-        import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
-        def wrapper():
-            queuelogger.clear_bg_logging()
-            try:
-                res = method(*args)
-            except:
-                child_conn.send((True, traceback.format_exc()))
-                child_conn.close()
-                return
-            child_conn.send((False, res))
-            child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+            return [method(*args) for method, args in calls]
+        calc_workers = self.printer.lookup_object('calc_workers')
+        results = calc_workers.run_all(calls)
+        for is_err, res in results:
+            if is_err:
+                raise self.error("Error in remote calculation: %s" % (res,))
+        return [res for is_err, res in results]
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -172,40 +249,66 @@ class ShaperCalibrate:
         fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
         return CalibrationData(fx, px+py+pz, px, py, pz)
 
+    def create_psd_accumulator(self):
+        return PSDAccumulator(self)
+
+    def start_accelerometer_data_processing(self, data):
+        # Start processing the accelerometer data without waiting for
+        # the result - see finish_accelerometer_data_processing()
+        if isinstance(data, PSDAccumulator):
+            # The PSD was already calculated while the data was streamed
+            return (data, None, data.get_calibration_data())
+        if data is not None and not isinstance(data, self.numpy.ndarray):
+            # Only the raw samples are sent to the calculation process
+            samples = data.get_samples()
+            data = self.numpy.array(samples) if samples else None
+        if self.printer is None:
+            return (data, None, self.calc_freq_response(data))
+        calc_workers = self.printer.lookup_object('calc_workers')
+        completion = calc_workers.submit(self.calc_freq_response, (data,))
+        return (data, completion, None)
+
+    def finish_accelerometer_data_processing(self, pending):
+        # Wait for a list of started calculations and return the
+        # resulting calibration data (in the same order)
+        completions = [c for d, c, r in pending if c is not None]
+        if completions:
+            calc_workers = self.printer.lookup_object('calc_workers')
+            results = iter(calc_workers.wait_all(completions))
+        res = []
+        for data, completion, calibration_data in pending:
+            if completion is not None:
+                is_err, calibration_data = next(results)
+                if is_err:
+                    raise self.error("Error in remote calculation: %s"
+                                     % (calibration_data,))
+            if calibration_data is None:
+                raise self.error("Internal error processing accelerometer"
+                                 " data %s" % (data,))
+            calibration_data.set_numpy(self.numpy)
+            res.append(calibration_data)
+        return res
+
     def process_accelerometer_data(self, data):
-        calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
-        if calibration_data is None:
-            raise self.error(
-                    "Internal error processing accelerometer data %s" % (data,))
-        calibration_data.set_numpy(self.numpy)
-        return calibration_data
+        pending = [self.start_accelerometer_data_processing(data)]
+        return self.finish_accelerometer_data_processing(pending)[0]
 
-    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+    def _estimate_shapers(self, A, T, test_damping_ratio, test_freqs):
+        # Estimate the response of a set of shapers (one shaper per row
+        # of the A and T arrays) at the given frequencies
         np = self.numpy
 
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
+        inv_D = 1. / A.sum(axis=-1)
 
         omega = 2. * math.pi * test_freqs
         damping = test_damping_ratio * omega
         omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
-
-    def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
-                                       freq_bins, psd):
-        vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
-        # The input shaper can only reduce the amplitude of vibrations by
-        # SHAPER_VIBRATION_REDUCTION times, so all vibrations below that
-        # threshold can be igonred
-        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
-        remaining_vibrations = self.numpy.maximum(
-                vals * psd - vibr_threshold, 0).sum()
-        all_vibrations = self.numpy.maximum(psd - vibr_threshold, 0).sum()
-        return (remaining_vibrations / all_vibrations, vals)
+        W = A[:, None, :] * np.exp(-damping[None, :, None]
+                                   * (T[:, -1:] - T)[:, None, :])
+        S = W * np.sin(omega_d[None, :, None] * T[:, None, :])
+        C = W * np.cos(omega_d[None, :, None] * T[:, None, :])
+        return (np.sqrt(S.sum(axis=-1)**2 + C.sum(axis=-1)**2)
+                * inv_D[:, None])
 
     def _get_shaper_smoothing(self, shaper, accel=5000, scv=5.):
         half_accel = accel * .5
@@ -227,34 +330,63 @@ class ShaperCalibrate:
         offset_180 *= inv_D
         return max(offset_90, offset_180)
 
-    def fit_shaper(self, shaper_cfg, calibration_data, max_smoothing):
+    def _calc_shaper_responses(self, shaper_cfg, freq_bins):
+        # Calculate the parts of the shaper fitting that do not depend
+        # on the measured PSD (they can be reused between fits)
         np = self.numpy
+        test_freqs = np.arange(shaper_cfg.min_freq, MAX_SHAPER_FREQ, .2)[::-1]
+        shapers = [shaper_cfg.init_func(
+            test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
+                   for test_freq in test_freqs]
+        A = np.array([shaper[0] for shaper in shapers])
+        T = np.array([shaper[1] for shaper in shapers])
+        smoothing = [self._get_shaper_smoothing(shaper) for shaper in shapers]
+        vals = np.array([self._estimate_shapers(A, T, dr, freq_bins)
+                         for dr in TEST_DAMPING_RATIOS])
+        return ShaperResponses(test_freqs=test_freqs, smoothing=smoothing,
+                               vals=vals)
 
-        test_freqs = np.arange(shaper_cfg.min_freq, MAX_SHAPER_FREQ, .2)
+    def fit_shaper(self, shaper_cfg, calibration_data, max_smoothing):
+        return self._fit_shaper(shaper_cfg, calibration_data, max_smoothing,
+                                None)[0]
+
+    def _fit_shaper(self, shaper_cfg, calibration_data, max_smoothing,
+                    responses):
+        np = self.numpy
 
         freq_bins = calibration_data.freq_bins
         psd = calibration_data.psd_sum[freq_bins <= MAX_FREQ]
         freq_bins = freq_bins[freq_bins <= MAX_FREQ]
+        if responses is None:
+            responses = self._calc_shaper_responses(shaper_cfg, freq_bins)
+
+        # The input shaper can only reduce the amplitude of vibrations by
+        # SHAPER_VIBRATION_REDUCTION times, so all vibrations below that
+        # threshold can be igonred
+        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+        # Exact damping ratio of the printer is unknown, pessimizing
+        # remaining vibrations over possible damping values
+        all_shaper_vibrations = np.zeros(shape=responses.test_freqs.shape)
+        all_shaper_vals = np.zeros(shape=responses.vals.shape[1:])
+        for vals in responses.vals:
+            vibrations = np.maximum(
+                    vals * psd - vibr_threshold, 0).sum(axis=-1)
+            vibrations /= all_vibrations
+            all_shaper_vals = np.maximum(all_shaper_vals, vals)
+            all_shaper_vibrations = np.where(
+                    vibrations > all_shaper_vibrations,
+                    vibrations, all_shaper_vibrations)
 
         best_res = None
         results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(
-                    test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
-            shaper_smoothing = self._get_shaper_smoothing(shaper)
+        for i, test_freq in enumerate(responses.test_freqs):
+            shaper_smoothing = responses.smoothing[i]
             if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in TEST_DAMPING_RATIOS:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper)
+                # Use the best result found so far
+                results = [best_res]
+                break
+            shaper_vibrations = all_shaper_vibrations[i]
             # The score trying to minimize vibrations, but also accounting
             # the growth of smoothing. The formula itself does not have any
             # special meaning, it simply shows good results on real user data
@@ -262,9 +394,10 @@ class ShaperCalibrate:
                                                shaper_vibrations * .2 + .01)
             results.append(
                     CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
+                        name=shaper_cfg.name, freq=test_freq,
+                        vals=all_shaper_vals[i], vibrs=shaper_vibrations,
+                        smoothing=shaper_smoothing, score=shaper_score,
+                        max_accel=None))
             if best_res is None or best_res.vibrs > results[-1].vibrs:
                 # The current frequency is better for the shaper.
                 best_res = results[-1]
@@ -274,7 +407,12 @@ class ShaperCalibrate:
         for res in results[::-1]:
             if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
                 selected = res
-        return selected
+        # Only calculate max_accel for the selected configuration
+        shaper = shaper_cfg.init_func(selected.freq,
+                                      shaper_defs.DEFAULT_DAMPING_RATIO)
+        selected = selected._replace(
+                max_accel=self.find_shaper_max_accel(shaper))
+        return selected, responses
 
     def _bisect(self, func):
         left = right = 1.
@@ -300,14 +438,45 @@ class ShaperCalibrate:
             shaper, test_accel) <= TARGET_SMOOTHING)
         return max_accel
 
+    def _fit_shapers(self, shaper_cfgs, calibration_data, max_smoothing):
+        # Fit a group of shapers, reusing the shaper responses of
+        # previous fits with the same frequency bins
+        freq_bins = calibration_data.freq_bins
+        bins_key = freq_bins[freq_bins <= MAX_FREQ].tobytes()
+        if bins_key != self.responses_key:
+            self.responses_key = bins_key
+            self.shaper_responses = {}
+        shapers = []
+        for shaper_cfg in shaper_cfgs:
+            shaper, responses = self._fit_shaper(
+                    shaper_cfg, calibration_data, max_smoothing,
+                    self.shaper_responses.get(shaper_cfg.name))
+            self.shaper_responses[shaper_cfg.name] = responses
+            shapers.append(shaper)
+        return shapers
+
     def find_best_shaper(self, calibration_data, max_smoothing, logger=None):
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in AUTOTUNE_SHAPERS]
+        # Fit the shapers in parallel - each calculation worker receives
+        # the calibration data once for its group of shapers
+        num_groups = 1
+        if self.printer is not None:
+            calc_workers = self.printer.lookup_object('calc_workers')
+            num_groups = calc_workers.get_worker_count()
+        groups = [shaper_cfgs[i::num_groups] for i in range(num_groups)]
+        groups = [group for group in groups if group]
+        fits = self.background_process_exec_all([
+            (self._fit_shapers, (group, calibration_data, max_smoothing))
+            for group in groups])
+        fitted = {}
+        for group, shapers in zip(groups, fits):
+            for shaper_cfg, shaper in zip(group, shapers):
+                fitted[shaper_cfg.name] = shaper
         best_shaper = None
         all_shapers = []
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in AUTOTUNE_SHAPERS:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, max_smoothing))
+        for shaper_cfg in shaper_cfgs:
+            shaper = fitted[shaper_cfg.name]
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
@@ -358,3 +527,12 @@ class ShaperCalibrate:
                     csvfile.write("\n")
         except IOError as e:
             raise self.error("Error writing to file '%s': %s", output, str(e))
+
+# ShaperCalibrate instance shared by the calculations of a worker process
+_worker_helper = None
+
+def _get_worker_helper():
+    global _worker_helper
+    if _worker_helper is None:
+        _worker_helper = ShaperCalibrate(None)
+    return _worker_helper
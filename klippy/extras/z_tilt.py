@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, functools
 import mathutil
 from . import probe
 
@@ -124,6 +124,118 @@ class RetryHelper:
             raise self.gcode.error("Too many retries")
         return "retry"
 
+# Limits on the learned ratio of realized to requested Z adjustment
+MIN_GAIN = 0.5
+MAX_GAIN = 1.5
+# Smallest requested adjustment (in mm) that is used for learning
+MIN_LEARN_ADJUST = 0.010
+# Weight of the previously learned gains relative to new measurements
+PRIOR_WEIGHT = 0.1
+
+# Residuals of the observed relative stepper movement for the given gains
+def gain_residuals(samples, prior_gains, weight, params):
+    gains = [params['gain%d' % (i,)] for i in range(len(prior_gains))]
+    residuals = []
+    for moves, change in samples:
+        realized = [g * m for g, m in zip(gains, moves)]
+        avg = sum(realized) / len(realized)
+        residuals.extend([r - avg - c for r, c in zip(realized, change)])
+    residuals.extend([weight * (g - p) for g, p in zip(gains, prior_gains)])
+    return residuals
+
+# Helper that learns how much of each requested Z stepper adjustment is
+# actually realized (eg, due to gantry flex) and scales future
+# adjustments accordingly.  The learned gains are stored with
+# [save_variables] (if available) so that they persist between runs.
+class ZAdjustPredictor:
+    def __init__(self, config, z_count):
+        self.printer = config.get_printer()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.enabled = config.getboolean('predict_adjustments', False)
+        self.var_name = config.get_name().replace(' ', '_') + '_gains'
+        self.gains = [1.] * z_count
+        self.last_moves = self.last_needed = None
+        self.samples = []
+        self.prior_gains = list(self.gains)
+        self.rounds = self.probed_points = self.skipped_points = 0
+        self.start_time = 0.
+        if self.enabled:
+            self.printer.register_event_handler("klippy:connect",
+                                                self.handle_connect)
+    def handle_connect(self):
+        # Load the gains learned during previous runs
+        save_variables = self.printer.lookup_object('save_variables', None)
+        if save_variables is None:
+            return
+        gains = save_variables.allVariables.get(self.var_name)
+        if isinstance(gains, list) and len(gains) == len(self.gains):
+            self.gains = [min(MAX_GAIN, max(MIN_GAIN, float(g)))
+                          for g in gains]
+    def start(self):
+        self.last_moves = self.last_needed = None
+        self.samples = []
+        self.prior_gains = list(self.gains)
+        self.rounds = self.probed_points = self.skipped_points = 0
+        self.start_time = self.printer.get_reactor().monotonic()
+    def note_positions(self, positions):
+        probed = len([p for p in positions if p is not None])
+        self.rounds += 1
+        self.probed_points += probed
+        self.skipped_points += len(positions) - probed
+    def _fit_gains(self):
+        # Only relative movement between the steppers is observable, so
+        # the gains are kept close to the previously learned values
+        weight = PRIOR_WEIGHT * max([-min(moves)
+                                     for moves, change in self.samples])
+        params = {'gain%d' % (i,): g for i, g in enumerate(self.gains)}
+        residual_func = functools.partial(
+            gain_residuals, self.samples, self.prior_gains, weight)
+        new_params = mathutil.least_squares(list(params.keys()), params,
+                                            residual_func)
+        gains = [new_params['gain%d' % (i,)] for i in range(len(self.gains))]
+        self.gains = [min(MAX_GAIN, max(MIN_GAIN, g)) for g in gains]
+    def calc_adjustments(self, needed):
+        if not self.enabled:
+            return needed
+        avg = sum(needed) / len(needed)
+        needed = [n - avg for n in needed]
+        # Update the gains from the response to the previous adjustment
+        if self.last_moves is not None:
+            change = [p - c for p, c in zip(self.last_needed, needed)]
+            if min(self.last_moves) <= -MIN_LEARN_ADJUST:
+                self.samples.append((self.last_moves, change))
+                self._fit_gains()
+        # The stepper needing the largest adjustment is not moved (see
+        # ZAdjustHelper.adjust_steppers) - scale the other movements
+        max_needed = max(needed)
+        moves = [(n - max_needed) / g for n, g in zip(needed, self.gains)]
+        self.last_moves, self.last_needed = moves, needed
+        return [avg + max_needed + m for m in moves]
+    def finish(self, retry_result):
+        if not self.enabled or retry_result == "retry":
+            return retry_result
+        msg = "Leveling finished after %d rounds" % (self.rounds,)
+        if self.skipped_points and self.probed_points:
+            eventtime = self.printer.get_reactor().monotonic()
+            probe_time = (eventtime - self.start_time) / self.probed_points
+            msg += " (skipped %d probes, ~%.1fs saved)" % (
+                self.skipped_points, self.skipped_points * probe_time)
+        logging.info("%s: gains %s", msg, self.gains)
+        self.gcode.respond_info(msg)
+        if self.printer.lookup_object('save_variables', None) is not None:
+            self.gcode.run_script_from_command(
+                "SAVE_VARIABLE VARIABLE=%s VALUE=[%s]" % (
+                    self.var_name, ",".join(["%.4f" % g for g in self.gains])))
+        return retry_result
+
+# Error function for coordinate descent (run in a background process)
+def tilt_errorfunc(positions, params):
+    total_error = 0.
+    for x, y, z in positions:
+        total_error += (z - x*params['x_adjust'] - y*params['y_adjust']
+                        - params['z_adjust'])**2
+    return total_error
+
 class ZTilt:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -134,6 +246,8 @@ class ZTilt:
         self.probe_helper.minimum_points(2)
         self.z_status = ZAdjustStatus(self.printer)
         self.z_helper = ZAdjustHelper(config, len(self.z_positions))
+        self.predictor = ZAdjustPredictor(config, len(self.z_positions))
+        self.last_positions = self.residuals = None
         # Register Z_TILT_ADJUST command
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command('Z_TILT_ADJUST', self.cmd_Z_TILT_ADJUST,
@@ -142,24 +256,55 @@ class ZTilt:
     def cmd_Z_TILT_ADJUST(self, gcmd):
         self.z_status.reset()
         self.retry_helper.start(gcmd)
+        self.predictor.start()
+        self.last_positions = self.residuals = None
         self.probe_helper.start_probe(gcmd)
+    def _fit_plane(self, positions, z_offset):
+        params = { 'x_adjust': 0., 'y_adjust': 0., 'z_adjust': z_offset }
+        error_func = functools.partial(tilt_errorfunc, positions)
+        return mathutil.background_coordinate_descent(
+            self.printer, list(params.keys()), params, error_func)
+    def _predict_positions(self, positions, z_offset):
+        # Estimate the skipped points from the probed points, assuming
+        # the shape of the bed (relative to a plane) is unchanged
+        probed = [(p[0], p[1], p[2] - r)
+                  for p, r in zip(positions, self.residuals) if p is not None]
+        params = self._fit_plane(probed, z_offset)
+        predicted = []
+        for p, lp, r in zip(positions, self.last_positions, self.residuals):
+            if p is None:
+                x, y = lp[0], lp[1]
+                p = [x, y, (x*params['x_adjust'] + y*params['y_adjust']
+                            + params['z_adjust'] + r)]
+            predicted.append(p)
+        return predicted
+    def _select_confirm_points(self):
+        # Probe only the point nearest to each z stepper
+        points = self.probe_helper.probe_points
+        indices = set()
+        for zx, zy in self.z_positions:
+            dists = [((px - zx)**2 + (py - zy)**2, i)
+                     for i, (px, py) in enumerate(points)]
+            indices.add(min(dists)[1])
+        if len(indices) < 3 or len(indices) >= len(points):
+            return None
+        return sorted(indices)
     def probe_finalize(self, offsets, positions):
+        self.predictor.note_positions(positions)
         # Setup for coordinate descent analysis
         z_offset = offsets[2]
+        is_full_round = None not in positions
+        if not is_full_round:
+            positions = self._predict_positions(positions, z_offset)
         logging.info("Calculating bed tilt with: %s", positions)
-        params = { 'x_adjust': 0., 'y_adjust': 0., 'z_adjust': z_offset }
         # Perform coordinate descent
-        def adjusted_height(pos, params):
-            x, y, z = pos
-            return (z - x*params['x_adjust'] - y*params['y_adjust']
-                    - params['z_adjust'])
-        def errorfunc(params):
-            total_error = 0.
-            for pos in positions:
-                total_error += adjusted_height(pos, params)**2
-            return total_error
-        new_params = mathutil.coordinate_descent(
-            params.keys(), params, errorfunc)
+        new_params = self._fit_plane(positions, z_offset)
+        if is_full_round:
+            self.last_positions = positions
+            self.residuals = [z - x*new_params['x_adjust']
+                              - y*new_params['y_adjust']
+                              - new_params['z_adjust']
+                              for x, y, z in positions]
         # Apply results
         speed = self.probe_helper.get_lift_speed()
         logging.info("Calculated bed tilt parameters: %s", new_params)
@@ -169,9 +314,13 @@ class ZTilt:
                     - x_adjust * offsets[0] - y_adjust * offsets[1])
         adjustments = [x*x_adjust + y*y_adjust + z_adjust
                        for x, y in self.z_positions]
+        adjustments = self.predictor.calc_adjustments(adjustments)
         self.z_helper.adjust_steppers(adjustments, speed)
-        return self.z_status.check_retry_result(
-            self.retry_helper.check_retry([p[2] for p in positions]))
+        res = self.retry_helper.check_retry([p[2] for p in positions])
+        if res == "retry" and self.predictor.enabled and is_full_round:
+            # Only probe the points needed to confirm convergence
+            self.probe_helper.set_probe_subset(self._select_confirm_points())
+        return self.z_status.check_retry_result(self.predictor.finish(res))
     def get_status(self, eventtime):
             return self.z_status.get_status(eventtime)
 
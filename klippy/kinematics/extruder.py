@@ -78,7 +78,8 @@ class ExtruderStepper:
             new_smooth_time = 0.
         toolhead = self.printer.lookup_object("toolhead")
         toolhead.note_step_generation_scan_time(new_smooth_time * .5,
-                                                old_delay=old_smooth_time * .5)
+                                                old_delay=old_smooth_time * .5,
+                                                steppers=[self.stepper])
         ffi_main, ffi_lib = chelper.get_ffi()
         espa = ffi_lib.extruder_set_pressure_advance
         espa(self.sk_extruder, pressure_advance, new_smooth_time)
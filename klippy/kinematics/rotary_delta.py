@@ -70,6 +70,7 @@ class RotaryDeltaKinematics:
         arm_z = [self.calibration.elbow_coord(i, ea)[2]
                  for i, ea in enumerate(eangles)]
         self.limit_z = min([az - la for az, la in zip(arm_z, lower_arms)])
+        self.untapered_max_z = min(self.limit_z, self.max_z)
         logging.info(
             "Delta max build height %.2fmm (radius tapered above %.2fmm)"
             % (self.max_z, self.limit_z))
@@ -102,9 +103,14 @@ class RotaryDeltaKinematics:
     def check_move(self, move):
         end_pos = move.end_pos
         end_xy2 = end_pos[0]**2 + end_pos[1]**2
-        if end_xy2 <= self.limit_xy2 and not move.axes_d[2]:
-            # Normal XY move
-            return
+        if end_xy2 <= self.limit_xy2:
+            if not move.axes_d[2]:
+                # Normal XY move
+                return
+            if self.min_z <= end_pos[2] <= self.untapered_max_z:
+                # Z move below the tapered part of the build envelope
+                move.limit_speed(self.max_z_velocity, move.accel)
+                return
         if self.need_home:
             raise move.move_error("Must home first")
         end_z = end_pos[2]
@@ -150,6 +156,13 @@ class RotaryDeltaCalibration:
         self.abs_endstops = [
             self.ffi_lib.itersolve_calc_position_from_coord(sk, 0., 0., es)
             for sk, es in zip(self.sks, endstops)]
+    def __getstate__(self):
+        # The C stepper objects can not be pickled - rebuild them instead
+        return (self.shoulder_radius, self.shoulder_height, self.angles,
+                self.upper_arms, self.lower_arms, self.endstops,
+                self.stepdists)
+    def __setstate__(self, state):
+        self.__init__(*state)
     def coordinate_descent_params(self, is_extended):
         # Determine adjustment parameters (for use with coordinate_descent)
         adj_params = ('shoulder_height', 'endstop_a', 'endstop_b', 'endstop_c')
@@ -3,8 +3,7 @@
 # Copyright (C) 2018-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, multiprocessing, traceback
-import queuelogger
+import math, logging, functools
 
 
 ######################################################################
@@ -48,38 +47,106 @@ def coordinate_descent(adj_params, params, error_func):
     return params
 
 # Helper to run the coordinate descent function in a background
-# process so that it does not block the main thread.
+# process so that it does not block the main thread.  The error_func
+# must be picklable (eg, a module level function or functools.partial)
 def background_coordinate_descent(printer, adj_params, params, error_func):
-    parent_conn, child_conn = multiprocessing.Pipe()
-    def wrapper():
-        queuelogger.clear_bg_logging()
-        try:
-            res = coordinate_descent(adj_params, params, error_func)
-        except:
-            child_conn.send((True, traceback.format_exc()))
-            child_conn.close()
-            return
-        child_conn.send((False, res))
-        child_conn.close()
-    # Start a process to perform the calculation
-    calc_proc = multiprocessing.Process(target=wrapper)
-    calc_proc.daemon = True
-    calc_proc.start()
-    # Wait for the process to finish
-    reactor = printer.get_reactor()
-    gcode = printer.lookup_object("gcode")
-    eventtime = last_report_time = reactor.monotonic()
-    while calc_proc.is_alive():
-        if eventtime > last_report_time + 5.:
-            last_report_time = eventtime
-            gcode.respond_info("Working on calibration...", log=False)
-        eventtime = reactor.pause(eventtime + .1)
-    # Return results
-    is_err, res = parent_conn.recv()
+    calc_workers = printer.lookup_object('calc_workers')
+    is_err, res = calc_workers.run(
+        coordinate_descent, (adj_params, params, error_func),
+        "Working on calibration...")
     if is_err:
         raise Exception("Error in coordinate descent: %s" % (res,))
-    calc_proc.join()
-    parent_conn.close()
+    return res
+
+
+######################################################################
+# Least squares
+######################################################################
+
+def _sum_squares(residual_func, params):
+    residuals = residual_func(params)
+    if residuals is None:
+        return 9999999999999.9
+    return sum([r**2 for r in residuals])
+
+# Helper code that minimizes the sum of squares of the residuals
+# returned by residual_func using the Levenberg-Marquardt algorithm.
+# The residual_func should return None if the params are not valid.
+# Falls back to coordinate descent if numpy is not available.
+def least_squares(adj_params, params, residual_func):
+    error_func = functools.partial(_sum_squares, residual_func)
+    try:
+        import numpy as np
+    except ImportError:
+        logging.info("Least squares using coordinate descent (no numpy)")
+        return coordinate_descent(adj_params, params, error_func)
+    params = dict(params)
+    def calc_residuals(x):
+        for param_name, val in zip(adj_params, x):
+            params[param_name] = float(val)
+        residuals = residual_func(params)
+        if residuals is None:
+            return None
+        return np.array(residuals, dtype=float)
+    x = np.array([params[param_name] for param_name in adj_params],
+                 dtype=float)
+    r = calc_residuals(x)
+    if r is None:
+        return coordinate_descent(adj_params, params, error_func)
+    best_err = r.dot(r)
+    logging.info("Least squares initial error: %s", best_err)
+    damping = .001
+    rounds = 0
+    while rounds < 100:
+        rounds += 1
+        # Numerically estimate the jacobian of the residuals
+        jac = np.zeros((len(r), len(x)))
+        for i in range(len(x)):
+            step = 0.000001 * max(1., abs(x[i]))
+            for delta in [step, -step]:
+                test_x = x.copy()
+                test_x[i] += delta
+                test_r = calc_residuals(test_x)
+                if test_r is not None:
+                    jac[:,i] = (test_r - r) / delta
+                    break
+        jtj = jac.T.dot(jac)
+        grad = jac.T.dot(r)
+        scale = np.diag(np.maximum(np.diag(jtj), 1e-12))
+        # Find a damping factor that reduces the error
+        while damping < 1e10:
+            try:
+                dx = np.linalg.solve(jtj + damping * scale, -grad)
+            except np.linalg.LinAlgError:
+                damping *= 10.
+                continue
+            new_r = calc_residuals(x + dx)
+            if new_r is not None and new_r.dot(new_r) < best_err:
+                break
+            damping *= 10.
+        else:
+            break
+        x += dx
+        r = new_r
+        err, best_err = best_err, r.dot(r)
+        damping = max(damping * .1, 1e-12)
+        if (err - best_err <= 1e-12 * err
+                or np.all(np.abs(dx) <= 1e-10 * (np.abs(x) + 1e-10))):
+            break
+    calc_residuals(x)
+    logging.info("Least squares best_err: %s  rounds: %d", best_err, rounds)
+    return params
+
+# Helper to run the least squares function in a background process so
+# that it does not block the main thread.  The residual_func must be
+# picklable (eg, a module level function or functools.partial)
+def background_least_squares(printer, adj_params, params, residual_func):
+    calc_workers = printer.lookup_object('calc_workers')
+    is_err, res = calc_workers.run(
+        least_squares, (adj_params, params, residual_func),
+        "Working on calibration...")
+    if is_err:
+        raise Exception("Error in least squares: %s" % (res,))
     return res
 
 
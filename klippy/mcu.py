@@ -961,6 +961,17 @@ class MCU:
                      self._name, eventtime)
         self._printer.invoke_shutdown("Lost communication with MCU '%s'" % (
             self._name,))
+    def estimated_sync_uncertainty(self):
+        return self._clocksync.get_sync_uncertainty()
+    def estimated_link_latency(self):
+        # Estimate the delay of a newly queued message (from last stats)
+        last_stats = self._get_status_info.get('last_stats')
+        if last_stats is None:
+            return 0.
+        latency = last_stats['srtt'] + 4. * last_stats['rttvar']
+        if self._baud:
+            latency += last_stats['ready_bytes'] * 10. / self._baud
+        return latency
     def get_status(self, eventtime=None):
         return dict(self._get_status_info)
     def stats(self, eventtime):
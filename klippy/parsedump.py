@@ -4,7 +4,7 @@
 # Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging
+import os, sys, optparse, logging, array, collections
 import msgproto
 
 def read_dictionary(filename):
@@ -13,14 +13,222 @@ def read_dictionary(filename):
     dfile.close()
     return dictionary
 
-def main():
-    dict_filename, data_filename = sys.argv[1:]
+def read_dump(filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    return bytearray(data)
 
-    dictionary = read_dictionary(dict_filename)
 
-    mp = msgproto.MessageParser()
-    mp.process_identify(dictionary, decompress=False)
+######################################################################
+# Bulk decoding
+######################################################################
 
+# Decode the messages in a data dump without creating a dict and
+# string for each message
+class DumpDecoder:
+    def __init__(self, mp):
+        self.mp = mp
+        self.block_count = self.invalid_bytes = 0
+        self.data_pos = 0
+        # Build the parameter decoding info for each message id
+        self.decoders = {}
+        for msgid, mid in mp.messages_by_id.items():
+            names, ptypes = [], []
+            for name, t in mid.param_names:
+                t = getattr(t, 'pt', t) # Store enumerations as integers
+                names.append(name)
+                ptypes.append((t.is_int, t.signed if t.is_int else False))
+            oid_index = names.index('oid') if 'oid' in names else None
+            self.decoders[msgid] = (mid.name, names, ptypes, oid_index)
+    # Generate (msgid, oid, params, size) for each message in the data.
+    # The oid is removed from the params list and the size of the first
+    # message of a block includes the block header and trailer.  On
+    # return, data_pos is the position of the first unprocessed byte
+    # (a partial block at the end of the data is not processed).
+    def iter_messages(self, data, check_crc=False):
+        decoders = self.decoders
+        sync = bytearray([msgproto.MESSAGE_SYNC])
+        pos = self.data_pos = 0
+        end = len(data)
+        while pos + msgproto.MESSAGE_MIN <= end:
+            msglen = data[pos]
+            if (msglen >= msgproto.MESSAGE_MIN
+                and msglen <= msgproto.MESSAGE_MAX and pos + msglen > end):
+                break
+            if (msglen < msgproto.MESSAGE_MIN or msglen > msgproto.MESSAGE_MAX
+                or data[pos+msglen-1] != msgproto.MESSAGE_SYNC
+                or (check_crc and self.mp.check_packet(
+                    data[pos:pos+msglen]) <= 0)):
+                # Skip to the next sync byte
+                nextpos = data.find(sync, pos) + 1
+                if not nextpos:
+                    nextpos = end
+                self.invalid_bytes += nextpos - pos
+                pos = self.data_pos = nextpos
+                continue
+            self.block_count += 1
+            mpos = pos + msgproto.MESSAGE_HEADER_SIZE
+            mend = pos + msglen - msgproto.MESSAGE_TRAILER_SIZE
+            framing = msglen - (mend - mpos)
+            pos = self.data_pos = pos + msglen
+            while mpos < mend:
+                mstart = mpos
+                msgid = data[mpos]
+                mpos += 1
+                decoder = decoders.get(msgid)
+                if decoder is None:
+                    # Unknown message - remainder of block can't be parsed
+                    self.invalid_bytes += mend - mpos + 1
+                    break
+                vals = []
+                for is_int, signed in decoder[2]:
+                    if not is_int:
+                        l = data[mpos]
+                        vals.append(bytes(data[mpos+1:mpos+l+1]))
+                        mpos += l + 1
+                        continue
+                    c = data[mpos]
+                    mpos += 1
+                    v = c & 0x7f
+                    if (c & 0x60) == 0x60:
+                        v |= -0x20
+                    while c & 0x80:
+                        c = data[mpos]
+                        mpos += 1
+                        v = (v<<7) | (c & 0x7f)
+                    if not signed:
+                        v &= 0xffffffff
+                    vals.append(v)
+                oid_index = decoder[3]
+                oid = None
+                if oid_index is not None:
+                    oid = vals.pop(oid_index)
+                yield msgid, oid, vals, mpos - mstart + framing
+                framing = 0
+    # Generate the messages of a data dump file (read in chunks)
+    def iter_file(self, f, check_crc=False, chunk_size=1024*1024):
+        data = bytearray()
+        while 1:
+            newdata = f.read(chunk_size)
+            if not newdata:
+                break
+            data += bytearray(newdata)
+            for msg in self.iter_messages(data, check_crc):
+                yield msg
+            del data[:self.data_pos]
+        self.invalid_bytes += len(data)
+
+# Decode a data dump into arrays of parameters (one set per command
+# and oid).
+class DumpArrays(DumpDecoder):
+    def __init__(self, mp):
+        DumpDecoder.__init__(self, mp)
+        self.columns = {}
+        self.counts = {}
+        self.message_count = 0
+    def _get_appenders(self, msgid, oid):
+        name, names, ptypes, oid_index = self.decoders[msgid]
+        key = (name, oid)
+        cols = self.columns.get(key)
+        if cols is None:
+            cols = collections.OrderedDict()
+            for i, (pname, (is_int, signed)) in enumerate(zip(names, ptypes)):
+                if i == oid_index:
+                    continue
+                if is_int:
+                    cols[pname] = array.array('l' if signed else 'L')
+                else:
+                    cols[pname] = []
+            self.columns[key] = cols
+        return [c.append for c in cols.values()]
+    def decode(self, data, check_crc=False):
+        data = bytearray(data)
+        appenders = {}
+        counts = {}
+        mcount = 0
+        for msgid, oid, vals, size in self.iter_messages(data, check_crc):
+            mcount += 1
+            akey = (msgid, oid)
+            funcs = appenders.get(akey)
+            if funcs is None:
+                funcs = appenders[akey] = self._get_appenders(msgid, oid)
+                counts[akey] = 0
+            counts[akey] += 1
+            for func, v in zip(funcs, vals):
+                func(v)
+        # A partial block at the end of the data is invalid
+        pos = self.data_pos
+        self.invalid_bytes += len(data) - pos
+        for (msgid, oid), count in counts.items():
+            key = (self.decoders[msgid][0], oid)
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.message_count += mcount
+        return pos
+    def get_keys(self):
+        return sorted(self.columns, key=lambda k: (k[0], k[1] is not None,
+                                                   k[1]))
+    def get_columns(self, name, oid=None):
+        return self.columns.get((name, oid), {})
+    def get_count(self, name, oid=None):
+        return self.counts.get((name, oid), 0)
+
+def decode_file(mp, filename, check_crc=False):
+    da = DumpArrays(mp)
+    da.decode(read_dump(filename), check_crc)
+    return da
+
+def format_key(key):
+    name, oid = key
+    if oid is None:
+        return name
+    return "%s oid=%d" % (name, oid)
+
+# Report the differences between two decoded dumps
+def compare_dumps(da1, da2):
+    out = []
+    keys = set(da1.columns) | set(da2.columns)
+    for key in sorted(keys, key=lambda k: (k[0], k[1] is not None, k[1])):
+        cols1 = da1.columns.get(key)
+        cols2 = da2.columns.get(key)
+        if cols1 is None or cols2 is None:
+            count = da1.get_count(*key) + da2.get_count(*key)
+            out.append("%s: only in %s (%d messages)" % (
+                format_key(key), "first" if cols2 is None else "second",
+                count))
+            continue
+        for pname, col1 in cols1.items():
+            col2 = cols2[pname]
+            if col1 == col2:
+                continue
+            for i in range(min(len(col1), len(col2))):
+                if col1[i] != col2[i]:
+                    out.append("%s: %s differs at message %d (%s vs %s)" % (
+                        format_key(key), pname, i, col1[i], col2[i]))
+                    break
+        count1, count2 = da1.get_count(*key), da2.get_count(*key)
+        if count1 != count2:
+            out.append("%s: %d messages vs %d messages" % (
+                format_key(key), count1, count2))
+    return out
+
+def summarize(da):
+    out = ["%d messages in %d blocks (%d invalid bytes)" % (
+        da.message_count, da.block_count, da.invalid_bytes)]
+    for key in da.get_keys():
+        line = "%s: %d" % (format_key(key), da.get_count(*key))
+        cols = da.columns[key]
+        if key[0] == 'queue_step':
+            line += " (%d steps)" % (sum(cols['count']),)
+        out.append(line)
+    return out
+
+
+######################################################################
+# Startup
+######################################################################
+
+def dump_messages(mp, data_filename):
     f = open(data_filename, 'rb')
     fd = f.fileno()
     data = bytearray()
@@ -41,5 +249,39 @@ def main():
             sys.stdout.write('\n'.join(msgs[1:]) + '\n')
             data = data[l:]
 
+def main():
+    usage = "%prog [options] <data dictionary> <dump file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--summary", action="store_true", dest="summary",
+                    help="report message counts per command and oid")
+    opts.add_option("-c", "--compare", type="string", dest="compare",
+                    help="compare the message parameters with another dump")
+    opts.add_option("--crc", action="store_true", dest="check_crc",
+                    help="verify block crcs in summary/compare mode")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    dict_filename, data_filename = args
+
+    dictionary = read_dictionary(dict_filename)
+
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+
+    if options.compare:
+        da1 = decode_file(mp, data_filename, options.check_crc)
+        da2 = decode_file(mp, options.compare, options.check_crc)
+        diffs = compare_dumps(da1, da2)
+        if diffs:
+            sys.stdout.write('\n'.join(diffs) + '\n')
+            sys.exit(1)
+        sys.stdout.write("No differences (%d messages)\n" % (
+            da1.message_count,))
+    elif options.summary:
+        da = decode_file(mp, data_filename, options.check_crc)
+        sys.stdout.write('\n'.join(summarize(da)) + '\n')
+    else:
+        dump_messages(mp, data_filename)
+
 if __name__ == '__main__':
     main()
@@ -114,10 +114,11 @@ class MoveQueue:
     def __init__(self, toolhead):
         self.toolhead = toolhead
         self.queue = []
+        self.lookahead_flush_time = LOOKAHEAD_FLUSH_TIME
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def reset(self):
         del self.queue[:]
-        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.junction_flush = self.lookahead_flush_time
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
     def get_last(self):
@@ -125,7 +126,7 @@ class MoveQueue:
             return self.queue[-1]
         return None
     def flush(self, lazy=False):
-        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.junction_flush = self.lookahead_flush_time
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
@@ -192,9 +193,40 @@ SDS_CHECK_TIME = 0.001 # step+dir+step filter in stepcompress.c
 
 DRIP_SEGMENT_TIME = 0.050
 DRIP_TIME = 0.100
+LOW_LATENCY_MARGIN = 0.020
 class DripModeEndSignal(Exception):
     pass
 
+ADAPTIVE_REFERENCE_LATENCY = 0.025
+ADAPTIVE_DECAY = 1. / 30.
+
+# Track host latency and derive a scale for the host buffering windows
+class BufferTimeTuner:
+    def __init__(self, config):
+        self.enabled = config.getboolean('adaptive_buffer_time', False)
+        self.min_scale = config.getfloat('buffer_time_min_scale', 0.5,
+                                         above=0., maxval=1.)
+        self.max_scale = config.getfloat('buffer_time_max_scale', 2.,
+                                         minval=1.)
+        self.host_latency = ADAPTIVE_REFERENCE_LATENCY
+        self.peak_latency = 0.
+        self.scale = 1.
+    def note_latency(self, latency):
+        self.peak_latency = max(self.peak_latency, latency)
+    def update_scale(self):
+        # Invoked once per second with the peak latency of that period
+        latency = self.peak_latency
+        self.peak_latency = 0.
+        if latency >= self.host_latency:
+            # Latency spikes take effect immediately
+            self.host_latency = latency
+        else:
+            # Lower latencies are only trusted after a sustained period
+            self.host_latency += (latency - self.host_latency) * ADAPTIVE_DECAY
+        scale = self.host_latency / ADAPTIVE_REFERENCE_LATENCY
+        self.scale = max(self.min_scale, min(self.max_scale, scale))
+        return self.scale
+
 # Main code to track events (and their timing) on the printer toolhead
 class ToolHead:
     def __init__(self, config):
@@ -229,6 +261,13 @@ class ToolHead:
             'buffer_time_start', 0.250, above=0.)
         self.move_flush_time = config.getfloat(
             'move_flush_time', 0.050, above=0.)
+        self.config_buffer_times = (self.buffer_time_low, self.buffer_time_high,
+                                    self.buffer_time_start)
+        self.buffer_tuner = BufferTimeTuner(config)
+        # Host timing is not meaningful in batch mode
+        self.track_host_latency = self.buffer_tuner.enabled and self.can_pause
+        self.flush_waketime = 0.
+        self.low_latency_moves = config.getboolean('low_latency_moves', False)
         self.print_time = 0.
         self.special_queuing_state = "Flushed"
         self.need_check_stall = -1.
@@ -237,9 +276,14 @@ class ToolHead:
         self.idle_flush_print_time = 0.
         self.print_stall = 0
         self.drip_completion = None
+        self.drip_time, self.drip_segment_time = DRIP_TIME, DRIP_SEGMENT_TIME
         # Kinematic step generation scan window time tracking
-        self.kin_flush_delay = SDS_CHECK_TIME
+        self.kin_flush_delay = self.base_flush_delay = SDS_CHECK_TIME
         self.kin_flush_times = []
+        self.stepper_flush_times = {}
+        self.step_gen_windows = []
+        self.stepper_flush_delays = []
+        self.mcu_flush_delays = [(m, SDS_CHECK_TIME) for m in self.all_mcus]
         self.force_flush_time = self.last_kin_move_time = 0.
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
@@ -270,6 +314,10 @@ class ToolHead:
                                self.cmd_SET_VELOCITY_LIMIT,
                                desc=self.cmd_SET_VELOCITY_LIMIT_help)
         gcode.register_command('M204', self.cmd_M204)
+        if self.buffer_tuner.enabled:
+            gcode.register_command('TUNE_BUFFER_TIME',
+                                   self.cmd_TUNE_BUFFER_TIME,
+                                   desc=self.cmd_TUNE_BUFFER_TIME_help)
         # Load some default modules
         modules = ["gcode_move", "homing", "idle_timeout", "statistics",
                    "manual_probe", "tuning_tower"]
@@ -278,27 +326,58 @@ class ToolHead:
     # Print time tracking
     def _update_move_time(self, next_print_time):
         batch_time = MOVE_BATCH_TIME
-        kin_flush_delay = self.kin_flush_delay
         fft = self.force_flush_time
+        # Motion queues only need to retain history for their own steppers
+        kin_delay = ext_delay = self.base_flush_delay
+        for stepper, delay in self.stepper_flush_delays:
+            if stepper.get_trapq() == self.trapq:
+                kin_delay = max(kin_delay, delay)
+            else:
+                ext_delay = max(ext_delay, delay)
+        tuner = self.buffer_tuner
+        track_latency = self.track_host_latency
         while 1:
             self.print_time = min(self.print_time + batch_time, next_print_time)
-            sg_flush_time = max(fft, self.print_time - kin_flush_delay)
-            for sg in self.step_generators:
-                sg(sg_flush_time)
-            free_time = max(fft, sg_flush_time - kin_flush_delay)
+            print_time = self.print_time
+            if track_latency:
+                start_time = self.reactor.monotonic()
+            for sg, delay in self.step_gen_windows:
+                sg(max(fft, print_time - delay))
+            free_time = max(fft, print_time - kin_delay - kin_delay)
             self.trapq_finalize_moves(self.trapq, free_time)
+            free_time = max(fft, print_time - ext_delay - ext_delay)
             self.extruder.update_move_time(free_time)
-            mcu_flush_time = max(fft, sg_flush_time - self.move_flush_time)
-            for m in self.all_mcus:
-                m.flush_moves(mcu_flush_time)
+            for m, delay in self.mcu_flush_delays:
+                m.flush_moves(max(fft, print_time - delay
+                                  - self.move_flush_time))
+            if track_latency:
+                # Step generation blocks the reactor for its full duration
+                tuner.note_latency(self.reactor.monotonic() - start_time)
             if self.print_time >= next_print_time:
                 break
-    def _calc_print_time(self):
+    def _update_buffer_times(self):
+        scale = self.buffer_tuner.update_scale()
+        low, high, start = self.config_buffer_times
+        self.buffer_time_low = low * scale
+        self.buffer_time_high = high * scale
+        self.buffer_time_start = start * scale
+        self.move_queue.lookahead_flush_time = LOOKAHEAD_FLUSH_TIME * scale
+    def _calc_low_latency_time(self):
+        # Minimum time needed to reliably schedule an action on all mcus
+        mcu_latency = max([m.estimated_sync_uncertainty()
+                           + m.estimated_link_latency()
+                           for m in self.all_mcus])
+        return min(LOW_LATENCY_MARGIN + mcu_latency, self.buffer_time_start)
+    def _calc_print_time(self, interactive=False):
         curtime = self.reactor.monotonic()
         est_print_time = self.mcu.estimated_print_time(curtime)
-        kin_time = max(est_print_time + MIN_KIN_TIME, self.force_flush_time)
+        min_kin_time, start_time = MIN_KIN_TIME, self.buffer_time_start
+        if interactive and self.low_latency_moves:
+            # Schedule interactive actions as soon as the mcus allow
+            min_kin_time = start_time = self._calc_low_latency_time()
+        kin_time = max(est_print_time + min_kin_time, self.force_flush_time)
         kin_time += self.kin_flush_delay
-        min_print_time = max(est_print_time + self.buffer_time_start, kin_time)
+        min_print_time = max(est_print_time + start_time, kin_time)
         if min_print_time > self.print_time:
             self.print_time = min_print_time
             self.printer.send_event("toolhead:sync_print_time",
@@ -306,12 +385,14 @@ class ToolHead:
     def _process_moves(self, moves):
         # Resync print_time if necessary
         if self.special_queuing_state:
-            if self.special_queuing_state != "Drip":
+            interactive = self.special_queuing_state in ("Drip", "Jog")
+            if not interactive:
                 # Transition from "Flushed"/"Priming" state to main state
                 self.special_queuing_state = ""
                 self.need_check_stall = -1.
+                self.flush_waketime = 0.
                 self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
-            self._calc_print_time()
+            self._calc_print_time(interactive)
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
         for move in moves:
@@ -329,7 +410,7 @@ class ToolHead:
             for cb in move.timing_callbacks:
                 cb(next_move_time)
         # Generate steps for moves
-        if self.special_queuing_state:
+        if self.special_queuing_state == "Drip":
             self._update_drip_move_time(next_move_time)
         self._update_move_time(next_move_time)
         self.last_kin_move_time = max(self.last_kin_move_time, next_move_time)
@@ -358,7 +439,7 @@ class ToolHead:
     def get_last_move_time(self):
         self._flush_lookahead()
         if self.special_queuing_state:
-            self._calc_print_time()
+            self._calc_print_time(self.special_queuing_state != "Priming")
         return self.print_time
     def _check_stall(self):
         eventtime = self.reactor.monotonic()
@@ -372,7 +453,8 @@ class ToolHead:
             # Transition from "Flushed"/"Priming" state to "Priming" state
             self.special_queuing_state = "Priming"
             self.need_check_stall = -1.
-            self.reactor.update_timer(self.flush_timer, eventtime + 0.100)
+            self.flush_waketime = eventtime + 0.100
+            self.reactor.update_timer(self.flush_timer, self.flush_waketime)
         # Check if there are lots of queued moves and stall if so
         while 1:
             est_print_time = self.mcu.estimated_print_time(eventtime)
@@ -390,11 +472,18 @@ class ToolHead:
                                      + 0.100)
     def _flush_handler(self, eventtime):
         try:
+            if self.track_host_latency and self.flush_waketime:
+                # Measure how late the reactor ran this timer
+                self.buffer_tuner.note_latency(
+                    self.reactor.monotonic() - self.flush_waketime)
+            self.flush_waketime = 0.
             print_time = self.print_time
             buffer_time = print_time - self.mcu.estimated_print_time(eventtime)
             if buffer_time > self.buffer_time_low:
                 # Running normally - reschedule check
-                return eventtime + buffer_time - self.buffer_time_low
+                self.flush_waketime = (eventtime + buffer_time
+                                       - self.buffer_time_low)
+                return self.flush_waketime
             # Under ran low buffer mark - flush lookahead queue
             self.flush_step_generation()
             if print_time != self.print_time:
@@ -431,8 +520,21 @@ class ToolHead:
         for i in range(len(coord)):
             if coord[i] is not None:
                 curpos[i] = coord[i]
-        self.move(curpos, speed)
+        if self.low_latency_moves and self.special_queuing_state == "Flushed":
+            self._jog_move(curpos, speed)
+        else:
+            self.move(curpos, speed)
         self.printer.send_event("toolhead:manual_move")
+    def _jog_move(self, newpos, speed):
+        # Transition from "Flushed" state to "Jog" state
+        self.special_queuing_state = "Jog"
+        self.need_check_stall = self.reactor.NEVER
+        # Submit move and transmit it without waiting for lookahead
+        try:
+            self.move(newpos, speed)
+        finally:
+            # Exit "Jog" state
+            self.flush_step_generation()
     def dwell(self, delay):
         next_print_time = self.get_last_move_time() + max(0., delay)
         self._update_move_time(next_print_time)
@@ -452,7 +554,8 @@ class ToolHead:
         return self.extruder
     # Homing "drip move" handling
     def _update_drip_move_time(self, next_print_time):
-        flush_delay = DRIP_TIME + self.move_flush_time + self.kin_flush_delay
+        flush_delay = (self.drip_time + self.move_flush_time
+                       + self.kin_flush_delay)
         while self.print_time < next_print_time:
             if self.drip_completion.test():
                 raise DripModeEndSignal()
@@ -463,7 +566,8 @@ class ToolHead:
                 # Pause before sending more steps
                 self.drip_completion.wait(curtime + wait_time)
                 continue
-            npt = min(self.print_time + DRIP_SEGMENT_TIME, next_print_time)
+            npt = min(self.print_time + self.drip_segment_time,
+                      next_print_time)
             self._update_move_time(npt)
     def drip_move(self, newpos, speed, drip_completion):
         self.dwell(self.kin_flush_delay)
@@ -475,6 +579,12 @@ class ToolHead:
         self.move_queue.set_flush_time(self.buffer_time_high)
         self.idle_flush_print_time = 0.
         self.drip_completion = drip_completion
+        self.drip_time, self.drip_segment_time = DRIP_TIME, DRIP_SEGMENT_TIME
+        if self.low_latency_moves:
+            # Only buffer as far ahead as the mcu links require
+            self.drip_time = min(DRIP_TIME, self._calc_low_latency_time())
+            self.drip_segment_time = min(DRIP_SEGMENT_TIME,
+                                         .5 * self.drip_time)
         # Submit move
         try:
             self.move(newpos, speed)
@@ -497,8 +607,18 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.special_queuing_state
         if self.special_queuing_state == "Drip":
             buffer_time = 0.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
+        msg = "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
             self.print_time, max(buffer_time, 0.), self.print_stall)
+        tuner = self.buffer_tuner
+        if self.track_host_latency:
+            # Queued mcu messages delay newly flushed steps
+            link_latency = max([m.estimated_link_latency()
+                                for m in self.all_mcus])
+            tuner.note_latency(link_latency)
+            self._update_buffer_times()
+            msg += " host_latency=%.3f buffer_scale=%.3f" % (
+                tuner.host_latency, tuner.scale)
+        return is_active, msg
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -515,7 +635,11 @@ class ToolHead:
                      'max_velocity': self.max_velocity,
                      'max_accel': self.max_accel,
                      'max_accel_to_decel': self.requested_accel_to_decel,
-                     'square_corner_velocity': self.square_corner_velocity})
+                     'square_corner_velocity': self.square_corner_velocity,
+                     'buffer_time_low': self.buffer_time_low,
+                     'buffer_time_high': self.buffer_time_high,
+                     'buffer_time_start': self.buffer_time_start,
+                     'host_latency': self.buffer_tuner.host_latency})
         return res
     def _handle_shutdown(self):
         self.can_pause = False
@@ -526,15 +650,45 @@ class ToolHead:
         return self.trapq
     def register_step_generator(self, handler):
         self.step_generators.append(handler)
-    def note_step_generation_scan_time(self, delay, old_delay=0.):
+        self._update_flush_delays()
+    def note_step_generation_scan_time(self, delay, old_delay=0.,
+                                       steppers=None):
         self.flush_step_generation()
-        cur_delay = self.kin_flush_delay
-        if old_delay:
-            self.kin_flush_times.pop(self.kin_flush_times.index(old_delay))
-        if delay:
-            self.kin_flush_times.append(delay)
-        new_delay = max(self.kin_flush_times + [SDS_CHECK_TIME])
-        self.kin_flush_delay = new_delay
+        if steppers is None:
+            # Scan window applies to all steppers
+            flush_times = [self.kin_flush_times]
+        else:
+            flush_times = [self.stepper_flush_times.setdefault(s, [])
+                           for s in steppers]
+        for times in flush_times:
+            if old_delay:
+                times.pop(times.index(old_delay))
+            if delay:
+                times.append(delay)
+        self._update_flush_delays()
+    def _update_flush_delays(self):
+        base_delay = max(self.kin_flush_times + [SDS_CHECK_TIME])
+        stepper_delays = {}
+        for stepper, times in list(self.stepper_flush_times.items()):
+            if not times:
+                del self.stepper_flush_times[stepper]
+                continue
+            delay = max(times + [base_delay])
+            stepper_delays[stepper.generate_steps] = (stepper, delay)
+        # Determine the step generation window of each step generator
+        self.step_gen_windows = [
+            (sg, stepper_delays.get(sg, (None, base_delay))[1])
+            for sg in self.step_generators]
+        self.stepper_flush_delays = [(s, d) for s, d in stepper_delays.values()
+                                     if d > base_delay]
+        # Each mcu may only be flushed once all its steppers are generated
+        self.mcu_flush_delays = [
+            (m, max([base_delay] + [d for s, d in self.stepper_flush_delays
+                                    if s.get_mcu() is m]))
+            for m in self.all_mcus]
+        self.base_flush_delay = base_delay
+        self.kin_flush_delay = max([base_delay] + [
+            d for s, d in self.stepper_flush_delays])
     def register_lookahead_callback(self, callback):
         last_move = self.move_queue.get_last()
         if last_move is None:
@@ -587,6 +741,20 @@ class ToolHead:
             square_corner_velocity is None and
             requested_accel_to_decel is None):
             gcmd.respond_info(msg, log=False)
+    cmd_TUNE_BUFFER_TIME_help = (
+        "Apply a host latency sample to the adaptive buffering windows")
+    def cmd_TUNE_BUFFER_TIME(self, gcmd):
+        latency = gcmd.get_float('LATENCY', minval=0.)
+        periods = gcmd.get_int('PERIODS', 1, minval=1)
+        for i in range(periods):
+            self.buffer_tuner.note_latency(latency)
+            self._update_buffer_times()
+        gcmd.respond_info("host_latency=%.6f buffer_scale=%.3f"
+                          " buffer_time_low=%.3f buffer_time_high=%.3f"
+                          " buffer_time_start=%.3f" % (
+                              self.buffer_tuner.host_latency,
+                              self.buffer_tuner.scale, self.buffer_time_low,
+                              self.buffer_time_high, self.buffer_time_start))
     def cmd_M204(self, gcmd):
         # Use S for accel
         accel = gcmd.get_float('S', None, above=0.)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# Host performance benchmarks using klippy's batch (file output) mode
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, subprocess, tempfile, shutil, time, math, json
+import pstats
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+KLIPPY_DIR = "./klippy"
+OUTPUT_FILE = "_bench_output"
+GCODE_FILE = "_bench_.gcode"
+LOG_FILE = "_bench_.log"
+PROFILE_FILE = "_bench_.prof"
+BASELINE_VERSION = 1
+
+
+######################################################################
+# Workloads
+######################################################################
+
+def gen_header(extra=[]):
+    return ["G28", "G90", "M83"] + extra
+
+# Short extruding segments along a spiral (typical of sliced curves)
+def gen_dense_segments(scale, center=(100., 100.), zpos=1.):
+    out = gen_header(["G1 Z%.3f F6000" % (zpos,),
+                      "G1 X%.3f Y%.3f" % center])
+    lastx, lasty = center
+    count = int(20000 * scale)
+    for i in range(count):
+        angle = i * .02
+        radius = 10. + 60. * (i % 5000) / 5000.
+        x = center[0] + radius * math.cos(angle)
+        y = center[1] + radius * math.sin(angle)
+        dist = math.sqrt((x - lastx)**2 + (y - lasty)**2)
+        out.append("G1 X%.3f Y%.3f E%.5f" % (x, y, dist * .03))
+        lastx, lasty = x, y
+    return out, count
+
+# Full circles using G2/G3 arcs
+def gen_arcs(scale):
+    out = gen_header(["G1 Z1 F6000", "G1 X80 Y100"])
+    count = int(200 * scale)
+    for i in range(count):
+        radius = 5. + (i % 15)
+        cmd = "G2" if i % 2 else "G3"
+        out.append("G1 X%.3f Y100" % (100. - radius,))
+        out.append("%s X%.3f Y100 I%.3f J0 E%.5f" % (
+            cmd, 100. - radius, radius, 2. * math.pi * radius * .03))
+    return out, 2 * count
+
+# Long zig-zag moves that bed_mesh splits into segments
+def gen_mesh_moves(scale):
+    out = gen_header(["BED_MESH_CALIBRATE", "G1 Z5 F6000", "G1 X10 Y10"])
+    count = int(2000 * scale)
+    for i in range(count):
+        y = 10. + (i % 170)
+        x = 180. if i % 2 else 10.
+        out.append("G1 X%.3f Y%.3f E%.5f" % (x, y, 170. * .03))
+    return out, count
+
+# Dense segments with pressure advance enabled
+def gen_shaper_pa(scale):
+    out, count = gen_dense_segments(scale)
+    out[3:3] = ["SET_PRESSURE_ADVANCE ADVANCE=0.05 SMOOTH_TIME=0.04"]
+    return out, count
+
+# Moves within the reach of a delta printer
+def gen_delta(scale):
+    out, count = gen_dense_segments(scale, center=(0., 0.), zpos=10.)
+    return out, count
+
+# Moves with regular z hops (z steppers are on a second mcu)
+def gen_multi_mcu(scale):
+    out = gen_header(["G1 Z5 F6000", "G1 X125 Y125"])
+    count = int(5000 * scale)
+    for i in range(count):
+        angle = i * .05
+        radius = 20. + 80. * (i % 1000) / 1000.
+        out.append("G1 X%.3f Y%.3f E%.5f" % (
+            125. + radius * math.cos(angle), 125. + radius * math.sin(angle),
+            radius * .05 * .03))
+        if i % 100 == 99:
+            out.append("G1 Z5.4")
+            out.append("G1 Z5")
+    return out, count + 2 * (count // 100)
+
+# name: (config file, dictionaries, gcode generator)
+WORKLOADS = [
+    ("dense_g1", "config/example-cartesian.cfg", ["atmega2560.dict"],
+     gen_dense_segments),
+    ("arcs", "test/klippy/gcode_arcs.cfg", ["atmega2560.dict"], gen_arcs),
+    ("bed_mesh", "test/klippy/low_latency.cfg", ["atmega2560.dict"],
+     gen_mesh_moves),
+    ("shaper_pa", "test/klippy/input_shaper.cfg", ["atmega2560.dict"],
+     gen_shaper_pa),
+    ("delta", "config/example-delta.cfg", ["atmega2560.dict"], gen_delta),
+    ("multi_mcu", "config/kit-voron2-250mm.cfg",
+     ["atmega2560.dict", "z=atmega2560.dict"], gen_multi_mcu),
+]
+
+
+######################################################################
+# Running klippy
+######################################################################
+
+# Report which part of the host code a profiled function belongs to
+PHASES = [
+    ("gcode", ["gcode.py", "gcode_move.py", "gcode_arcs.py",
+               "gcode_macro.py"]),
+    ("planning", ["toolhead.py", "extruder.py", "bed_mesh.py",
+                  "input_shaper.py", "kinematics"]),
+    ("stepgen", ["stepper.py", "mcu.py", "chelper"]),
+    ("serial", ["serialhdl.py", "msgproto.py", "clocksync.py"]),
+    ("reactor", ["reactor.py", "greenlet"]),
+    ("startup", ["cffi", "pycparser", "importlib", "<frozen", "/re/",
+                 "sre_", "jinja2", "markupsafe", "builtins.compile",
+                 "marshal.loads"]),
+]
+
+def get_phase(filename, funcname):
+    desc = "%s:%s" % (filename, funcname)
+    for phase, names in PHASES:
+        for name in names:
+            if name in desc:
+                return phase
+    return "other"
+
+def summarize_profile(prof_fname):
+    # Sum the time spent in each function (excluding callees) by phase
+    stats = pstats.Stats(prof_fname).stats
+    phases = {}
+    for (filename, lineno, funcname), st in stats.items():
+        phase = get_phase(filename, funcname)
+        phases[phase] = phases.get(phase, 0.) + st[2]
+    return phases
+
+def count_steps(dict_fname, out_fname):
+    # Count the steps in the queue_step commands sent to an mcu
+    f = open(dict_fname, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    queue_step = mp.lookup_command("queue_step oid=%c interval=%u"
+                                   " count=%hu add=%hi")
+    queue_step_id = queue_step.msgid
+    f = open(out_fname, 'rb')
+    data = bytearray(f.read())
+    f.close()
+    steps = 0
+    while data:
+        l = mp.check_packet(data)
+        if l <= 0:
+            if not l:
+                break
+            data = data[-l:]
+            continue
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            msgid = data[pos]
+            mid = mp.messages_by_id.get(msgid, mp.unknown)
+            params, pos = mid.parse(data, pos)
+            if msgid == queue_step_id:
+                steps += params['count']
+        data = data[l:]
+    return steps
+
+class Benchmark:
+    def __init__(self, name, config_fname, dict_fnames, gcode_func, options):
+        self.name = name
+        self.config_fname = config_fname
+        self.dict_fnames = []
+        for df in dict_fnames:
+            if '=' in df:
+                mcu_name, df = df.split('=', 1)
+                df = '%s=%s' % (mcu_name, os.path.join(options.dictdir, df))
+            else:
+                df = os.path.join(options.dictdir, df)
+            self.dict_fnames.append(df)
+        self.gcode_func = gcode_func
+        self.options = options
+    def launch(self, rundir, gcode_fname, profile):
+        args = [sys.executable]
+        if profile:
+            args += ['-m', 'cProfile', '-o',
+                     os.path.join(rundir, PROFILE_FILE)]
+        args += [os.path.join(KLIPPY_DIR, 'klippy.py'), self.config_fname,
+                 '-i', gcode_fname, '-o', os.path.join(rundir, OUTPUT_FILE),
+                 '-l', os.path.join(rundir, LOG_FILE)]
+        for df in self.dict_fnames:
+            args += ['-d', df]
+        starttime = time.time()
+        # Use wait4() to obtain the resource usage of just this process
+        proc = subprocess.Popen(args)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        walltime = time.time() - starttime
+        proc.returncode = status
+        if status:
+            f = open(os.path.join(rundir, LOG_FILE), 'r')
+            sys.stdout.write(f.read())
+            f.close()
+            raise Exception("klippy failed on benchmark %s" % (self.name,))
+        return walltime, rusage
+    def run(self):
+        options = self.options
+        rundir = tempfile.mkdtemp(prefix="bench_klippy_", dir=options.tempdir)
+        try:
+            return self._run(rundir)
+        finally:
+            if not options.keepfiles:
+                shutil.rmtree(rundir, ignore_errors=True)
+    def _run(self, rundir):
+        options = self.options
+        gcode, moves = self.gcode_func(options.scale)
+        gcode_fname = os.path.join(rundir, GCODE_FILE)
+        f = open(gcode_fname, 'w')
+        f.write('\n'.join(gcode + ['']))
+        f.close()
+        # Timed runs (the fastest run is reported)
+        best = None
+        for i in range(options.repeat):
+            walltime, rusage = self.launch(rundir, gcode_fname, False)
+            cputime = rusage.ru_utime + rusage.ru_stime
+            if best is None or cputime < best[1]:
+                best = (walltime, cputime, rusage.ru_maxrss)
+        walltime, cputime, maxrss = best
+        # Count steps sent to each mcu
+        steps = 0
+        for df in self.dict_fnames:
+            suffix = ""
+            if '=' in df:
+                mcu_name, df = df.split('=', 1)
+                suffix = "-" + mcu_name
+            steps += count_steps(df, os.path.join(rundir,
+                                                  OUTPUT_FILE + suffix))
+        res = {'wall': walltime, 'cpu': cputime, 'maxrss': maxrss,
+               'moves': moves, 'steps': steps,
+               'moves_per_sec': moves / cputime,
+               'steps_per_sec': steps / cputime}
+        # Profiled run
+        if options.profile:
+            self.launch(rundir, gcode_fname, True)
+            res['phases'] = summarize_profile(
+                os.path.join(rundir, PROFILE_FILE))
+        return res
+
+
+######################################################################
+# Reporting
+######################################################################
+
+def report(name, res, base):
+    msg = ("%-10s wall=%7.3fs cpu=%7.3fs rss=%6dKiB moves/s=%9.0f"
+           " steps/s=%10.0f" % (name, res['wall'], res['cpu'], res['maxrss'],
+                                res['moves_per_sec'], res['steps_per_sec']))
+    if base is not None:
+        msg += " (%+.1f%% cpu)" % (100. * (res['cpu'] / base['cpu'] - 1.),)
+    sys.stdout.write(msg + "\n")
+    phases = res.get('phases')
+    if phases:
+        total = sum(phases.values())
+        parts = ["%s=%.1f%%" % (phase, 100. * phases[phase] / total)
+                 for phase in sorted(phases, key=phases.get, reverse=True)]
+        sys.stdout.write("%-10s profile: %s\n" % ("", " ".join(parts)))
+
+def check_regression(res, base, threshold):
+    if base is None:
+        return False
+    if base.get('moves') != res['moves']:
+        sys.stdout.write("    warning: workload differs from baseline"
+                         " (%s moves vs %s)\n" % (res['moves'],
+                                                   base.get('moves')))
+    return res['cpu'] > base['cpu'] * (1. + threshold)
+
+def load_baseline(fname):
+    f = open(fname, 'r')
+    data = json.load(f)
+    f.close()
+    if data.get('version') != BASELINE_VERSION:
+        raise Exception("Unsupported baseline file %s" % (fname,))
+    return data
+
+def save_baseline(fname, options, results):
+    data = {'version': BASELINE_VERSION, 'scale': options.scale,
+            'results': results}
+    f = open(fname, 'w')
+    json.dump(data, f, indent=2, sort_keys=True)
+    f.close()
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] [benchmark names]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictdir", dest="dictdir", default=".",
+                    help="directory for dictionary files")
+    opts.add_option("-t", "--tempdir", dest="tempdir", default=".",
+                    help="directory for temporary files")
+    opts.add_option("-k", action="store_true", dest="keepfiles",
+                    help="do not remove temporary files")
+    opts.add_option("-s", "--scale", dest="scale", type="float", default=1.,
+                    help="scale the size of each workload")
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="number of timed runs of each benchmark")
+    opts.add_option("-p", "--profile", action="store_true", dest="profile",
+                    help="report a per-phase profile of each benchmark")
+    opts.add_option("-b", "--baseline", dest="baseline",
+                    help="compare results against a stored baseline")
+    opts.add_option("-o", "--save-baseline", dest="save_baseline",
+                    help="store the results as a baseline")
+    opts.add_option("--threshold", dest="threshold", type="float",
+                    default=10.,
+                    help="percent cpu increase reported as a regression")
+    opts.add_option("-l", "--list", action="store_true", dest="listbench",
+                    help="list the available benchmarks")
+    options, args = opts.parse_args()
+    names = [w[0] for w in WORKLOADS]
+    if options.listbench:
+        sys.stdout.write("\n".join(names) + "\n")
+        return
+    for name in args:
+        if name not in names:
+            opts.error("Unknown benchmark '%s'" % (name,))
+    baseline = {}
+    if options.baseline:
+        bdata = load_baseline(options.baseline)
+        if bdata.get('scale') != options.scale:
+            opts.error("Baseline was recorded with scale %s" % (
+                bdata.get('scale'),))
+        baseline = bdata['results']
+
+    # Run each benchmark
+    results = {}
+    regressions = []
+    for name, config_fname, dict_fnames, gcode_func in WORKLOADS:
+        if args and name not in args:
+            continue
+        bench = Benchmark(name, config_fname, dict_fnames, gcode_func,
+                          options)
+        res = results[name] = bench.run()
+        base = baseline.get(name)
+        report(name, res, base)
+        if check_regression(res, base, options.threshold / 100.):
+            regressions.append(name)
+    if options.save_baseline:
+        save_baseline(options.save_baseline, options, results)
+    if regressions:
+        sys.stdout.write("\nPerformance regression in: %s\n" % (
+            " ".join(regressions),))
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
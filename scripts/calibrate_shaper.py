@@ -8,7 +8,8 @@
 from __future__ import print_function
 import importlib, optparse, os, sys
 from textwrap import wrap
-import numpy as np, matplotlib
+import numpy as np
+import psdcache
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
                              '..', 'klippy'))
 shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
@@ -16,6 +17,10 @@ shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
 MAX_TITLE_LENGTH=65
 
 def parse_log(logname):
+    with open(logname, 'rb') as f:
+        if f.read(6) == b'\x93NUMPY':
+            # Raw accelerometer data in binary format
+            return psdcache.load_npy(logname)
     with open(logname) as f:
         for header in f:
             if not header.startswith('#'):
@@ -35,22 +40,53 @@ def parse_log(logname):
         calibration_data.normalize_to_frequencies()
     return calibration_data
 
+# Calculate the frequency response of a capture (run in a worker
+# process).  Returns (calibration_data, info, best_shaper).
+def process_log(args):
+    logname, use_cache, max_smoothing, find_shaper = args
+    calibration_data, info = psdcache.get_capture_psd(
+            logname, parse_log, use_cache)
+    best_shaper = None
+    if find_shaper:
+        # Find the best shaper of this capture alone
+        data = psdcache.copy_calibration_data(calibration_data)
+        if info is not None:
+            data.normalize_to_frequencies()
+        helper = shaper_calibrate.ShaperCalibrate(printer=None)
+        best_shaper, all_shapers = helper.find_best_shaper(
+                data, max_smoothing, None)
+    return calibration_data, info, best_shaper
+
+def summarize(lognames, results):
+    header = ["capture", "samples", "rate", "peak_x", "peak_y", "shaper",
+              "freq", "vibrations", "smoothing", "max_accel"]
+    rows = []
+    for logname, (calibration_data, info, shaper) in zip(lognames, results):
+        samples = rate = "-"
+        if info is not None:
+            samples = "%d" % (info['samples'],)
+            rate = "%.0f" % (info['samples'] / info['duration'],)
+        rows.append([logname, samples, rate] + [
+            "%.1f" % (psdcache.get_peak_freq(calibration_data, axis,
+                                             shaper_calibrate.MAX_FREQ),)
+            for axis in 'xy'] + [
+            shaper.name, "%.1f" % (shaper.freq,),
+            "%.1f%%" % (shaper.vibrs * 100.,), "%.3f" % (shaper.smoothing,),
+            "%.0f" % (round(shaper.max_accel / 100.) * 100.,)])
+    return psdcache.format_table(header, rows)
+
 ######################################################################
 # Shaper calibration
 ######################################################################
 
 # Find the best shaper parameters
-def calibrate_shaper(datas, csv_output, max_smoothing):
+def calibrate_shaper(results, csv_output, max_smoothing):
     helper = shaper_calibrate.ShaperCalibrate(printer=None)
-    if isinstance(datas[0], shaper_calibrate.CalibrationData):
-        calibration_data = datas[0]
-        for data in datas[1:]:
-            calibration_data.add_data(data)
-    else:
-        # Process accelerometer data
-        calibration_data = helper.process_accelerometer_data(datas[0])
-        for data in datas[1:]:
-            calibration_data.add_data(helper.process_accelerometer_data(data))
+    calibration_data, info, best_shaper = results[0]
+    for data, data_info, data_best_shaper in results[1:]:
+        calibration_data.add_data(data)
+    if info is not None:
+        # Raw accelerometer data
         calibration_data.normalize_to_frequencies()
     shaper, all_shapers = helper.find_best_shaper(
             calibration_data, max_smoothing, print)
@@ -125,6 +161,7 @@ def plot_freq_response(lognames, calibration_data, shapers,
 
 def setup_matplotlib(output_to_file):
     global matplotlib
+    import matplotlib
     if output_to_file:
         matplotlib.rcParams.update({'figure.autolayout': True})
         matplotlib.use('Agg')
@@ -143,18 +180,35 @@ def main():
                     help="maximum frequency to graph")
     opts.add_option("-s", "--max_smoothing", type="float", default=None,
                     help="maximum shaper smoothing to allow")
+    opts.add_option("-j", "--jobs", type="int", dest="jobs",
+                    default=psdcache.get_default_jobs(),
+                    help="number of captures to process in parallel")
+    opts.add_option("--summary", action="store_true", dest="summary",
+                    help="report the best shaper of each capture (and skip"
+                    " the combined calibration unless -o or -c is given)")
+    opts.add_option("--no-cache", action="store_false", dest="use_cache",
+                    default=True, help="do not read or write the"
+                    " <capture>.psd.npz frequency response cache files")
     options, args = opts.parse_args()
     if len(args) < 1:
         opts.error("Incorrect number of arguments")
     if options.max_smoothing is not None and options.max_smoothing < 0.05:
         opts.error("Too small max_smoothing specified (must be at least 0.05)")
 
-    # Parse data
-    datas = [parse_log(fn) for fn in args]
+    # Parse data and calculate the frequency response of each capture
+    results = psdcache.run_parallel(process_log, [
+        (fn, options.use_cache, options.max_smoothing, options.summary)
+        for fn in args], options.jobs)
+    for calibration_data, info, best_shaper in results:
+        calibration_data.set_numpy(np)
+    if options.summary:
+        print("\n".join(summarize(args, results)))
+        if not options.csv and not options.output:
+            return
 
     # Calibrate shaper and generate outputs
     selected_shaper, shapers, calibration_data = calibrate_shaper(
-            datas, options.csv, options.max_smoothing)
+            results, options.csv, options.max_smoothing)
 
     if not options.csv or options.output:
         # Draw graph
@@ -7,14 +7,22 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import importlib, optparse, os, sys
 from textwrap import wrap
-import numpy as np, matplotlib
+import numpy as np
+import psdcache
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
                              '..', 'klippy'))
 shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
 
 MAX_TITLE_LENGTH=65
 
-def parse_log(logname, opts):
+class error(Exception):
+    pass
+
+def parse_log(logname):
+    with open(logname, 'rb') as f:
+        if f.read(6) == b'\x93NUMPY':
+            # Raw accelerometer data in binary format
+            return psdcache.load_npy(logname)
     with open(logname) as f:
         for header in f:
             if not header.startswith('#'):
@@ -23,9 +31,10 @@ def parse_log(logname, opts):
             # Raw accelerometer data
             return np.loadtxt(logname, comments='#', delimiter=',')
     # Power spectral density data or shaper calibration data
-    opts.error("File %s does not contain raw accelerometer data and therefore "
-               "is not supported by graph_accelerometer.py script. Please use "
-               "calibrate_shaper.py script to process it instead." % (logname,))
+    raise error("File %s does not contain raw accelerometer data and"
+                " therefore is not supported by graph_accelerometer.py"
+                " script. Please use calibrate_shaper.py script to process"
+                " it instead." % (logname,))
 
 ######################################################################
 # Raw accelerometer graphing
@@ -54,10 +63,10 @@ def plot_accel(data, logname):
 # Frequency graphing
 ######################################################################
 
-# Calculate estimated "power spectral density"
-def calc_freq_response(data, max_freq):
-    helper = shaper_calibrate.ShaperCalibrate(printer=None)
-    return helper.process_accelerometer_data(data)
+# Calculate estimated "power spectral density" (run in a worker process)
+def calc_freq_response(args):
+    logname, use_cache = args
+    return psdcache.get_capture_psd(logname, parse_log, use_cache)
 
 def calc_specgram(data, axis):
     N = data.shape[0]
@@ -79,10 +88,10 @@ def calc_specgram(data, axis):
             pdata += _specgram(d[ax])[0]
     return pdata, bins, t
 
-def plot_frequency(datas, lognames, max_freq):
-    calibration_data = calc_freq_response(datas[0], max_freq)
-    for data in datas[1:]:
-        calibration_data.add_data(calc_freq_response(data, max_freq))
+def plot_frequency(psds, lognames, max_freq):
+    calibration_data = psds[0]
+    for psd in psds[1:]:
+        calibration_data.add_data(psd)
     freqs = calibration_data.freq_bins
     psd = calibration_data.psd_sum[freqs <= max_freq]
     px = calibration_data.psd_x[freqs <= max_freq]
@@ -113,14 +122,13 @@ def plot_frequency(datas, lognames, max_freq):
     fig.tight_layout()
     return fig
 
-def plot_compare_frequency(datas, lognames, max_freq, axis):
+def plot_compare_frequency(psds, lognames, max_freq, axis):
     fig, ax = matplotlib.pyplot.subplots()
     ax.set_title('Frequency responses comparison')
     ax.set_xlabel('Frequency (Hz)')
     ax.set_ylabel('Power spectral density')
 
-    for data, logname in zip(datas, lognames):
-        calibration_data = calc_freq_response(data, max_freq)
+    for calibration_data, logname in zip(psds, lognames):
         freqs = calibration_data.freq_bins
         psd = calibration_data.get_psd(axis)[freqs <= max_freq]
         freqs = freqs[freqs <= max_freq]
@@ -154,13 +162,30 @@ def plot_specgram(data, logname, max_freq, axis):
 # CSV output
 ######################################################################
 
-def write_frequency_response(datas, output):
+def write_frequency_response(psds, output):
     helper = shaper_calibrate.ShaperCalibrate(printer=None)
-    calibration_data = helper.process_accelerometer_data(datas[0])
-    for data in datas[1:]:
-        calibration_data.add_data(helper.process_accelerometer_data(data))
+    calibration_data = psds[0]
+    for psd in psds[1:]:
+        calibration_data.add_data(psd)
     helper.save_calibration_data(output, calibration_data)
 
+######################################################################
+# Summary table
+######################################################################
+
+def summarize(lognames, results, max_freq):
+    header = ["capture", "samples", "rate", "duration", "peak_x", "peak_y",
+              "peak_z", "peak_all"]
+    rows = []
+    for logname, (calibration_data, info) in zip(lognames, results):
+        rows.append([logname, "%d" % (info['samples'],),
+                     "%.0f" % (info['samples'] / info['duration'],),
+                     "%.2f" % (info['duration'],)] + [
+            "%.1f" % (psdcache.get_peak_freq(calibration_data, axis,
+                                             max_freq),)
+            for axis in ['x', 'y', 'z', 'all']])
+    return psdcache.format_table(header, rows)
+
 def write_specgram(psd, freq_bins, time, output):
     M = freq_bins.shape[0]
     with open(output, "w") as csvfile:
@@ -183,6 +208,7 @@ def is_csv_output(output):
 
 def setup_matplotlib(output):
     global matplotlib
+    import matplotlib
     if is_csv_output(output):
         # Only mlab may be necessary with CSV output
         import matplotlib.mlab
@@ -210,14 +236,38 @@ def main():
                     help="graph spectrogram of accelerometer data")
     opts.add_option("-a", type="string", dest="axis", default="all",
                     help="axis to graph (one of 'all', 'x', 'y', or 'z')")
+    opts.add_option("-j", "--jobs", type="int", dest="jobs",
+                    default=psdcache.get_default_jobs(),
+                    help="number of captures to process in parallel")
+    opts.add_option("--summary", action="store_true", dest="summary",
+                    help="report the peak frequencies of each capture (and"
+                    " skip the graph unless -o is given)")
+    opts.add_option("--no-cache", action="store_false", dest="use_cache",
+                    default=True, help="do not read or write the"
+                    " <capture>.psd.npz frequency response cache files")
     options, args = opts.parse_args()
     if len(args) < 1:
         opts.error("Incorrect number of arguments")
+    if options.summary and (options.raw or options.specgram):
+        opts.error("summary is not supported in raw or specgram mode")
 
     # Parse data
-    datas = [parse_log(fn, opts) for fn in args]
-
-    setup_matplotlib(options.output)
+    try:
+        if options.raw or options.specgram:
+            datas = [parse_log(fn) for fn in args]
+        else:
+            results = psdcache.run_parallel(calc_freq_response, [
+                (fn, options.use_cache) for fn in args], options.jobs)
+            psds = [calibration_data for calibration_data, info in results]
+            for calibration_data in psds:
+                calibration_data.set_numpy(np)
+    except error as e:
+        opts.error(str(e))
+
+    if options.summary:
+        print("\n".join(summarize(args, results, options.max_freq)))
+        if not options.output:
+            return
 
     if is_csv_output(options.output):
         if options.raw:
@@ -227,13 +277,15 @@ def main():
         if options.specgram:
             if len(args) > 1:
                 opts.error("Only 1 input is supported in specgram mode")
+            setup_matplotlib(options.output)
             pdata, bins, t = calc_specgram(datas[0], options.axis)
             write_specgram(pdata, bins, t, options.output)
         else:
-            write_frequency_response(datas, options.output)
+            write_frequency_response(psds, options.output)
         return
 
     # Draw graph
+    setup_matplotlib(options.output)
     if options.raw:
         if len(args) > 1:
             opts.error("Only 1 input is supported in raw mode")
@@ -243,10 +295,10 @@ def main():
             opts.error("Only 1 input is supported in specgram mode")
         fig = plot_specgram(datas[0], args[0], options.max_freq, options.axis)
     elif options.compare:
-        fig = plot_compare_frequency(datas, args, options.max_freq,
+        fig = plot_compare_frequency(psds, args, options.max_freq,
                                      options.axis)
     else:
-        fig = plot_frequency(datas, args, options.max_freq)
+        fig = plot_frequency(psds, args, options.max_freq)
 
     # Show graph
     if options.output is None:
@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import optparse, datetime
+import logindex
 import matplotlib
 
 MAXBANDWIDTH=25000.
@@ -23,31 +24,24 @@ def parse_log(logname, mcu):
         mcu = "mcu"
     mcu_prefix = mcu + ":"
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
-    f = open(logname, 'r')
+    index = logindex.LogIndex(logname)
+    # Determine the output key for each stats field
+    keys = []
+    for prefix, name in index.get_stats_fields():
+        if prefix == mcu_prefix:
+            prefix = ''
+        if name in apply_prefix:
+            name = prefix + name
+        keys.append(name)
     out = []
-    for line in f:
-        parts = line.split()
-        if not parts or parts[0] not in ('Stats', 'INFO:root:Stats'):
-            #if parts and parts[0] == 'INFO:root:shutdown:':
-            #    break
-            continue
-        prefix = ""
+    for offset, sampletime, row in index.get_stats():
         keyparts = {}
-        for p in parts[2:]:
-            if '=' not in p:
-                prefix = p
-                if prefix == mcu_prefix:
-                    prefix = ''
-                continue
-            name, val = p.split('=', 1)
-            if name in apply_prefix:
-                name = prefix + name
-            keyparts[name] = val
+        for i in range(0, len(row), 2):
+            keyparts[keys[row[i]]] = row[i+1]
         if 'print_time' not in keyparts:
             continue
-        keyparts['#sampletime'] = float(parts[1][:-1])
+        keyparts['#sampletime'] = sampletime
         out.append(keyparts)
-    f.close()
     return out
 
 def setup_matplotlib(output_to_file):
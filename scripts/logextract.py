@@ -4,7 +4,8 @@
 # Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, re, collections, ast
+import sys, re, ast
+import logindex
 
 def format_comment(line_num, line):
     return "# %6d: %s" % (line_num, line)
@@ -575,33 +576,42 @@ def main():
     last_git = last_start = None
     configs = {}
     handler = None
-    recent_lines = collections.deque([], 200)
-    # Parse log file
-    f = open(logname, 'rb')
-    for line_num, line in enumerate(f):
-        line = line.rstrip()
-        line_num += 1
-        recent_lines.append((line_num, line))
-        if handler is not None:
-            ret = handler.add_line(line_num, line)
-            if ret:
-                continue
-            recent_lines.clear()
-            handler = None
-        if line.startswith('Git version'):
+    # Process the interesting parts of the log file (as found by the index)
+    index = logindex.LogIndex(logname)
+    end_line_num = 0
+    for line_num, offset, kind in index.get_markers():
+        if line_num < end_line_num:
+            # Line already processed by a handler
+            continue
+        line = next(index.read_lines(offset, line_num))[1].rstrip()
+        if kind == 'git':
             last_git = format_comment(line_num, line)
-        elif line.startswith('Start printer at'):
+            continue
+        elif kind == 'start':
             last_start = format_comment(line_num, line)
-        elif line == '===== Config file =====':
+            continue
+        recent_lines = []
+        if line_num > end_line_num:
+            first_line_num = max(end_line_num + 1, line_num - 199)
+            before = index.read_lines_before(offset, line_num,
+                                             line_num - first_line_num)
+            recent_lines = [(ln, l.rstrip()) for ln, l in before]
+            recent_lines.append((line_num, line))
+        if kind == 'config':
             handler = GatherConfig(configs, line_num, recent_lines, logname)
-            handler.add_comment(last_git)
-            handler.add_comment(last_start)
-        elif 'shutdown: ' in line or line.startswith('Dumping '):
+        else:
             handler = GatherShutdown(configs, line_num, recent_lines, logname)
-            handler.add_comment(last_git)
-            handler.add_comment(last_start)
-    if handler is not None:
-        handler.finalize()
+        handler.add_comment(last_git)
+        handler.add_comment(last_start)
+        lines = index.read_lines(offset, line_num)
+        next(lines)
+        for end_line_num, line in lines:
+            if not handler.add_line(end_line_num, line.rstrip()):
+                handler = None
+                break
+        if handler is not None:
+            handler.finalize()
+            break
     # Write found config files
     for cfg in configs.values():
         cfg.write_file()
@@ -0,0 +1,194 @@
+# Build (and cache) an index of the interesting lines in a klippy.log file
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, sys, re, pickle, zlib, multiprocessing
+
+CACHE_VERSION = 1
+CHUNK_SIZE = 16 * 1024 * 1024
+
+marker_r = re.compile(
+    br"^(?:(?P<git>Git version)|(?P<start>Start printer at)"
+    br"|(?P<config>===== Config file =====[ \t\r\f\v]*$)"
+    br"|(?P<stats>(?:INFO:root:)?Stats[ \t])"
+    br"|(?P<shutdown>Dumping |[^\n]*shutdown: ))", re.M)
+MARKER_KINDS = ('git', 'start', 'config', 'shutdown')
+
+# Split a "Stats" line into a sample time and a list of
+# (prefix, name, value) tuples
+def parse_stats_line(line):
+    parts = line.split()
+    try:
+        sampletime = float(parts[1][:-1])
+    except (IndexError, ValueError):
+        return None
+    prefix = ""
+    fields = []
+    for p in parts[2:]:
+        if '=' not in p:
+            prefix = p
+            continue
+        name, val = p.split('=', 1)
+        fields.append((prefix, name, val))
+    return sampletime, fields
+
+# Scan the lines that start in the given byte range of a log file.
+# Returns the number of lines, a list of (line index, file offset,
+# kind) markers, and a list of (file offset, parsed stats) entries.
+def scan_chunk(args):
+    logname, start, end = args
+    f = open(logname, 'rb')
+    base = start
+    if start:
+        f.seek(start - 1)
+        data = f.read(end - start + 1)
+        # Skip the line that started in the previous chunk
+        if data[:1] != b'\n':
+            pos = data.find(b'\n')
+            if pos < 0:
+                pos = len(data)
+            base = start + pos
+            data = data[pos:]
+        data = data[1:]
+    else:
+        data = f.read(end)
+    data += f.readline()
+    f.close()
+    if base >= end:
+        return 0, [], []
+    chunk_end = end - base
+    line_count = 1 + data.count(b'\n', 0, chunk_end - 1)
+    markers = []
+    stats = []
+    line_idx = last_pos = 0
+    for m in marker_r.finditer(data):
+        pos = m.start()
+        if pos >= chunk_end:
+            break
+        line_idx += data.count(b'\n', last_pos, pos)
+        last_pos = pos
+        kind = m.lastgroup
+        if kind != 'stats':
+            markers.append((line_idx, base + pos, kind))
+            continue
+        line_end = data.find(b'\n', pos)
+        if line_end < 0:
+            line_end = len(data)
+        res = parse_stats_line(data[pos:line_end].decode('latin-1'))
+        if res is not None:
+            stats.append((base + pos, res))
+    return line_count, markers, stats
+
+class LogIndex:
+    def __init__(self, logname, use_cache=True):
+        self.logname = logname
+        self.cache_name = logname + ".logindex"
+        st = os.stat(logname)
+        self.log_id = (CACHE_VERSION, sys.version_info[0], st.st_size,
+                       st.st_mtime)
+        self.line_count = 0
+        self.markers = []
+        self.stats_fields = []
+        self.stats = []
+        if use_cache and self._load_cache():
+            return
+        self._scan(st.st_size)
+        if use_cache:
+            self._save_cache()
+    def _load_cache(self):
+        try:
+            f = open(self.cache_name, 'rb')
+            data = pickle.loads(zlib.decompress(f.read()))
+            f.close()
+        except Exception:
+            return False
+        if data.get('log_id') != self.log_id:
+            return False
+        self.line_count = data['line_count']
+        self.markers = data['markers']
+        self.stats_fields = data['stats_fields']
+        self.stats = data['stats']
+        return True
+    def _save_cache(self):
+        data = {'log_id': self.log_id, 'line_count': self.line_count,
+                'markers': self.markers, 'stats_fields': self.stats_fields,
+                'stats': self.stats}
+        try:
+            f = open(self.cache_name, 'wb')
+            f.write(zlib.compress(pickle.dumps(data, 2), 1))
+            f.close()
+        except (IOError, OSError):
+            pass
+    def _scan(self, size):
+        chunks = [(self.logname, start, min(size, start + CHUNK_SIZE))
+                  for start in range(0, size, CHUNK_SIZE)]
+        if len(chunks) > 1:
+            pool = multiprocessing.Pool()
+            try:
+                results = pool.map(scan_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [scan_chunk(c) for c in chunks]
+        # Merge the chunk results (stats fields are stored as
+        # (field id, value) pairs to reduce the size of the cache)
+        field_ids = {}
+        line_num = 1
+        for line_count, markers, stats in results:
+            for line_idx, offset, kind in markers:
+                self.markers.append((line_num + line_idx, offset, kind))
+            for offset, (sampletime, fields) in stats:
+                row = []
+                for prefix, name, val in fields:
+                    fid = field_ids.get((prefix, name))
+                    if fid is None:
+                        fid = field_ids[(prefix, name)] = len(field_ids)
+                        self.stats_fields.append((prefix, name))
+                    row.append(fid)
+                    row.append(val)
+                self.stats.append((offset, sampletime, tuple(row)))
+            line_num += line_count
+        self.line_count = line_num - 1
+    # Index access
+    def get_line_count(self):
+        return self.line_count
+    def get_markers(self):
+        # Returns a list of (line number, file offset, kind) tuples
+        return self.markers
+    def get_stats_fields(self):
+        # Returns a list of (prefix, name) for each stats field id
+        return self.stats_fields
+    def get_stats(self):
+        # Returns a list of (file offset, sample time, row) tuples where
+        # row contains alternating stats field ids and string values
+        return self.stats
+    # Log access
+    def read_lines(self, offset, line_num):
+        # Generate (line number, line) for each line starting at offset
+        f = open(self.logname, 'rb')
+        f.seek(offset)
+        while 1:
+            line = f.readline()
+            if not line:
+                break
+            yield line_num, line
+            line_num += 1
+        f.close()
+    def read_lines_before(self, offset, line_num, count):
+        # Return (line number, line) for up to count lines before offset
+        if count <= 0:
+            return []
+        f = open(self.logname, 'rb')
+        read_size = 65536
+        while 1:
+            start = max(0, offset - read_size)
+            f.seek(start)
+            lines = f.read(offset - start).split(b'\n')[:-1]
+            if start and len(lines) <= count:
+                read_size *= 2
+                continue
+            break
+        f.close()
+        lines = [l + b'\n' for l in lines[-count:]]
+        first_line = line_num - len(lines)
+        return [(first_line + i, l) for i, l in enumerate(lines)]
@@ -0,0 +1,688 @@
+#!/usr/bin/env python
+# Simulate a micro-controller on a pseudo-tty for host side testing
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, pty, fcntl, termios, errno, select, heapq
+import random, zlib, json, collections
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+SERIALBITS = 10 # 8N1 = 1 start, 8 data, 1 stop
+RECEIVE_WINDOW = 192
+STATS_INTERVAL = 5.
+
+# Commands that are still processed after a shutdown
+IN_SHUTDOWN_COMMANDS = {
+    'identify': 1, 'get_config': 1, 'get_clock': 1, 'get_uptime': 1,
+    'emergency_stop': 1, 'clear_shutdown': 1, 'config_reset': 1, 'reset': 1,
+    'stepper_get_position': 1, 'endstop_query_state': 1, 'debug_nop': 1,
+    'debug_ping': 1, 'debug_read': 1, 'debug_write': 1,
+}
+
+
+######################################################################
+# Serial link
+######################################################################
+
+# Message block framing, acknowledgments, and serial port timing
+class SerialLink:
+    def __init__(self, sim, fd, baud, loss):
+        self.sim = sim
+        self.fd = fd
+        self.byte_time = 0.
+        if baud:
+            self.byte_time = SERIALBITS / float(baud)
+        self.loss = loss
+        self.next_sequence = msgproto.MESSAGE_DEST
+        self.need_sync = self.need_valid = False
+        self.rx_buf = bytearray()
+        self.rx_pending = collections.deque()
+        self.tx_pending = collections.deque()
+        self.rx_busy_time = self.tx_busy_time = 0.
+        self.stats = collections.OrderedDict([
+            ('rx_blocks', 0), ('rx_bytes', 0), ('rx_lost', 0),
+            ('rx_invalid', 0), ('rx_out_of_seq', 0), ('tx_blocks', 0),
+            ('tx_bytes', 0), ('tx_lost', 0)])
+    def reset(self):
+        self.next_sequence = msgproto.MESSAGE_DEST
+    # Receiving
+    def handle_read(self, eventtime):
+        try:
+            data = os.read(self.fd, 4096)
+        except os.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EIO):
+                return
+            raise
+        # Data is available to the mcu once it has crossed the wire
+        start = max(eventtime, self.rx_busy_time)
+        self.rx_busy_time = start + len(data) * self.byte_time
+        self.rx_pending.append((self.rx_busy_time, bytearray(data)))
+    def _find_block(self):
+        # Returns (is_valid, pop_count) - based on command_find_block()
+        buf = self.rx_buf
+        if buf and self.need_sync:
+            return self._sync(buf)
+        if len(buf) < msgproto.MESSAGE_MIN:
+            return False, 0
+        msglen = buf[msgproto.MESSAGE_POS_LEN]
+        msgseq = buf[msgproto.MESSAGE_POS_SEQ]
+        if (msglen < msgproto.MESSAGE_MIN or msglen > msgproto.MESSAGE_MAX
+            or (msgseq & ~msgproto.MESSAGE_SEQ_MASK) != msgproto.MESSAGE_DEST):
+            return self._error(buf)
+        if len(buf) < msglen:
+            return False, 0
+        if buf[msglen-msgproto.MESSAGE_TRAILER_SYNC] != msgproto.MESSAGE_SYNC:
+            return self._error(buf)
+        crc = msgproto.crc16_ccitt(buf[:msglen-msgproto.MESSAGE_TRAILER_SIZE])
+        msgcrc = list(buf[msglen-msgproto.MESSAGE_TRAILER_CRC:
+                          msglen-msgproto.MESSAGE_TRAILER_SYNC])
+        if crc != msgcrc:
+            return self._error(buf)
+        if self.loss and random.random() < self.loss:
+            # Simulate a corrupted block
+            self.stats['rx_lost'] += 1
+            return self._error(buf)
+        self.need_valid = False
+        if msgseq != self.next_sequence:
+            # Lost message - discard messages until it is retransmitted
+            self.stats['rx_out_of_seq'] += 1
+            self.send_ack()
+            return False, msglen
+        self.next_sequence = (((msgseq + 1) & msgproto.MESSAGE_SEQ_MASK)
+                              | msgproto.MESSAGE_DEST)
+        return True, msglen
+    def _error(self, buf):
+        if buf[0] == msgproto.MESSAGE_SYNC:
+            # Ignore (do not nak) leading SYNC bytes
+            return False, 1
+        self.stats['rx_invalid'] += 1
+        self.need_sync = True
+        return self._sync(buf)
+    def _sync(self, buf):
+        # Discard bytes until next SYNC found
+        pos = buf.find(bytearray([msgproto.MESSAGE_SYNC]))
+        if pos >= 0:
+            self.need_sync = False
+            pop_count = pos + 1
+        else:
+            pop_count = len(buf)
+        if not self.need_valid:
+            self.need_valid = True
+            self.send_ack()
+        return False, pop_count
+    def process(self, eventtime):
+        while self.rx_pending and self.rx_pending[0][0] <= eventtime:
+            self.rx_buf.extend(self.rx_pending.popleft()[1])
+        while 1:
+            is_valid, pop_count = self._find_block()
+            if not pop_count:
+                break
+            block = self.rx_buf[:pop_count]
+            del self.rx_buf[:pop_count]
+            if is_valid:
+                self.stats['rx_blocks'] += 1
+                self.stats['rx_bytes'] += pop_count
+                self.sim.dispatch(block, eventtime)
+                self.send_ack()
+        self._flush_tx(eventtime)
+    # Transmitting
+    def send_ack(self):
+        self.send_block([])
+    def send_block(self, payload):
+        msglen = msgproto.MESSAGE_MIN + len(payload)
+        out = [msglen, self.next_sequence] + payload
+        out += msgproto.crc16_ccitt(out)
+        out.append(msgproto.MESSAGE_SYNC)
+        start = max(time.time(), self.tx_busy_time)
+        self.tx_busy_time = start + len(out) * self.byte_time
+        if payload and self.loss and random.random() < self.loss:
+            # Acks are not dropped - the host waits for the ack of each
+            # identify request and would stall until its connect timeout
+            self.stats['tx_lost'] += 1
+            return
+        self.stats['tx_blocks'] += 1
+        self.stats['tx_bytes'] += len(out)
+        self.tx_pending.append((self.tx_busy_time, bytearray(out)))
+    def _flush_tx(self, eventtime):
+        while self.tx_pending and self.tx_pending[0][0] <= eventtime:
+            data = self.tx_pending[0][1]
+            try:
+                count = os.write(self.fd, data)
+            except os.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EIO):
+                    return
+                raise
+            if count < len(data):
+                del data[:count]
+                return
+            self.tx_pending.popleft()
+    def get_next_wake(self):
+        waketime = 9999999999.
+        if self.rx_pending:
+            waketime = self.rx_pending[0][0]
+        if self.tx_pending:
+            waketime = min(waketime, self.tx_pending[0][0])
+        return waketime
+
+
+######################################################################
+# Simulated mcu objects
+######################################################################
+
+class SimStepper:
+    def __init__(self, sim, oid):
+        self.sim = sim
+        self.oid = oid
+        self.last_clock = 0
+        self.reset_clock32 = 0
+        self.next_dir = 0
+        self.position = 0
+        self.need_reset = False
+        # Queued moves: (start_clock, end_clock, interval, count, add, dir)
+        self.moves = collections.deque()
+    def reset_clock(self, clock32):
+        # The 64bit clock is resolved from the first step time
+        self.reset_clock32 = clock32
+        self.need_reset = False
+    def resolve_clock(self, interval, eventtime):
+        if self.reset_clock32 is None:
+            return
+        step_clock32 = (self.reset_clock32 + interval) & 0xffffffff
+        step_clock = self.sim.clock32_to_clock64(step_clock32, eventtime)
+        self.last_clock = step_clock - interval
+        self.reset_clock32 = None
+    def queue_move(self, interval, count, add):
+        start = self.last_clock
+        end = start + interval * count + add * count * (count - 1) // 2
+        self.moves.append((start, end, interval, count, add, self.next_dir))
+        self.last_clock = end
+    def is_active(self, clock):
+        # Note the completed moves and report if any steps are pending
+        while self.moves and self.moves[0][1] <= clock:
+            move = self.moves.popleft()
+            self.position += move[3] if move[5] else -move[3]
+        return len(self.moves) > 0
+    def get_position(self, clock):
+        if not self.is_active(clock):
+            return self.position
+        # Count the steps of the current move that are at or before clock
+        start, end, interval, count, add, mdir = self.moves[0]
+        step_clock = start
+        steps = 0
+        while steps < count:
+            step_clock += interval + add * steps
+            if step_clock > clock:
+                break
+            steps += 1
+        return self.position + (steps if mdir else -steps)
+    def stop(self, clock):
+        self.position = self.get_position(clock)
+        self.moves.clear()
+        self.need_reset = True
+
+class SimTrsync:
+    def __init__(self, sim, oid):
+        self.sim = sim
+        self.oid = oid
+        self.can_trigger = False
+        self.trigger_reason = self.expire_reason = 0
+        self.report_ticks = 0
+        self.steppers = []
+        self.timer_gen = self.expire_gen = 0
+    def start(self, report_clock, report_ticks, expire_reason):
+        self.can_trigger = True
+        self.trigger_reason = 0
+        self.expire_reason = expire_reason
+        self.report_ticks = report_ticks
+        self.steppers = []
+        self.timer_gen += 1
+        self.expire_gen += 1
+        if report_ticks:
+            self.sim.add_clock_timer(report_clock, self._report_event,
+                                     self.timer_gen)
+    def set_timeout(self, clock):
+        # A new timeout replaces any pending timeout
+        self.expire_gen += 1
+        if self.can_trigger:
+            self.sim.add_clock_timer(clock, self._timeout_event,
+                                     self.expire_gen)
+    def _report_event(self, clock, gen):
+        # Reports continue after a trigger until the host stops the trsync
+        if gen != self.timer_gen:
+            return None
+        self.report(clock)
+        return clock + self.report_ticks
+    def _timeout_event(self, clock, gen):
+        if gen == self.expire_gen:
+            self.trigger(self.expire_reason, clock)
+        return None
+    def _do_trigger(self, reason, clock):
+        if not self.can_trigger:
+            return False
+        self.can_trigger = False
+        self.trigger_reason = reason
+        for stepper in self.steppers:
+            stepper.stop(clock)
+        self.steppers = []
+        return True
+    def trigger(self, reason, clock):
+        if self._do_trigger(reason, clock):
+            self.report(clock)
+    def host_trigger(self, reason, clock):
+        self._do_trigger(reason, clock)
+        self.timer_gen += 1
+        self.expire_gen += 1
+        self.report(0)
+    def report(self, clock):
+        self.sim.send("trsync_state", oid=self.oid,
+                      can_trigger=int(self.can_trigger),
+                      trigger_reason=self.trigger_reason,
+                      clock=clock & 0xffffffff)
+
+class SimEndstop:
+    def __init__(self, sim, oid):
+        self.sim = sim
+        self.oid = oid
+        self.homing = False
+        self.pin_value = 0
+        self.next_clock = 0
+        self.timer_gen = 0
+    def home(self, clock, rest_ticks, pin_value, trsync, reason):
+        self.timer_gen += 1
+        self.homing = False
+        self.pin_value = pin_value
+        if trsync is None:
+            return
+        # Report the endstop as triggered after a fixed homing time
+        self.homing = True
+        trigger_clock = max(clock, self.sim.get_clock(time.time()))
+        trigger_clock += int(self.sim.home_time * self.sim.freq)
+        self.next_clock = clock
+        self.sim.add_clock_timer(trigger_clock, self._trigger_event,
+                                 (self.timer_gen, rest_ticks, trsync, reason))
+    def _trigger_event(self, clock, data):
+        gen, rest_ticks, trsync, reason = data
+        if gen != self.timer_gen:
+            return None
+        self.homing = False
+        self.next_clock = clock + rest_ticks
+        trsync.trigger(reason, clock)
+        return None
+    def query(self, clock):
+        next_clock = self.next_clock
+        if self.homing:
+            next_clock = clock
+        # The endstop always reads as "not triggered" outside of homing
+        self.sim.send("endstop_state", oid=self.oid, homing=int(self.homing),
+                      next_clock=next_clock & 0xffffffff,
+                      pin_value=int(not self.pin_value))
+
+class SimAnalogIn:
+    def __init__(self, sim, oid):
+        self.sim = sim
+        self.oid = oid
+        self.timer_gen = 0
+    def query(self, clock, sample_count, rest_ticks, min_value, max_value):
+        self.timer_gen += 1
+        if not sample_count:
+            return
+        # Report a constant value in the middle of the allowed range
+        if max_value > min_value:
+            value = (min_value + max_value) // 2
+        else:
+            value = self.sim.adc_max * sample_count // 2
+        self.sim.add_clock_timer(clock, self._report_event,
+                                 (self.timer_gen, rest_ticks, value))
+    def _report_event(self, clock, data):
+        gen, rest_ticks, value = data
+        if gen != self.timer_gen:
+            return None
+        next_clock = clock + rest_ticks
+        self.sim.send("analog_in_state", oid=self.oid,
+                      next_clock=next_clock & 0xffffffff, value=value)
+        return next_clock
+
+
+######################################################################
+# Simulated mcu
+######################################################################
+
+class McuSim:
+    def __init__(self, dictionary, options):
+        self.msgparser = msgproto.MessageParser()
+        self.msgparser.process_identify(dictionary, decompress=False)
+        self.identify_data = zlib.compress(dictionary)
+        self.freq = self.msgparser.get_constant_float('CLOCK_FREQ')
+        self.adc_max = self.msgparser.get_constant_int('ADC_MAX', 4095)
+        self.move_count = options.move_count
+        self.verbose = options.verbose
+        self.home_time = options.home_time
+        self.link = None
+        self.start_time = time.time()
+        self.timers = []
+        self.timer_seq = 0
+        self.reset_state()
+        self.stats_time = self.start_time + options.stats_interval
+        self.stats_interval = options.stats_interval
+    def reset_state(self):
+        self.is_config = 0
+        self.config_crc = 0
+        self.shutdown_reason = None
+        self.objects = {}
+        self.queued_moves = []
+        self.max_queued_moves = 0
+        self.step_count = 0
+        self.timers = []
+    def set_link(self, link):
+        self.link = link
+    # Clock handling
+    def get_clock(self, eventtime):
+        return int((eventtime - self.start_time) * self.freq)
+    def clock_to_time(self, clock):
+        return self.start_time + clock / self.freq
+    def clock32_to_clock64(self, clock32, eventtime):
+        clock = self.get_clock(eventtime)
+        diff = (clock32 - clock) & 0xffffffff
+        if diff & 0x80000000:
+            diff -= 0x100000000
+        return clock + diff
+    # Timers (callbacks return the next clock to run at or None)
+    def add_clock_timer(self, clock, callback, data=None):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (self.clock_to_time(clock),
+                                     self.timer_seq, clock, callback, data))
+    def _run_timers(self, eventtime):
+        while self.timers and self.timers[0][0] <= eventtime:
+            waketime, seq, clock, callback, data = heapq.heappop(self.timers)
+            next_clock = callback(clock, data)
+            if next_clock is not None:
+                self.add_clock_timer(next_clock, callback, data)
+    def _get_next_wake(self):
+        if self.timers:
+            return self.timers[0][0]
+        return 9999999999.
+    # Message encoding and decoding
+    def send(self, name, **params):
+        msg = self.msgparser.messages_by_name[name]
+        if self.verbose:
+            sys.stdout.write("%.6f: -> %s\n" % (
+                time.time() - self.start_time, msg.format_params(params)))
+        self.link.send_block(msg.encode_by_name(**params))
+    def dispatch(self, block, eventtime):
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        end = len(block) - msgproto.MESSAGE_TRAILER_SIZE
+        mp = self.msgparser
+        while pos < end:
+            mid = mp.messages_by_id.get(block[pos], mp.unknown)
+            params, pos = mid.parse(block, pos)
+            if self.verbose:
+                sys.stdout.write("%.6f: %s\n" % (
+                    eventtime - self.start_time, mid.format_params(params)))
+            if (self.shutdown_reason is not None
+                and mid.name not in IN_SHUTDOWN_COMMANDS):
+                self.send("is_shutdown", static_string_id=self.shutdown_reason)
+                continue
+            func = getattr(self, 'cmd_' + mid.name, None)
+            if func is not None:
+                func(params, eventtime)
+    def shutdown(self, reason, eventtime):
+        if self.shutdown_reason is not None:
+            return
+        enums = self.msgparser.get_enumerations().get('static_string_id', {})
+        if reason not in enums:
+            reason = "Command request"
+        self.shutdown_reason = reason
+        clock = self.get_clock(eventtime)
+        for obj in self.objects.values():
+            if isinstance(obj, SimStepper):
+                obj.stop(clock)
+        self.timers = []
+        self.queued_moves = []
+        sys.stdout.write("Shutdown: %s\n" % (reason,))
+        self.send("shutdown", clock=clock & 0xffffffff,
+                  static_string_id=reason)
+    def _lookup(self, oid, otype):
+        obj = self.objects.get(oid)
+        if obj is None:
+            obj = self.objects[oid] = otype(self, oid)
+        return obj
+    # Basic commands
+    def cmd_identify(self, params, eventtime):
+        offset = params['offset']
+        data = self.identify_data[offset:offset+params['count']]
+        self.send("identify_response", offset=offset, data=data)
+    def cmd_get_config(self, params, eventtime):
+        self.send("config", is_config=self.is_config, crc=self.config_crc,
+                  is_shutdown=int(self.shutdown_reason is not None),
+                  move_count=self.move_count)
+    def cmd_finalize_config(self, params, eventtime):
+        self.is_config = 1
+        self.config_crc = params['crc']
+    def cmd_get_clock(self, params, eventtime):
+        self.send("clock", clock=self.get_clock(time.time()) & 0xffffffff)
+    def cmd_get_uptime(self, params, eventtime):
+        clock = self.get_clock(time.time())
+        self.send("uptime", high=clock >> 32, clock=clock & 0xffffffff)
+    def cmd_emergency_stop(self, params, eventtime):
+        self.shutdown("Command request", eventtime)
+    def cmd_clear_shutdown(self, params, eventtime):
+        self.shutdown_reason = None
+    def cmd_config_reset(self, params, eventtime):
+        if self.shutdown_reason is None:
+            self.shutdown("Command request", eventtime)
+        sys.stdout.write("Config reset\n")
+        self.reset_state()
+    def cmd_reset(self, params, eventtime):
+        sys.stdout.write("Reset\n")
+        self.reset_state()
+        self.link.reset()
+    def cmd_debug_ping(self, params, eventtime):
+        self.send("pong", data=params['data'])
+    # Steppers
+    def cmd_reset_step_clock(self, params, eventtime):
+        stepper = self._lookup(params['oid'], SimStepper)
+        stepper.reset_clock(params['clock'])
+    def cmd_set_next_step_dir(self, params, eventtime):
+        self._lookup(params['oid'], SimStepper).next_dir = params['dir']
+    def cmd_queue_step(self, params, eventtime):
+        stepper = self._lookup(params['oid'], SimStepper)
+        clock = self.get_clock(eventtime)
+        self._free_moves(clock)
+        queued = self.queued_moves
+        if len(queued) >= self.move_count:
+            self.shutdown("Move queue overflow", eventtime)
+            return
+        if stepper.need_reset:
+            # Stepper stopped by a trsync - discard moves until reset
+            return
+        stepper.resolve_clock(params['interval'], eventtime)
+        if (not stepper.is_active(clock)
+            and stepper.last_clock + params['interval'] < clock):
+            self.shutdown("Stepper too far in past", eventtime)
+            return
+        heapq.heappush(queued, stepper.last_clock)
+        stepper.queue_move(params['interval'], params['count'], params['add'])
+        self.max_queued_moves = max(self.max_queued_moves, len(queued))
+        self.step_count += params['count']
+    def _free_moves(self, clock):
+        # Moves are freed once the mcu starts to process them
+        queued = self.queued_moves
+        while queued and queued[0] <= clock:
+            heapq.heappop(queued)
+    def cmd_stepper_get_position(self, params, eventtime):
+        stepper = self._lookup(params['oid'], SimStepper)
+        pos = stepper.get_position(self.get_clock(eventtime))
+        self.send("stepper_position", oid=params['oid'], pos=pos)
+    def cmd_stepper_stop_on_trigger(self, params, eventtime):
+        stepper = self._lookup(params['oid'], SimStepper)
+        trsync = self._lookup(params['trsync_oid'], SimTrsync)
+        trsync.steppers.append(stepper)
+    # Homing
+    def cmd_trsync_start(self, params, eventtime):
+        trsync = self._lookup(params['oid'], SimTrsync)
+        report_clock = self.clock32_to_clock64(params['report_clock'],
+                                               eventtime)
+        trsync.start(report_clock, params['report_ticks'],
+                     params['expire_reason'])
+    def cmd_trsync_set_timeout(self, params, eventtime):
+        trsync = self._lookup(params['oid'], SimTrsync)
+        trsync.set_timeout(self.clock32_to_clock64(params['clock'], eventtime))
+    def cmd_trsync_trigger(self, params, eventtime):
+        trsync = self._lookup(params['oid'], SimTrsync)
+        trsync.host_trigger(params['reason'], self.get_clock(eventtime))
+    def cmd_endstop_home(self, params, eventtime):
+        endstop = self._lookup(params['oid'], SimEndstop)
+        trsync = None
+        if params['sample_count']:
+            trsync = self._lookup(params['trsync_oid'], SimTrsync)
+        clock = self.clock32_to_clock64(params['clock'], eventtime)
+        endstop.home(clock, params['rest_ticks'], params['pin_value'], trsync,
+                     params['trigger_reason'])
+    def cmd_endstop_query_state(self, params, eventtime):
+        endstop = self._lookup(params['oid'], SimEndstop)
+        endstop.query(self.get_clock(eventtime))
+    # Sensors and buses
+    def cmd_query_analog_in(self, params, eventtime):
+        adc = self._lookup(params['oid'], SimAnalogIn)
+        clock = self.clock32_to_clock64(params['clock'], eventtime)
+        adc.query(clock, params['sample_count'], params['rest_ticks'],
+                  params['min_value'], params['max_value'])
+    def cmd_spi_transfer(self, params, eventtime):
+        self.send("spi_transfer_response", oid=params['oid'],
+                  response=bytes(bytearray(len(params['data']))))
+    def cmd_i2c_read(self, params, eventtime):
+        self.send("i2c_read_response", oid=params['oid'],
+                  response=bytes(bytearray(params['read_len'])))
+    def cmd_neopixel_send(self, params, eventtime):
+        self.send("neopixel_result", oid=params['oid'], success=1)
+    # Main loop
+    def _report_stats(self, eventtime):
+        if eventtime < self.stats_time:
+            return
+        self.stats_time = eventtime + self.stats_interval
+        self._free_moves(self.get_clock(eventtime))
+        parts = ["%s=%d" % (name, val)
+                 for name, val in self.link.stats.items()]
+        parts += ["queued_moves=%d" % (len(self.queued_moves),),
+                  "max_queued_moves=%d" % (self.max_queued_moves,),
+                  "steps=%d" % (self.step_count,)]
+        sys.stdout.write("Stats %.1f: %s\n" % (
+            eventtime - self.start_time, " ".join(parts)))
+        sys.stdout.flush()
+        self.max_queued_moves = len(self.queued_moves)
+    def run(self, fd):
+        link = self.link
+        while 1:
+            eventtime = time.time()
+            self._run_timers(eventtime)
+            link.process(eventtime)
+            if self.stats_interval:
+                self._report_stats(eventtime)
+            waketime = min(self._get_next_wake(), link.get_next_wake())
+            if link.tx_pending:
+                # Retry writes to a full pseudo-tty
+                waketime = min(waketime, eventtime + .001)
+            timeout = max(0., waketime - time.time())
+            res = select.select([fd], [], [], min(timeout, 1.))
+            if res[0]:
+                link.handle_read(time.time())
+
+
+######################################################################
+# Startup
+######################################################################
+
+# Support for creating a pseudo-tty for emulating a serial port
+def create_pty(ptyname):
+    mfd, sfd = pty.openpty()
+    try:
+        os.unlink(ptyname)
+    except os.error:
+        pass
+    os.symlink(os.ttyname(sfd), ptyname)
+    fcntl.fcntl(mfd, fcntl.F_SETFL
+                , fcntl.fcntl(mfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    tcattr = termios.tcgetattr(mfd)
+    tcattr[0] &= ~(
+        termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP |
+        termios.INLCR | termios.IGNCR | termios.ICRNL | termios.IXON)
+    tcattr[1] &= ~termios.OPOST
+    tcattr[3] &= ~(
+        termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG |
+        termios.IEXTEN)
+    tcattr[2] &= ~(termios.CSIZE | termios.PARENB)
+    tcattr[2] |= termios.CS8
+    tcattr[6][termios.VMIN] = 0
+    tcattr[6][termios.VTIME] = 0
+    termios.tcsetattr(mfd, termios.TCSAFLUSH, tcattr)
+    # The slave side is kept open so that the master doesn't report
+    # errors while the host reconnects
+    return mfd, sfd
+
+def load_dictionary(filename, options):
+    f = open(filename, 'rb')
+    data = json.loads(f.read())
+    f.close()
+    config = data.setdefault('config', {})
+    if options.clock_freq:
+        config['CLOCK_FREQ'] = options.clock_freq
+    if options.baud:
+        config['SERIAL_BAUD'] = options.baud
+        config['RECEIVE_WINDOW'] = options.receive_window
+    else:
+        config.pop('SERIAL_BAUD', None)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+def main():
+    usage = "%prog [options] <data dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--port", type="string", dest="port",
+                    default="/tmp/pseudoserial",
+                    help="pseudo-tty device to create for serial port")
+    opts.add_option("-b", "--baud", type="int", dest="baud", default=250000,
+                    help="baud rate of the emulated serial port (0 for a"
+                    " usb style link without a bandwidth limit)")
+    opts.add_option("-c", "--clock-freq", type="int", dest="clock_freq",
+                    default=0, help="mcu clock frequency (default from"
+                    " the data dictionary)")
+    opts.add_option("-m", "--move-count", type="int", dest="move_count",
+                    default=1024, help="size of the mcu move queue")
+    opts.add_option("-w", "--receive-window", type="int",
+                    dest="receive_window", default=RECEIVE_WINDOW,
+                    help="mcu receive buffer size reported to the host")
+    opts.add_option("-l", "--loss", type="float", dest="loss", default=0.,
+                    help="probability of losing each message block")
+    opts.add_option("-t", "--home-time", type="float", dest="home_time",
+                    default=.100, help="time before endstops trigger")
+    opts.add_option("-v", action="store_true", dest="verbose",
+                    help="show all messages sent and received")
+    opts.add_option("-s", "--stats", type="float", dest="stats_interval",
+                    default=STATS_INTERVAL,
+                    help="interval between statistics reports (0 to disable)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    if options.loss < 0. or options.loss >= 1.:
+        opts.error("Loss must be between 0 and 1")
+    dictionary = load_dictionary(args[0], options)
+    sim = McuSim(dictionary, options)
+
+    # Create terminal device
+    mfd, sfd = create_pty(options.port)
+    sim.set_link(SerialLink(sim, mfd, options.baud, options.loss))
+    sys.stdout.write("Starting mcu simulation: freq=%d move_count=%d\n"
+                     "Serial: port=%s baud=%d loss=%.3f\n" % (
+                         sim.freq, options.move_count, options.port,
+                         options.baud, options.loss))
+    sys.stdout.flush()
+
+    # Run loop
+    try:
+        sim.run(mfd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(options.port)
+
+if __name__ == '__main__':
+    main()
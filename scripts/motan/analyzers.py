@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, collections
+import numpy
 import readlog
 
 
@@ -41,9 +42,8 @@ class GenDerivative:
     def generate_data(self):
         inv_seg_time = 1. / self.amanager.get_segment_time()
         data = self.amanager.get_datasets()[self.source]
-        deriv = [(data[i+1] - data[i]) * inv_seg_time
-                 for i in range(len(data)-1)]
-        return [deriv[0]] + deriv
+        deriv = (data[1:] - data[:-1]) * inv_seg_time
+        return numpy.concatenate((deriv[:1], deriv))
 AHandlers["derivative"] = GenDerivative
 
 # Calculate an integral (accel to velocity, or velocity to position)
@@ -85,24 +85,23 @@ class GenIntegral:
     def generate_data(self):
         seg_time = self.amanager.get_segment_time()
         src = self.amanager.get_datasets()[self.source]
-        offset = sum(src) / len(src)
-        total = 0.
-        ref = None
-        if self.ref is not None:
-            ref = self.amanager.get_datasets()[self.ref]
-            offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
-            total = ref[0]
-            src_weight = 1.
-            if self.half_life:
-                src_weight = math.exp(math.log(.5) * seg_time / self.half_life)
-            ref_weight = 1. - src_weight
-        data = [0.] * len(src)
-        for i, v in enumerate(src):
-            total += (v - offset) * seg_time
-            if ref is not None:
-                total = src_weight * total + ref_weight * ref[i]
+        offset = numpy.sum(src) / len(src)
+        if self.ref is None:
+            return numpy.add.accumulate((src - offset) * seg_time)
+        ref = self.amanager.get_datasets()[self.ref]
+        offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
+        src_weight = 1.
+        if self.half_life:
+            src_weight = math.exp(math.log(.5) * seg_time / self.half_life)
+        ref_weight = 1. - src_weight
+        # The weighted sum is a recursive filter - calculate it in a loop
+        total = ref[0]
+        data = ((src - offset) * seg_time).tolist()
+        ref_data = (ref_weight * ref).tolist()
+        for i, v in enumerate(data):
+            total = src_weight * (total + v) + ref_data[i]
             data[i] = total
-        return data
+        return numpy.array(data)
 AHandlers["integral"] = GenIntegral
 
 # Calculate a kinematic stepper position from the toolhead requested position
@@ -138,14 +137,10 @@ class GenKinematicPosition:
         return {'label': 'Position', 'units': 'Position\n(mm)'}
     def generate_data_corexy_plus(self):
         datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 + d2 for d1, d2 in zip(data1, data2)]
+        return datasets[self.source1] + datasets[self.source2]
     def generate_data_corexy_minus(self):
         datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        return datasets[self.source1] - datasets[self.source2]
     def generate_data_passthrough(self):
         return self.amanager.get_datasets()[self.source1]
 AHandlers["kin"] = GenKinematicPosition
@@ -174,8 +169,8 @@ class GenCorexyPosition:
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
         if self.is_plus:
-            return [.5 * (d1 + d2) for d1, d2 in zip(data1, data2)]
-        return [.5 * (d1 - d2) for d1, d2 in zip(data1, data2)]
+            return .5 * (data1 + data2)
+        return .5 * (data1 - data2)
 AHandlers["corexy"] = GenCorexyPosition
 
 # Calculate a position deviation
@@ -199,9 +194,7 @@ class GenDeviation:
         return {'label': label1['label'] + ' deviation', 'units': units}
     def generate_data(self):
         datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        return datasets[self.source1] - datasets[self.source2]
 AHandlers["deviation"] = GenDeviation
 
 
@@ -267,17 +260,26 @@ class AnalyzerManager:
                 raise self.error("Unknown dataset '%s'" % (dataset,))
         return hdl.get_label()
     def generate_datasets(self):
-        # Generate raw data
-        list_hdls = [(self.datasets[name], hdl)
-                     for name, hdl in self.raw_datasets.items()]
+        # Calculate sample times (by repeatedly adding segment_time)
         initial_start_time = self.lmanager.get_initial_start_time()
-        start_time = t = self.lmanager.get_start_time()
+        start_time = self.lmanager.get_start_time()
         end_time = start_time + self.duration
-        while t < end_time:
-            t += self.segment_time
-            self.dataset_times.append(t - initial_start_time)
-            for dl, hdl in list_hdls:
-                dl.append(hdl.pull_data(t))
+        count = max(0, int((end_time - start_time) / self.segment_time) + 3)
+        times = numpy.full(count + 1, self.segment_time)
+        times[0] = start_time
+        times = numpy.add.accumulate(times)[1:]
+        if start_time < end_time:
+            times = times[:numpy.searchsorted(times, end_time) + 1]
+        else:
+            times = times[:0]
+        self.dataset_times = times - initial_start_time
+        # Generate raw data
+        for name, hdl in self.raw_datasets.items():
+            if hasattr(hdl, 'pull_data_array'):
+                self.datasets[name] = hdl.pull_data_array(times)
+            else:
+                self.datasets[name] = numpy.array([hdl.pull_data(t)
+                                                   for t in times])
         # Generate analyzer data
         for name, hdl in self.gen_datasets.items():
             self.datasets[name] = hdl.generate_data()
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+# Chunked, columnar storage of motion data logs
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, json, struct, array, bisect, zlib
+
+# File layout: MAGIC, a series of blocks, and (if the log was closed
+# cleanly) an index block followed by a trailer.  Each block starts with
+# a BLOCK_HDR (tag, header length, data length), followed by a JSON
+# header and the raw data.  Headers and columns are padded to 8 bytes
+# so that the columns can be memory mapped.
+LOG_SUFFIX = ".motan"
+MAGIC = b"MOTANCL1"
+END_MAGIC = b"MOTANEND"
+BLOCK_HDR = struct.Struct('<4sIQ')
+TRAILER = struct.Struct('<Q8s')
+TAG_META = b"META"
+TAG_CHUNK = b"CHNK"
+TAG_INDEX = b"INDX"
+
+# Chunks of a series are written once they span CHUNK_TIME seconds
+CHUNK_TIME = 1.0
+STATUS_CHUNK_TIME = 5.0
+MAX_CHUNK_ROWS = 1 << 16
+JSON_CHUNK_ROWS = 256
+
+NAN = float('nan')
+
+def _dtype(arr):
+    if arr.typecode in 'fd':
+        kind = 'f'
+    elif arr.typecode.isupper():
+        kind = 'u'
+    else:
+        kind = 'i'
+    return '<%s%d' % (kind, arr.itemsize)
+
+def _to_bytes(arr):
+    if sys.byteorder != 'little':
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    if hasattr(arr, 'tobytes'):
+        return arr.tobytes()
+    return arr.tostring()
+
+def _pad(data):
+    return data + b" " * (-len(data) % 8)
+
+
+######################################################################
+# Series storage
+######################################################################
+
+# Series types: {subscription id prefix: class, ...}
+SeriesTypes = {}
+
+# Base class for the storage of a subscription's messages.  Each series
+# type implements add() to append an API message to its columns and a
+# decode() classmethod to rebuild the messages from a stored chunk.
+class Series:
+    Columns = ()
+    ChunkTime = CHUNK_TIME
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+    def reset(self):
+        self.columns = [(cname, array.array(tc)) for cname, tc in self.Columns]
+        self.cols = dict(self.columns)
+        self.start_time = self.end_time = None
+        self.rows = 0
+        self.attrs = {}
+    def note_time(self, start_time, end_time):
+        if self.start_time is None:
+            self.start_time = start_time
+        self.end_time = max(end_time, self.end_time or end_time)
+    def is_empty(self):
+        return self.start_time is None
+    def is_full(self):
+        return (self.rows >= MAX_CHUNK_ROWS
+                or self.end_time - self.start_time >= self.ChunkTime)
+    def get_columns(self):
+        return self.columns
+
+def _split_rows(counts):
+    # Yield the (start, end) row range of each message
+    pos = 0
+    for count in counts:
+        yield pos, pos + count
+        pos += count
+
+class TrapQSeries(Series):
+    Columns = (
+        ('print_time', 'd'), ('move_t', 'd'), ('start_v', 'd'), ('accel', 'd'),
+        ('start_x', 'd'), ('start_y', 'd'), ('start_z', 'd'),
+        ('x_r', 'd'), ('y_r', 'd'), ('z_r', 'd'))
+    def add(self, params):
+        data = params['data']
+        if not data:
+            return
+        c = self.cols
+        for print_time, move_t, start_v, accel, start_pos, axes_r in data:
+            c['print_time'].append(print_time)
+            c['move_t'].append(move_t)
+            c['start_v'].append(start_v)
+            c['accel'].append(accel)
+            c['start_x'].append(start_pos[0])
+            c['start_y'].append(start_pos[1])
+            c['start_z'].append(start_pos[2])
+            c['x_r'].append(axes_r[0])
+            c['y_r'].append(axes_r[1])
+            c['z_r'].append(axes_r[2])
+        last = data[-1]
+        self.note_time(data[0][0], last[0] + last[1])
+        self.rows += len(data)
+    @classmethod
+    def decode(cls, header, cols):
+        pos = zip(cols['start_x'].tolist(), cols['start_y'].tolist(),
+                  cols['start_z'].tolist())
+        axes_r = zip(cols['x_r'].tolist(), cols['y_r'].tolist(),
+                     cols['z_r'].tolist())
+        data = list(zip(cols['print_time'].tolist(), cols['move_t'].tolist(),
+                        cols['start_v'].tolist(), cols['accel'].tolist(),
+                        pos, axes_r))
+        return [{'data': data}]
+SeriesTypes["trapq"] = TrapQSeries
+
+class StepQSeries(Series):
+    # Clocks and mcu positions are stored as doubles (exact up to 2^53)
+    MsgColumns = (
+        ('first_clock', 'd'), ('first_step_time', 'd'),
+        ('last_clock', 'd'), ('last_step_time', 'd'),
+        ('start_position', 'd'), ('start_mcu_position', 'd'),
+        ('step_distance', 'd'))
+    IntFields = ('first_clock', 'last_clock', 'start_mcu_position')
+    Columns = MsgColumns + (
+        ('msg_rows', 'I'), ('interval', 'I'), ('count', 'i'), ('add', 'i'))
+    def add(self, params):
+        data = params['data']
+        if not data:
+            return
+        c = self.cols
+        for cname, tc in self.MsgColumns:
+            c[cname].append(params[cname])
+        c['msg_rows'].append(len(data))
+        for interval, count, add in data:
+            c['interval'].append(interval)
+            c['count'].append(count)
+            c['add'].append(add)
+        self.note_time(params['first_step_time'], params['last_step_time'])
+        self.rows += len(data)
+    @classmethod
+    def decode(cls, header, cols):
+        msg_cols = [(cname, cols[cname].tolist())
+                    for cname, tc in cls.MsgColumns]
+        steps = list(zip(cols['interval'].tolist(), cols['count'].tolist(),
+                         cols['add'].tolist()))
+        msgs = []
+        for i, (start, end) in enumerate(_split_rows(cols['msg_rows'])):
+            msg = {cname: vals[i] for cname, vals in msg_cols}
+            for cname in cls.IntFields:
+                msg[cname] = int(msg[cname])
+            msg['data'] = steps[start:end]
+            msgs.append(msg)
+        return msgs
+SeriesTypes["stepq"] = StepQSeries
+
+# The accelerations are stored as floats (well above sensor resolution)
+class ADXL345Series(Series):
+    Columns = (('time', 'd'), ('accel_x', 'f'), ('accel_y', 'f'),
+               ('accel_z', 'f'))
+    def add(self, params):
+        data = params['data']
+        if not data:
+            return
+        c = self.cols
+        for t, x, y, z in data:
+            c['time'].append(t)
+            c['accel_x'].append(x)
+            c['accel_y'].append(y)
+            c['accel_z'].append(z)
+        self.note_time(data[0][0], data[-1][0])
+        self.rows += len(data)
+    @classmethod
+    def decode(cls, header, cols):
+        data = list(zip(cols['time'].tolist(), cols['accel_x'].tolist(),
+                        cols['accel_y'].tolist(), cols['accel_z'].tolist()))
+        return [{'data': data}]
+SeriesTypes["adxl345"] = ADXL345Series
+
+class AngleSeries(Series):
+    Columns = (('errors', 'I'), ('position_offset', 'd'), ('msg_rows', 'I'),
+               ('time', 'd'), ('angle', 'd'))
+    def add(self, params):
+        data = params['data']
+        if not data:
+            return
+        c = self.cols
+        c['errors'].append(params.get('errors', 0))
+        position_offset = params.get('position_offset')
+        if position_offset is None:
+            position_offset = NAN
+        c['position_offset'].append(position_offset)
+        c['msg_rows'].append(len(data))
+        for t, angle in data:
+            c['time'].append(t)
+            c['angle'].append(angle)
+        self.note_time(data[0][0], data[-1][0])
+        self.rows += len(data)
+    @classmethod
+    def decode(cls, header, cols):
+        samples = list(zip(cols['time'].tolist(),
+                           cols['angle'].astype('i8').tolist()))
+        errors = cols['errors'].tolist()
+        offsets = cols['position_offset'].tolist()
+        msgs = []
+        for i, (start, end) in enumerate(_split_rows(cols['msg_rows'])):
+            offset = offsets[i]
+            if offset != offset:
+                offset = None
+            msgs.append({'data': samples[start:end], 'errors': errors[i],
+                         'position_offset': offset})
+        return msgs
+SeriesTypes["angle"] = AngleSeries
+
+# Numeric status fields are stored as one column per field (with NaN
+# for no update) and any other updates are stored in the JSON header.
+# Each chunk also stores the accumulated changes to the initial status.
+class StatusSeries(Series):
+    Columns = (('eventtime', 'd'), ('print_time', 'd'))
+    ChunkTime = STATUS_CHUNK_TIME
+    def __init__(self, name):
+        self.initial_status = None
+        self.status = {}
+        self.print_time = 0.
+        Series.__init__(self, name)
+    def set_initial_status(self, status):
+        self.initial_status = json.loads(json.dumps(status))
+        self.status = json.loads(json.dumps(status))
+        th = status.get('toolhead', {})
+        self.print_time = th.get('estimated_print_time', self.print_time)
+    def reset(self):
+        Series.reset(self)
+        self.fields = {}
+        self.attrs = {'fields': [], 'other': [], 'snapshot': self._snapshot()}
+    def _snapshot(self):
+        if self.initial_status is None:
+            return {}
+        initial = self.initial_status
+        snapshot = {k: v for k, v in self.status.items() if initial.get(k) != v}
+        return json.loads(json.dumps(snapshot))
+    def _add_field(self, obj, field, value):
+        key = (obj, field)
+        field_info = self.fields.get(key)
+        if field_info is None:
+            col = array.array('d', [NAN] * (self.rows + 1))
+            cname = 'f%d' % (len(self.fields),)
+            field_info = [obj, field, type(value) is int]
+            self.fields[key] = (col, field_info)
+            self.columns.append((cname, col))
+            self.attrs['fields'].append(field_info)
+        col, field_info = self.fields[key]
+        if type(value) is not int:
+            field_info[2] = False
+        col[self.rows] = value
+    def add(self, params):
+        updates = params.get('status', {})
+        th = updates.get('toolhead', {})
+        self.print_time = th.get('estimated_print_time', self.print_time)
+        self.cols['eventtime'].append(params['eventtime'])
+        self.cols['print_time'].append(self.print_time)
+        for col, field_info in self.fields.values():
+            col.append(NAN)
+        other = {}
+        for obj, fields in updates.items():
+            self.status.setdefault(obj, {}).update(fields)
+            for field, value in fields.items():
+                if type(value) in (int, float):
+                    self._add_field(obj, field, value)
+                else:
+                    other.setdefault(obj, {})[field] = value
+        if other:
+            self.attrs['other'].append([self.rows, other])
+        self.note_time(self.print_time, self.print_time)
+        self.rows += 1
+    @classmethod
+    def decode(cls, header, cols):
+        attrs = header['attrs']
+        fields = [(obj, field, is_int, cols['f%d' % (i,)].tolist())
+                  for i, (obj, field, is_int) in enumerate(attrs['fields'])]
+        other = dict((row, upd) for row, upd in attrs['other'])
+        msgs = []
+        eventtimes = cols['eventtime'].tolist()
+        for row, eventtime in enumerate(eventtimes):
+            status = {}
+            for obj, field, is_int, vals in fields:
+                val = vals[row]
+                if val == val:
+                    if is_int:
+                        val = int(val)
+                    status.setdefault(obj, {})[field] = val
+            for obj, upd in other.get(row, {}).items():
+                status.setdefault(obj, {}).update(upd)
+            msgs.append({'eventtime': eventtime, 'status': status})
+        return msgs
+SeriesTypes["status"] = StatusSeries
+
+# Storage of messages from unknown subscriptions.  The message times
+# aren't known, so these chunks are untimed (no start_time or end_time)
+# and are written once they hold JSON_CHUNK_ROWS messages.
+class JsonSeries(Series):
+    def add(self, params):
+        self.attrs.setdefault('messages', []).append(params)
+        self.rows += 1
+    def is_empty(self):
+        return not self.rows
+    def is_full(self):
+        return self.rows >= JSON_CHUNK_ROWS
+    @classmethod
+    def decode(cls, header, cols):
+        return header['attrs'].get('messages', [])
+
+
+######################################################################
+# Log writing
+######################################################################
+
+class ColumnWriter:
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC)
+        self.file_pos = len(MAGIC)
+        self.series = {}
+        self.index = {'meta': [], 'chunks': []}
+    def _write_block(self, tag, header, columns=()):
+        data = []
+        col_info = []
+        offset = 0
+        for cname, arr in columns:
+            d = _pad(_to_bytes(arr))
+            col_info.append([cname, _dtype(arr), offset, len(arr)])
+            data.append(d)
+            offset += len(d)
+        if col_info:
+            header['columns'] = col_info
+        hdr = _pad(json.dumps(header, separators=(',', ':')).encode())
+        block_pos = self.file_pos
+        self.file.write(BLOCK_HDR.pack(tag, len(hdr), offset))
+        self.file.write(hdr)
+        for d in data:
+            self.file.write(d)
+        self.file_pos += BLOCK_HDR.size + len(hdr) + offset
+        return block_pos
+    def _flush_series(self, series):
+        if series.is_empty():
+            return
+        header = {'series': series.name, 'start_time': series.start_time,
+                  'end_time': series.end_time, 'rows': series.rows,
+                  'attrs': series.attrs}
+        block_pos = self._write_block(TAG_CHUNK, header, series.get_columns())
+        self.index['chunks'].append([series.name, block_pos, series.start_time,
+                                     series.end_time])
+        series.reset()
+    def add_meta(self, msg):
+        block_pos = self._write_block(TAG_META, msg)
+        self.index['meta'].append(block_pos)
+    def add_message(self, msg, raw_msg=None):
+        if msg is None:
+            msg = json.loads(raw_msg)
+        qid = msg.get('q')
+        if qid is None:
+            # Query responses are stored as metadata
+            self.add_meta(msg)
+            if msg.get('id') == 'status' and 'result' in msg:
+                series = self._lookup_series('status')
+                series.set_initial_status(msg['result']['status'])
+                series.reset()
+            return
+        series = self._lookup_series(qid)
+        series.add(msg['params'])
+        if not series.is_empty() and series.is_full():
+            self._flush_series(series)
+    def _lookup_series(self, qid):
+        series = self.series.get(qid)
+        if series is None:
+            cls = SeriesTypes.get(qid.split(':')[0], JsonSeries)
+            self.series[qid] = series = cls(qid)
+        return series
+    def flush(self):
+        for series in self.series.values():
+            self._flush_series(series)
+        self.file.flush()
+    def close(self):
+        self.flush()
+        index_pos = self._write_block(TAG_INDEX, self.index)
+        self.file.write(TRAILER.pack(index_pos, END_MAGIC))
+        self.file.close()
+        self.file = None
+
+
+######################################################################
+# Log reading
+######################################################################
+
+class ColumnLogReader:
+    def __init__(self, filename):
+        import numpy
+        self.numpy = numpy
+        self.data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+        if self.data[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError("File '%s' is not a motan log" % (filename,))
+        index = self._read_index()
+        if index is None:
+            index = self._scan_index()
+        self.meta = [self._read_block(pos)[1] for pos in index['meta']]
+        # Per series chunk lists: {series: ([end_time, ...], [pos, ...],
+        #                                   [start_time, ...])}
+        self.chunks = {}
+        for name, block_pos, start_time, end_time in index['chunks']:
+            end_times, positions, start_times = self.chunks.setdefault(
+                name, ([], [], []))
+            end_times.append(end_time)
+            positions.append(block_pos)
+            start_times.append(start_time)
+    def _read_block(self, pos):
+        tag, hlen, dlen = BLOCK_HDR.unpack(
+            self.data[pos:pos+BLOCK_HDR.size].tobytes())
+        hpos = pos + BLOCK_HDR.size
+        header = json.loads(self.data[hpos:hpos+hlen].tobytes().decode())
+        return tag, header, hpos + hlen, dlen
+    def _read_index(self):
+        size = len(self.data)
+        if size < len(MAGIC) + TRAILER.size:
+            return None
+        index_pos, end_magic = TRAILER.unpack(
+            self.data[size-TRAILER.size:].tobytes())
+        if end_magic != END_MAGIC:
+            return None
+        tag, header, data_pos, dlen = self._read_block(index_pos)
+        return header
+    def _scan_index(self):
+        # Rebuild the index of a log that was not closed cleanly
+        index = {'meta': [], 'chunks': []}
+        pos = len(MAGIC)
+        size = len(self.data)
+        while pos + BLOCK_HDR.size <= size:
+            try:
+                tag, header, data_pos, dlen = self._read_block(pos)
+            except ValueError:
+                break
+            if data_pos + dlen > size:
+                break
+            if tag == TAG_META:
+                index['meta'].append(pos)
+            elif tag == TAG_CHUNK:
+                index['chunks'].append([header['series'], pos,
+                                        header['start_time'],
+                                        header['end_time']])
+            pos = data_pos + dlen
+        return index
+    def get_meta(self):
+        return self.meta
+    def get_series_names(self):
+        return list(self.chunks.keys())
+    def get_chunk_count(self, series):
+        return len(self.chunks.get(series, ([], [], []))[1])
+    def get_chunk_start_time(self, series, chunk_idx):
+        # Returns None for the chunks of an untimed series
+        return self.chunks[series][2][chunk_idx]
+    def is_timed(self, series):
+        end_times = self.chunks.get(series, ([], [], []))[0]
+        return not end_times or end_times[0] is not None
+    def find_chunk(self, series, req_time):
+        # Return the index of the first chunk ending at or after req_time
+        # (untimed series can't be seeked and always start at the first)
+        if not self.is_timed(series):
+            return 0
+        end_times = self.chunks.get(series, ([], [], []))[0]
+        return bisect.bisect_left(end_times, req_time)
+    def read_chunk(self, series, chunk_idx):
+        # Return the chunk header and a {name: array} dict of its columns
+        # (the arrays are read-only views of the memory mapped file)
+        block_pos = self.chunks[series][1][chunk_idx]
+        tag, header, data_pos, dlen = self._read_block(block_pos)
+        cols = {}
+        for cname, dtype, offset, count in header.get('columns', []):
+            cols[cname] = self.numpy.frombuffer(
+                self.data, dtype=dtype, count=count, offset=data_pos + offset)
+        return header, cols
+    def read_messages(self, series, chunk_idx):
+        # Return the chunk contents in the format of the API messages.
+        # This rebuilds per-sample Python lists and is only intended for
+        # the message based readlog handlers - code that processes the
+        # samples in bulk should use read_chunk() and the numpy arrays.
+        header, cols = self.read_chunk(series, chunk_idx)
+        cls = SeriesTypes.get(series.split(':')[0], JsonSeries)
+        return header, cls.decode(header, cols)
+
+
+######################################################################
+# Conversion of logs in the original (json.gz) format
+######################################################################
+
+def convert_json_log(log_prefix, out_filename):
+    writer = ColumnWriter(out_filename)
+    f = open(log_prefix + ".json.gz", "rb")
+    comp = zlib.decompressobj(31)
+    partial = b""
+    while 1:
+        raw_data = f.read(65536)
+        if not raw_data:
+            break
+        parts = comp.decompress(raw_data).split(b'\x03')
+        parts[0] = partial + parts[0]
+        partial = parts.pop()
+        for part in parts:
+            try:
+                msg = json.loads(part)
+            except ValueError:
+                sys.stderr.write("Unable to parse message\n")
+                continue
+            writer.add_message(msg)
+    f.close()
+    writer.close()
+
+def main():
+    usage = "%prog [options] <log name>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-o", "--output", type="string", dest="output",
+                    default=None, help="filename of converted log")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    log_prefix = args[0]
+    out_filename = options.output
+    if out_filename is None:
+        out_filename = log_prefix + LOG_SUFFIX
+    if os.path.exists(out_filename):
+        opts.error("File '%s' already exists" % (out_filename,))
+    convert_json_log(log_prefix, out_filename)
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,17 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, optparse, socket, select, json, errno, time, zlib
+import threading
+import columnlog
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 INDEX_UPDATE_TIME = 5.0
+WRITE_QUEUE_SIZE = 1024
+STATS_UPDATE_TIME = 5.0
+LAG_WARN_TIME = 1.0
 ClientInfo = {'program': 'motan_data_logger', 'version': 'v0.1'}
 
 def webhook_socket_create(uds_filename):
@@ -29,16 +38,17 @@ def webhook_socket_create(uds_filename):
     return sock
 
 class LogWriter:
-    def __init__(self, filename):
+    def __init__(self, filename, level=zlib.Z_DEFAULT_COMPRESSION):
         self.file = open(filename, "wb")
-        self.comp = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                                     zlib.DEFLATED, 31)
+        self.comp = zlib.compressobj(level, zlib.DEFLATED, 31)
         self.raw_pos = self.file_pos = 0
     def add_data(self, data):
         d = self.comp.compress(data + b"\x03")
         self.file.write(d)
         self.file_pos += len(d)
         self.raw_pos += len(data) + 1
+    def add_message(self, msg, raw_msg):
+        self.add_data(raw_msg)
     def flush(self, flag=zlib.Z_FULL_FLUSH):
         if not self.raw_pos:
             return self.file_pos
@@ -52,16 +62,105 @@ class LogWriter:
         self.file = None
         self.comp = None
 
+# Compress and write log messages in a background thread so that the
+# webhooks socket is always read promptly
+class BackgroundWriter:
+    def __init__(self, logger, index):
+        self.logger = logger
+        self.index = index
+        self.queue = queue.Queue(WRITE_QUEUE_SIZE)
+        self.write_error = None
+        # Statistics
+        self.lock = threading.Lock()
+        self.written = self.dropped = self.last_dropped = 0
+        self.drops = {}
+        self.max_lag = 0.
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    def _run(self):
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                break
+            recv_time, msg, raw_msg = item
+            try:
+                if raw_msg is None:
+                    # Index update
+                    msg['file_position'] = self.logger.flush()
+                    self.index.add_data(
+                        json.dumps(msg, separators=(',', ':')).encode())
+                else:
+                    self.logger.add_message(msg, raw_msg)
+            except Exception as e:
+                self.write_error = str(e)
+                break
+            lag = time.time() - recv_time
+            with self.lock:
+                self.written += 1
+                self.max_lag = max(self.max_lag, lag)
+    def add_message(self, msg, raw_msg, drop_id=None):
+        # Messages with a drop_id are discarded if the queue is full
+        item = (time.time(), msg, raw_msg)
+        if drop_id is None:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            self.drops[drop_id] = self.drops.get(drop_id, 0) + 1
+    def add_index(self, db):
+        self.queue.put((time.time(), db, None))
+    def get_stats(self):
+        with self.lock:
+            written, max_lag = self.written, self.max_lag
+            self.max_lag = 0.
+        dropped = self.dropped - self.last_dropped
+        self.last_dropped = self.dropped
+        return {'queued': self.queue.qsize(), 'written': written,
+                'dropped': dropped, 'max_lag': max_lag}
+    def get_drops(self):
+        return dict(self.drops)
+    def check_error(self):
+        return self.write_error
+    def close(self):
+        if self.write_error is None:
+            self.queue.put(None)
+            self.thread.join()
+        self.logger.close()
+        if self.index is not None:
+            self.index.close()
+
+# Extract the subscription id from a raw async message (without
+# parsing the full message)
+def get_raw_qid(raw_msg):
+    if not raw_msg.startswith(b'{"q":"'):
+        return None
+    end = raw_msg.find(b'"', 6)
+    if end < 0 or raw_msg[end-1:end] == b"\\":
+        return None
+    return raw_msg[6:end].decode()
+
 class DataLogger:
-    def __init__(self, uds_filename, log_prefix):
+    def __init__(self, uds_filename, log_prefix, log_format="motan",
+                 compress_level=zlib.Z_DEFAULT_COMPRESSION):
         # IO
         self.webhook_socket = webhook_socket_create(uds_filename)
         self.poll = select.poll()
         self.poll.register(self.webhook_socket, select.POLLIN | select.POLLHUP)
         self.socket_data = b""
         # Data log
-        self.logger = LogWriter(log_prefix + ".json.gz")
-        self.index = LogWriter(log_prefix + ".index.gz")
+        if log_format == "json":
+            logger = LogWriter(log_prefix + ".json.gz", compress_level)
+            index = LogWriter(log_prefix + ".index.gz", compress_level)
+        else:
+            # Columnar logs contain their own time index
+            logger = columnlog.ColumnWriter(log_prefix + columnlog.LOG_SUFFIX)
+            index = None
+        self.has_index = index is not None
+        self.writer = BackgroundWriter(logger, index)
+        self.next_stats_time = time.time() + STATS_UPDATE_TIME
         # Handlers
         self.query_handlers = {}
         self.async_handlers = {}
@@ -75,8 +174,12 @@ class DataLogger:
         sys.stderr.write(msg + "\n")
     def finish(self, msg):
         self.error(msg)
-        self.logger.close()
-        self.index.close()
+        self.writer.close()
+        stats = self.writer.get_stats()
+        drops = self.writer.get_drops()
+        self.error("Wrote %d messages, dropped %d%s" % (
+            stats['written'], sum(drops.values()),
+            "".join([" %s=%d" % (k, v) for k, v in sorted(drops.items())])))
         sys.exit(0)
     # Unix Domain Socket IO
     def send_query(self, msg_id, method, params, cb):
@@ -85,19 +188,24 @@ class DataLogger:
         cm = json.dumps(msg, separators=(',', ':')).encode()
         self.webhook_socket.send(cm + b"\x03")
     def process_socket(self):
-        data = self.webhook_socket.recv(4096)
+        data = self.webhook_socket.recv(65536)
         if not data:
             self.finish("Socket closed")
         parts = data.split(b"\x03")
         parts[0] = self.socket_data + parts[0]
         self.socket_data = parts.pop()
         for part in parts:
+            # Bulk data is only parsed by the writer thread (if needed)
+            qid = get_raw_qid(part)
+            if qid is not None and qid not in self.async_handlers:
+                self.writer.add_message(None, part, qid)
+                continue
             try:
                 msg = json.loads(part)
             except:
                 self.error("ERROR: Unable to parse line")
                 continue
-            self.logger.add_data(part)
+            self.writer.add_message(msg, part)
             msg_q = msg.get("q")
             if msg_q is not None:
                 hdl = self.async_handlers.get(msg_q)
@@ -120,8 +228,20 @@ class DataLogger:
                 for fd, event in res:
                     if fd == self.webhook_socket.fileno():
                         self.process_socket()
+                if time.time() >= self.next_stats_time:
+                    self.check_stats()
         except KeyboardInterrupt as e:
             self.finish("Keyboard Interrupt")
+    def check_stats(self):
+        self.next_stats_time = time.time() + STATS_UPDATE_TIME
+        write_error = self.writer.check_error()
+        if write_error is not None:
+            self.finish("ERROR: Unable to write log: %s" % (write_error,))
+        stats = self.writer.get_stats()
+        if stats['dropped'] or stats['max_lag'] > LAG_WARN_TIME:
+            self.error("Writer falling behind: queued=%d dropped=%d"
+                       " max_lag=%.3f" % (stats['queued'], stats['dropped'],
+                                          stats['max_lag']))
     # Query response handlers
     def send_subscribe(self, msg_id, method, params, cb=None, async_cb=None):
         if cb is None:
@@ -169,8 +289,9 @@ class DataLogger:
             return
         self.db.setdefault("subscriptions", {})[msg_id] = msg["result"]
     def flush_index(self):
-        self.db['file_position'] = self.logger.flush()
-        self.index.add_data(json.dumps(self.db, separators=(',', ':')).encode())
+        if not self.has_index:
+            return
+        self.writer.add_index(self.db)
         self.db = {"status": {}}
     def handle_async_db(self, msg, raw_msg):
         params = msg["params"]
@@ -192,12 +313,21 @@ def nice():
 def main():
     usage = "%prog [options] <socket filename> <log name>"
     opts = optparse.OptionParser(usage)
+    opts.add_option("-f", "--format", type="choice", dest="format",
+                    choices=["motan", "json"], default="motan",
+                    help="log file format (motan or json)")
+    opts.add_option("-c", "--compress-level", type="int", dest="level",
+                    default=zlib.Z_DEFAULT_COMPRESSION,
+                    help="json format compression level (1=fast, 9=best)")
     options, args = opts.parse_args()
     if len(args) != 2:
         opts.error("Incorrect number of arguments")
+    if options.level != zlib.Z_DEFAULT_COMPRESSION and not (
+            0 <= options.level <= 9):
+        opts.error("Invalid compression level")
 
     nice()
-    dl = DataLogger(args[0], args[1])
+    dl = DataLogger(args[0], args[1], options.format, options.level)
     dl.run()
 
 if __name__ == '__main__':
@@ -3,7 +3,9 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib
+import os, json, zlib, logging, collections
+import numpy
+import columnlog
 
 class error(Exception):
     pass
@@ -41,6 +43,17 @@ class HandleStatusField:
         self.result = db.get(self.field_parts[-1], 0.)
         self.next_update_time = next_update_time
         return self.result
+    def pull_data_array(self, req_times):
+        results = []
+        counts = []
+        pos = 0
+        while pos < len(req_times):
+            results.append(self.pull_data(req_times[pos]))
+            end = numpy.searchsorted(req_times, self.next_update_time, 'left')
+            end = max(end, pos + 1)
+            counts.append(end - pos)
+            pos = end
+        return numpy.repeat(results, counts)
 LogHandlers["status"] = HandleStatusField
 
 # Extract requested position, velocity, and accel from a trapq log
@@ -58,6 +71,7 @@ class HandleTrapQ:
         self.name = name
         self.jdispatch = lmanager.get_jdispatch()
         self.cur_data = [(0., 0., 0., 0., (0., 0., 0.), (0., 0., 0.))]
+        self.cur_moves = None
         self.data_pos = 0
         tq, trapq_name, datasel = name_parts
         ptypes = {}
@@ -88,57 +102,110 @@ class HandleTrapQ:
             raise error("Unknown trapq data selection '%s'" % (datasel,))
         self.label = {'label': pinfo['label'], 'units': pinfo['units']}
         self.axis = pinfo.get('axis')
-        self.pull_data = pinfo['func']
+        self.pull_data_array = pinfo['func']
     def get_label(self):
         return self.label
-    def _find_move(self, req_time):
-        data_pos = self.data_pos
+    def pull_data(self, req_time):
+        return self.pull_data_array(numpy.array([req_time]))[0]
+    def _get_moves(self):
+        # Return the current moves as an array of (print_time, move_t,
+        # start_v, accel, start_x, start_y, start_z, x_r, y_r, z_r) rows
+        if self.cur_moves is None:
+            self.cur_moves = numpy.array([tuple(m[:4]) + tuple(m[4])
+                                          + tuple(m[5])
+                                          for m in self.cur_data])
+        return self.cur_moves
+    def _find_moves(self, req_times):
+        # Find the move active at each requested time - returns the
+        # parameters of each found move and if the time is in its range
+        count = len(req_times)
+        moves = numpy.empty((count, 10))
+        in_range = numpy.zeros(count, dtype=bool)
+        pos = 0
         while 1:
-            move = self.cur_data[data_pos]
-            print_time, move_t, start_v, accel, start_pos, axes_r = move
-            if req_time <= print_time + move_t:
-                return move, req_time >= print_time
-            data_pos += 1
-            if data_pos < len(self.cur_data):
-                self.data_pos = data_pos
-                continue
-            jmsg = self.jdispatch.pull_msg(req_time, self.name)
-            if jmsg is None:
-                return move, False
+            cur_moves = self._get_moves()[self.data_pos:]
+            end_times = numpy.maximum.accumulate(cur_moves[:,0]
+                                                 + cur_moves[:,1])
+            end = numpy.searchsorted(req_times, end_times[-1], 'right')
+            if end > pos:
+                idx = numpy.searchsorted(end_times, req_times[pos:end], 'left')
+                found = cur_moves[idx]
+                moves[pos:end] = found
+                in_range[pos:end] = req_times[pos:end] >= found[:,0]
+                self.data_pos += idx[-1]
+                pos = end
+            if pos >= count:
+                return moves, in_range
+            # Read next data block (use last move until one is available)
+            self.data_pos = len(self.cur_data) - 1
+            while 1:
+                jmsg = self.jdispatch.pull_msg(req_times[pos], self.name)
+                if jmsg is not None:
+                    break
+                moves[pos] = cur_moves[-1]
+                pos += 1
+                if pos >= count:
+                    return moves, in_range
             self.cur_data = jmsg['data']
-            self.data_pos = data_pos = 0
-    def _pull_axis_position(self, req_time):
-        move, in_range = self._find_move(req_time)
-        print_time, move_t, start_v, accel, start_pos, axes_r = move
-        mtime = max(0., min(move_t, req_time - print_time))
-        dist = (start_v + .5 * accel * mtime) * mtime;
-        return start_pos[self.axis] + axes_r[self.axis] * dist
-    def _pull_axis_velocity(self, req_time):
-        move, in_range = self._find_move(req_time)
-        if not in_range:
-            return 0.
-        print_time, move_t, start_v, accel, start_pos, axes_r = move
-        return (start_v + accel * (req_time - print_time)) * axes_r[self.axis]
-    def _pull_axis_accel(self, req_time):
-        move, in_range = self._find_move(req_time)
-        if not in_range:
-            return 0.
-        print_time, move_t, start_v, accel, start_pos, axes_r = move
-        return accel * axes_r[self.axis]
-    def _pull_velocity(self, req_time):
-        move, in_range = self._find_move(req_time)
-        if not in_range:
-            return 0.
-        print_time, move_t, start_v, accel, start_pos, axes_r = move
-        return start_v + accel * (req_time - print_time)
-    def _pull_accel(self, req_time):
-        move, in_range = self._find_move(req_time)
-        if not in_range:
-            return 0.
-        print_time, move_t, start_v, accel, start_pos, axes_r = move
-        return accel
+            self.cur_moves = None
+            self.data_pos = 0
+    def _pull_axis_position(self, req_times):
+        moves, in_range = self._find_moves(req_times)
+        print_time, move_t, start_v, accel = moves[:,:4].T
+        mtime = numpy.maximum(0., numpy.minimum(move_t, req_times - print_time))
+        dist = (start_v + .5 * accel * mtime) * mtime
+        return moves[:,4+self.axis] + moves[:,7+self.axis] * dist
+    def _pull_axis_velocity(self, req_times):
+        moves, in_range = self._find_moves(req_times)
+        print_time, move_t, start_v, accel = moves[:,:4].T
+        axis_r = moves[:,7+self.axis]
+        velocity = (start_v + accel * (req_times - print_time)) * axis_r
+        return numpy.where(in_range, velocity, 0.)
+    def _pull_axis_accel(self, req_times):
+        moves, in_range = self._find_moves(req_times)
+        return numpy.where(in_range, moves[:,3] * moves[:,7+self.axis], 0.)
+    def _pull_velocity(self, req_times):
+        moves, in_range = self._find_moves(req_times)
+        print_time, move_t, start_v, accel = moves[:,:4].T
+        velocity = start_v + accel * (req_times - print_time)
+        return numpy.where(in_range, velocity, 0.)
+    def _pull_accel(self, req_times):
+        moves, in_range = self._find_moves(req_times)
+        return numpy.where(in_range, moves[:,3], 0.)
 LogHandlers["trapq"] = HandleTrapQ
 
+# Calculate the time and direction of each step in a queue_step block
+def calc_step_block(jmsg):
+    data = numpy.array(jmsg['data'], dtype=numpy.int64).reshape(-1, 3)
+    intervals, raw_counts, adds = data.T
+    counts = numpy.abs(raw_counts)
+    first_time = jmsg['first_step_time']
+    first_clock = jmsg['first_clock']
+    cdiff = jmsg['last_clock'] - first_clock
+    tdiff = jmsg['last_step_time'] - first_time
+    inv_freq = 0.
+    if cdiff:
+        inv_freq = tdiff / cdiff
+    # Clock of each step (relative to first_clock)
+    block_clocks = counts * intervals + adds * counts * (counts - 1) // 2
+    block_starts = numpy.cumsum(block_clocks) - block_clocks - intervals[0]
+    block = numpy.repeat(numpy.arange(len(counts)), counts)
+    step_offsets = numpy.cumsum(counts) - counts
+    i = numpy.arange(len(block)) - step_offsets[block]
+    step_clocks = (block_starts[block] + (i + 1) * intervals[block]
+                   + adds[block] * i * (i + 1) // 2)
+    step_times = first_time + step_clocks.astype(numpy.float64) * inv_freq
+    return step_times, numpy.sign(raw_counts)[block]
+
+# Find the step active at each requested time (the last step time that
+# is not after the requested time) starting from the given step index.
+# Returns the number of times found and the step index for those times.
+def find_steps(step_times, data_pos, req_times):
+    next_times = numpy.maximum.accumulate(step_times[data_pos+1:])
+    count = numpy.searchsorted(req_times, next_times[-1], 'left')
+    idx = numpy.searchsorted(next_times, req_times[:count], 'right')
+    return count, idx + data_pos
+
 # Extract positions from queue_step log
 class HandleStepQ:
     SubscriptionIdParts = 2
@@ -152,7 +219,10 @@ class HandleStepQ:
         self.name = name
         self.stepper_name = name_parts[1]
         self.jdispatch = lmanager.get_jdispatch()
-        self.step_data = [(0., 0., 0.), (0., 0., 0.)] # [(time, half_pos, pos)]
+        # Step (time, half_pos, pos) arrays
+        self.step_times = numpy.zeros(2)
+        self.step_halfpos = numpy.zeros(2)
+        self.step_pos = numpy.zeros(2)
         self.data_pos = 0
         self.smooth_time = 0.010
         if len(name_parts) == 3:
@@ -164,74 +234,72 @@ class HandleStepQ:
         label = '%s position' % (self.stepper_name,)
         return {'label': label, 'units': 'Position\n(mm)'}
     def pull_data(self, req_time):
-        smooth_time = self.smooth_time
+        return self.pull_data_array(numpy.array([req_time]))[0]
+    def pull_data_array(self, req_times):
+        count = len(req_times)
+        res = numpy.empty(count)
+        pos = 0
         while 1:
-            data_pos = self.data_pos
-            step_data = self.step_data
-            # Find steps before and after req_time
-            next_time, next_halfpos, next_pos = step_data[data_pos + 1]
-            if req_time >= next_time:
-                if data_pos + 2 < len(step_data):
-                    self.data_pos = data_pos + 1
-                    continue
-                self._pull_block(req_time)
-                continue
-            last_time, last_halfpos, last_pos = step_data[data_pos]
-            # Perform step smoothing
-            rtdiff = req_time - last_time
-            stime = next_time - last_time
-            if stime <= smooth_time:
-                pdiff = next_halfpos - last_halfpos
-                return last_halfpos + rtdiff * pdiff / stime
-            stime = .5 * smooth_time
-            if rtdiff < stime:
-                pdiff = last_pos - last_halfpos
-                return last_halfpos + rtdiff * pdiff / stime
-            rtdiff = next_time - req_time
-            if rtdiff < stime:
-                pdiff = last_pos - next_halfpos
-                return next_halfpos + rtdiff * pdiff / stime
-            return last_pos
+            # Find steps before and after each req_time
+            num, idx = find_steps(self.step_times, self.data_pos,
+                                  req_times[pos:])
+            if num:
+                self.data_pos = idx[-1]
+                res[pos:pos+num] = self._smooth(req_times[pos:pos+num], idx)
+                pos += num
+            if pos >= count:
+                return res
+            self._pull_block(req_times[pos])
+    def _smooth(self, req_times, idx):
+        # Perform step smoothing
+        smooth_time = self.smooth_time
+        last_time = self.step_times[idx]
+        next_time = self.step_times[idx + 1]
+        last_halfpos = self.step_halfpos[idx]
+        next_halfpos = self.step_halfpos[idx + 1]
+        last_pos = self.step_pos[idx]
+        rtdiff = req_times - last_time
+        stime = next_time - last_time
+        hstime = .5 * smooth_time
+        next_rtdiff = next_time - req_times
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            pdiff = next_halfpos - last_halfpos
+            res = last_halfpos + rtdiff * pdiff / stime
+            pdiff = last_pos - last_halfpos
+            start_res = last_halfpos + rtdiff * pdiff / hstime
+            pdiff = last_pos - next_halfpos
+            end_res = next_halfpos + next_rtdiff * pdiff / hstime
+        is_long = stime > smooth_time
+        res = numpy.where(is_long, last_pos, res)
+        res = numpy.where(is_long & (next_rtdiff < hstime), end_res, res)
+        return numpy.where(is_long & (rtdiff < hstime), start_res, res)
     def _pull_block(self, req_time):
-        step_data = self.step_data
-        del step_data[:-1]
+        last_time = self.step_times[-1]
+        last_halfpos = self.step_halfpos[-1]
+        last_pos = self.step_pos[-1]
         self.data_pos = 0
         # Read data block containing requested time frame
         while 1:
             jmsg = self.jdispatch.pull_msg(req_time, self.name)
             if jmsg is None:
-                last_time, last_halfpos, last_pos = step_data[0]
-                self.step_data.append((req_time + .1, last_pos, last_pos))
+                self.step_times = numpy.array([last_time, req_time + .1])
+                self.step_halfpos = numpy.array([last_halfpos, last_pos])
+                self.step_pos = numpy.array([last_pos, last_pos])
                 return
-            last_time = jmsg['last_step_time']
-            if req_time <= last_time:
+            if req_time <= jmsg['last_step_time']:
                 break
-        # Process block into (time, half_position, position) 3-tuples
-        first_time = step_time = jmsg['first_step_time']
-        first_clock = jmsg['first_clock']
-        step_clock = first_clock - jmsg['data'][0][0]
-        cdiff = jmsg['last_clock'] - first_clock
-        tdiff = last_time - first_time
-        inv_freq = 0.
-        if cdiff:
-            inv_freq = tdiff / cdiff
-        step_dist = jmsg['step_distance']
+        # Process block into (time, half_position, position) arrays
+        step_times, step_dirs = calc_step_block(jmsg)
+        step_dist = step_dirs * jmsg['step_distance']
         step_pos = jmsg['start_position']
-        if not step_data[0][0]:
-            step_data[0] = (0., step_pos, step_pos)
-        for interval, raw_count, add in jmsg['data']:
-            qs_dist = step_dist
-            count = raw_count
-            if count < 0:
-                qs_dist = -qs_dist
-                count = -count
-            for i in range(count):
-                step_clock += interval
-                interval += add
-                step_time = first_time + (step_clock - first_clock) * inv_freq
-                step_halfpos = step_pos + .5 * qs_dist
-                step_pos += qs_dist
-                step_data.append((step_time, step_halfpos, step_pos))
+        if not last_time:
+            last_halfpos = last_pos = step_pos
+        positions = numpy.add.accumulate(numpy.concatenate((
+            [step_pos], step_dist)))
+        step_halfpos = positions[:-1] + .5 * step_dist
+        self.step_times = numpy.concatenate(([last_time], step_times))
+        self.step_halfpos = numpy.concatenate(([last_halfpos], step_halfpos))
+        self.step_pos = numpy.concatenate(([last_pos], positions[1:]))
 LogHandlers["stepq"] = HandleStepQ
 
 # Extract stepper motor phase position
@@ -260,8 +328,9 @@ class HandleStepPhase:
             self.phases *= 4
         self.jdispatch = lmanager.get_jdispatch()
         self.jdispatch.add_handler(name, "stepq:" + self.stepper_name)
-        # stepq tracking
-        self.step_data = [(0., 0), (0., 0)] # [(time, mcu_pos)]
+        # stepq tracking (time, mcu_pos) arrays
+        self.step_times = numpy.zeros(2)
+        self.step_pos = numpy.zeros(2, dtype=numpy.int64)
         self.data_pos = 0
         # driver phase tracking
         self.status_tracker = lmanager.get_status_tracker()
@@ -279,59 +348,56 @@ class HandleStepPhase:
             mcu_phase_offset = 0
         self.mcu_phase_offset = mcu_phase_offset
     def pull_data(self, req_time):
-        if req_time >= self.next_status_time:
-            self._pull_phase_offset(req_time)
+        return self.pull_data_array(numpy.array([req_time]))[0]
+    def pull_data_array(self, req_times):
+        count = len(req_times)
+        res = numpy.empty(count, dtype=numpy.int64)
+        pos = 0
+        while pos < count:
+            if req_times[pos] >= self.next_status_time:
+                self._pull_phase_offset(req_times[pos])
+            end = numpy.searchsorted(req_times, self.next_status_time, 'left')
+            end = max(end, pos + 1)
+            step_pos = self._pull_steps(req_times[pos:end])
+            res[pos:end] = (step_pos - self.mcu_phase_offset) % self.phases
+            pos = end
+        return res
+    def _pull_steps(self, req_times):
+        count = len(req_times)
+        res = numpy.empty(count, dtype=numpy.int64)
+        pos = 0
         while 1:
-            data_pos = self.data_pos
-            step_data = self.step_data
-            # Find steps before and after req_time
-            next_time, next_pos = step_data[data_pos + 1]
-            if req_time >= next_time:
-                if data_pos + 2 < len(step_data):
-                    self.data_pos = data_pos + 1
-                    continue
-                self._pull_block(req_time)
-                continue
-            step_pos = step_data[data_pos][1]
-            return (step_pos - self.mcu_phase_offset) % self.phases
+            # Find steps before and after each req_time
+            num, idx = find_steps(self.step_times, self.data_pos,
+                                  req_times[pos:])
+            if num:
+                self.data_pos = idx[-1]
+                res[pos:pos+num] = self.step_pos[idx]
+                pos += num
+            if pos >= count:
+                return res
+            self._pull_block(req_times[pos])
     def _pull_block(self, req_time):
-        step_data = self.step_data
-        del step_data[:-1]
+        last_time = self.step_times[-1]
+        last_pos = self.step_pos[-1]
         self.data_pos = 0
         # Read data block containing requested time frame
         while 1:
             jmsg = self.jdispatch.pull_msg(req_time, self.name)
             if jmsg is None:
-                last_time, last_pos = step_data[0]
-                self.step_data.append((req_time + .1, last_pos))
+                self.step_times = numpy.array([last_time, req_time + .1])
+                self.step_pos = numpy.array([last_pos, last_pos])
                 return
-            last_time = jmsg['last_step_time']
-            if req_time <= last_time:
+            if req_time <= jmsg['last_step_time']:
                 break
-        # Process block into (time, position) 2-tuples
-        first_time = step_time = jmsg['first_step_time']
-        first_clock = jmsg['first_clock']
-        step_clock = first_clock - jmsg['data'][0][0]
-        cdiff = jmsg['last_clock'] - first_clock
-        tdiff = last_time - first_time
-        inv_freq = 0.
-        if cdiff:
-            inv_freq = tdiff / cdiff
+        # Process block into (time, position) arrays
+        step_times, step_dirs = calc_step_block(jmsg)
         step_pos = jmsg['start_mcu_position']
-        if not step_data[0][0]:
-            step_data[0] = (0., step_pos)
-        for interval, raw_count, add in jmsg['data']:
-            qs_dist = 1
-            count = raw_count
-            if count < 0:
-                qs_dist = -1
-                count = -count
-            for i in range(count):
-                step_clock += interval
-                interval += add
-                step_time = first_time + (step_clock - first_clock) * inv_freq
-                step_pos += qs_dist
-                step_data.append((step_time, step_pos))
+        if not last_time:
+            last_pos = step_pos
+        positions = step_pos + numpy.cumsum(step_dirs)
+        self.step_times = numpy.concatenate(([last_time], step_times))
+        self.step_pos = numpy.concatenate(([last_pos], positions))
 LogHandlers["step_phase"] = HandleStepPhase
 
 # Extract accelerometer data
@@ -483,13 +549,13 @@ class JsonDispatcher:
     def check_end_of_data(self):
         return self.is_eof and not any(self.queues.values())
     def add_handler(self, name, subscription_id):
-        self.names[name] = q = []
+        self.names[name] = q = collections.deque()
         self.queues.setdefault(subscription_id, []).append(q)
     def pull_msg(self, req_time, name):
         q = self.names[name]
         while 1:
             if q:
-                return q.pop(0)
+                return q.popleft()
             if req_time + 1. < self.last_read_time:
                 return None
             json_msg = self.log_reader.pull_msg()
@@ -504,6 +570,43 @@ class JsonDispatcher:
             for mq in self.queues.get(qid, []):
                 mq.append(json_msg['params'])
 
+# Load chunks of a columnar log as handlers request them
+class ColumnDispatcher:
+    def __init__(self, log_prefix):
+        self.log_reader = columnlog.ColumnLogReader(
+            log_prefix + columnlog.LOG_SUFFIX)
+        self.cursors = {}
+        self.seek_time = 0.
+    def set_seek_time(self, seek_time):
+        self.seek_time = seek_time
+    def check_end_of_data(self):
+        lr = self.log_reader
+        return not any(q or chunk_idx < lr.get_chunk_count(series)
+                       for series, chunk_idx, q in self.cursors.values())
+    def add_handler(self, name, subscription_id):
+        lr = self.log_reader
+        chunk_idx = lr.find_chunk(subscription_id, self.seek_time)
+        if subscription_id == "status":
+            chunk_idx = max(0, min(chunk_idx,
+                                   lr.get_chunk_count(subscription_id) - 1))
+        self.cursors[name] = [subscription_id, chunk_idx,
+                              collections.deque()]
+    def pull_msg(self, req_time, name):
+        cursor = self.cursors[name]
+        series, chunk_idx, q = cursor
+        while 1:
+            if q:
+                return q.popleft()
+            if chunk_idx >= self.log_reader.get_chunk_count(series):
+                return None
+            lr = self.log_reader
+            start_time = lr.get_chunk_start_time(series, chunk_idx)
+            if start_time is not None and start_time > req_time + 1.:
+                return None
+            header, msgs = lr.read_messages(series, chunk_idx)
+            cursor[1] = chunk_idx = chunk_idx + 1
+            q.extend(msgs)
+
 
 ######################################################################
 # Dataset and log tracking
@@ -515,7 +618,7 @@ class TrackStatus:
         self.name = name
         self.jdispatch = lmanager.get_jdispatch()
         self.next_status_time = 0.
-        self.status = dict(start_status)
+        self.status = {k: dict(v) for k, v in start_status.items()}
         self.next_update = {}
     def pull_status(self, req_time):
         status = self.status
@@ -566,21 +669,50 @@ def list_datasets():
 class LogManager:
     error = error
     def __init__(self, log_prefix):
-        self.index_reader = JsonLogReader(log_prefix + ".index.gz")
-        self.jdispatch = JsonDispatcher(log_prefix)
+        self.index_reader = None
+        if os.path.exists(log_prefix + columnlog.LOG_SUFFIX):
+            self.jdispatch = ColumnDispatcher(log_prefix)
+        else:
+            self.index_reader = JsonLogReader(log_prefix + ".index.gz")
+            self.jdispatch = JsonDispatcher(log_prefix)
         self.initial_start_time = self.start_time = 0.
         self.datasets = {}
         self.initial_status = {}
         self.start_status = {}
         self.log_subscriptions = {}
-        self.status_tracker = None
+        self.status_trackers = 0
     def setup_index(self):
-        fmsg = self.index_reader.pull_msg()
+        if self.index_reader is None:
+            fmsg = self._read_column_meta()
+        else:
+            fmsg = self.index_reader.pull_msg()
         self.initial_status = status = fmsg['status']
         self.start_status = dict(status)
         start_time = status['toolhead']['estimated_print_time']
         self.initial_start_time = self.start_time = start_time
         self.log_subscriptions = fmsg.get('subscriptions', {})
+    def _read_column_meta(self):
+        # Build the equivalent of the first index message
+        fmsg = {'subscriptions': {}}
+        for msg in self.jdispatch.log_reader.get_meta():
+            msg_id = msg.get('id')
+            if 'result' not in msg or msg_id in ('info', 'list'):
+                continue
+            if msg_id == 'status':
+                fmsg['status'] = msg['result']['status']
+            else:
+                fmsg['subscriptions'][msg_id] = msg['result']
+        return fmsg
+    def _seek_column_log(self, seek_time):
+        lr = self.jdispatch.log_reader
+        self.jdispatch.set_seek_time(seek_time)
+        count = lr.get_chunk_count("status")
+        if not count:
+            return
+        chunk_idx = min(lr.find_chunk("status", seek_time), count - 1)
+        header, cols = lr.read_chunk("status", chunk_idx)
+        for k, v in header['attrs']['snapshot'].items():
+            self.start_status.setdefault(k, {}).update(v)
     def get_initial_status(self):
         return self.initial_status
     def available_dataset_types(self):
@@ -591,6 +723,9 @@ class LogManager:
         self.start_time = req_start_time = self.initial_start_time + req_time
         start_status = self.start_status
         seek_time = max(self.initial_start_time, req_start_time - 1.)
+        if self.index_reader is None:
+            self._seek_column_log(seek_time)
+            return
         file_position = 0
         while 1:
             fmsg = self.index_reader.pull_msg()
@@ -610,10 +745,13 @@ class LogManager:
     def get_start_time(self):
         return self.start_time
     def get_status_tracker(self):
-        if self.status_tracker is None:
-            self.status_tracker = TrackStatus(self, "status", self.start_status)
-            self.jdispatch.add_handler("status", "status")
-        return self.status_tracker
+        # Each dataset tracks status separately so that datasets can be
+        # generated independently of each other
+        name = "status:%d" % (self.status_trackers,)
+        self.status_trackers += 1
+        status_tracker = TrackStatus(self, name, self.start_status)
+        self.jdispatch.add_handler(name, "status")
+        return status_tracker
     def setup_dataset(self, name):
         if name in self.datasets:
             return self.datasets[name]
@@ -0,0 +1,144 @@
+# Parallel processing of accelerometer captures with a cache of the
+# frequency response calculated for each capture
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, multiprocessing, os, sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
+
+CACHE_VERSION = 1
+
+######################################################################
+# Raw capture loading
+######################################################################
+
+def load_npy(logname):
+    data = np.load(logname)
+    if data.dtype.names is None:
+        return data
+    # Convert (time, accel_x, accel_y, accel_z) records to a 2D array
+    return np.column_stack([data[name].astype(float)
+                            for name in data.dtype.names])
+
+
+######################################################################
+# Frequency response cache
+######################################################################
+
+# The power spectral density of a raw capture is stored next to it in
+# a <logname>.psd.npz file.  It is only used while the size and
+# modification time of the capture are unchanged.
+def get_cache_name(logname):
+    return logname + '.psd.npz'
+
+def get_file_key(logname):
+    st = os.stat(logname)
+    return np.array([CACHE_VERSION, st.st_size, st.st_mtime])
+
+def load_cache(logname):
+    try:
+        with np.load(get_cache_name(logname)) as npz:
+            if not np.array_equal(npz['key'], get_file_key(logname)):
+                return None
+            calibration_data = shaper_calibrate.CalibrationData(
+                    freq_bins=npz['freq_bins'], psd_sum=npz['psd_sum'],
+                    psd_x=npz['psd_x'], psd_y=npz['psd_y'],
+                    psd_z=npz['psd_z'])
+            info = {'samples': int(npz['info'][0]),
+                    'duration': float(npz['info'][1])}
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    calibration_data.set_numpy(np)
+    return calibration_data, info
+
+def save_cache(logname, calibration_data, info):
+    cache_name = get_cache_name(logname)
+    temp_name = cache_name + '.tmp%d' % (os.getpid(),)
+    try:
+        with open(temp_name, 'wb') as f:
+            np.savez(f, key=get_file_key(logname),
+                     freq_bins=calibration_data.freq_bins,
+                     psd_sum=calibration_data.psd_sum,
+                     psd_x=calibration_data.psd_x,
+                     psd_y=calibration_data.psd_y,
+                     psd_z=calibration_data.psd_z,
+                     info=np.array([info['samples'], info['duration']]))
+        os.rename(temp_name, cache_name)
+    except (IOError, OSError):
+        # Caching is optional (eg, the capture directory is read-only)
+        try:
+            os.unlink(temp_name)
+        except OSError:
+            pass
+
+# Return the (calibration_data, info) of a capture.  The parse_log()
+# function may return raw accelerometer data or an already calculated
+# CalibrationData (in which case info is None).
+def get_capture_psd(logname, parse_log, use_cache=True):
+    if use_cache:
+        res = load_cache(logname)
+        if res is not None:
+            return res
+    data = parse_log(logname)
+    if isinstance(data, shaper_calibrate.CalibrationData):
+        return data, None
+    helper = shaper_calibrate.ShaperCalibrate(printer=None)
+    calibration_data = helper.process_accelerometer_data(data)
+    info = {'samples': data.shape[0], 'duration': data[-1,0] - data[0,0]}
+    if use_cache:
+        save_cache(logname, calibration_data, info)
+    return calibration_data, info
+
+def copy_calibration_data(calibration_data):
+    res = shaper_calibrate.CalibrationData(
+            freq_bins=calibration_data.freq_bins,
+            psd_sum=calibration_data.psd_sum.copy(),
+            psd_x=calibration_data.psd_x.copy(),
+            psd_y=calibration_data.psd_y.copy(),
+            psd_z=calibration_data.psd_z.copy())
+    res.set_numpy(np)
+    return res
+
+def get_peak_freq(calibration_data, axis, max_freq):
+    freqs = calibration_data.freq_bins
+    psd = calibration_data.get_psd(axis)
+    valid = (freqs >= shaper_calibrate.MIN_FREQ) & (freqs <= max_freq)
+    if not valid.any():
+        return 0.
+    return freqs[valid][np.argmax(psd[valid])]
+
+######################################################################
+# Parallel processing and reporting
+######################################################################
+
+# Run func() on each item in a pool of worker processes (the results
+# are returned in the order of the items)
+def run_parallel(func, items, jobs):
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = multiprocessing.Pool(min(jobs, len(items)))
+    try:
+        results = pool.map(func, items, 1)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def format_table(header, rows):
+    widths = [max([len(row[i]) for row in [header] + rows])
+              for i in range(len(header))]
+    out = []
+    for row in [header] + rows:
+        out.append("  ".join([row[0].ljust(widths[0])]
+                             + [val.rjust(w)
+                                for val, w in zip(row[1:], widths[1:])]))
+    return out
+
+def get_default_jobs():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
@@ -1,40 +1,617 @@
-#!/usr/bin/env python2
-# Script to calculate stats for each stepper from a log of messages
+#!/usr/bin/env python
+# Script to calculate step rate and queue statistics for each stepper
+# from a log of messages
 #
-# Copyright (C) 2016  Kevin O'Connor <kevin@koconnor.net>
+# Copyright (C) 2016-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse
+import sys, os, optparse, heapq, collections
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import msgproto, parsedump
+import psdcache
+
+class error(Exception):
+    pass
+
+MOTAN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'motan')
+
+# Default serial baud rate (10 bits are sent for each byte)
+BAUD = 250000.
+# Default move queue size reported by the mcu in batch mode
+MOVE_COUNT = 500
+# Minimum time a message should be sent ahead of its use
+# (MIN_REQTIME_DELTA in serialqueue.c)
+MIN_LEAD_TIME = 0.250
+# Maximum amount a clock may be before the current mcu clock (larger
+# differences are assumed to be a 32-bit clock rollover)
+CLOCK_BACKTRACK = 1<<29
+
+def vlq_size(v):
+    # Size of an integer encoded with encode_int() in msgproto.py
+    v &= 0xffffffff
+    if v >= 0x80000000:
+        v -= 0x100000000
+    if -(1<<6) <= v < (1<<6):
+        return 1
+    if -(1<<13) <= v < (1<<13):
+        return 2
+    if -(1<<20) <= v < (1<<20):
+        return 3
+    if -(1<<27) <= v < (1<<27):
+        return 4
+    return 5
+
+
+######################################################################
+# Step and queue tracking
+######################################################################
+
+class StepperStats:
+    def __init__(self, mcu, name):
+        self.mcu = mcu
+        self.name = name
+        self.last_clock = 0
+        self.reset_clock = None
+        self.sdir = None
+        self.queue_steps = self.dir_changes = 0
+        self.steps = [0, 0]
+        self.min_interval = None
+        self.window_steps = {}
+    def set_dir(self, sdir):
+        if sdir != self.sdir:
+            self.dir_changes += 1
+            self.sdir = sdir
+    def reset_step_clock(self, clock32):
+        # The full clock is found from the first step after the reset
+        self.reset_clock = clock32
+    def _count_before(self, interval, count, add, clock):
+        # Number of steps of the move that occur before 'clock'
+        last_clock = self.last_clock
+        lo, hi = 0, count
+        while lo < hi:
+            i = (lo + hi + 1) // 2
+            if last_clock + i * interval + add * i * (i - 1) // 2 < clock:
+                lo = i
+            else:
+                hi = i - 1
+        return lo
+    def queue_step(self, interval, count, add):
+        mcu = self.mcu
+        if self.reset_clock is not None:
+            self.last_clock = self.reset_clock
+            self.reset_clock = None
+        # The interval of a move after a long idle period may have
+        # overflowed - find the first step clock from the current time
+        first_clock = mcu.resolve_clock(self.last_clock + interval)
+        start_clock = last_clock = first_clock - interval
+        end_clock = last_clock + count * interval + add * count * (count-1)//2
+        self.queue_steps += 1
+        self.steps[self.sdir == 1] += count
+        if count:
+            min_interval = min(interval, interval + (count - 1) * add)
+            if self.min_interval is None or min_interval < self.min_interval:
+                self.min_interval = min_interval
+        # Assign the steps to time windows
+        ws = self.window_steps
+        first_win = mcu.get_window(last_clock + interval)
+        end_win = mcu.get_window(end_clock)
+        prev = 0
+        for w in range(first_win, end_win):
+            pos = self._count_before(interval, count, add,
+                                     mcu.get_window_clock(w + 1))
+            ws[w] = ws.get(w, 0) + pos - prev
+            prev = pos
+        ws[end_win] = ws.get(end_win, 0) + count - prev
+        self.last_clock = end_clock
+        return start_clock, first_clock
+    def get_max_rate(self):
+        if not self.min_interval:
+            return 0.
+        return self.mcu.freq / self.min_interval
+    def get_peak_rate(self):
+        if not self.window_steps:
+            return 0.
+        return max(self.window_steps.values()) / self.mcu.window
+
+class McuStats:
+    def __init__(self, name, freq, options):
+        self.name = name
+        self.freq = float(freq)
+        self.window = options.window
+        self.bandwidth = options.get_bandwidth(name)
+        self.min_lead_time = options.min_lead
+        self.steppers = {}
+        self.stepper_order = []
+        self.ref_clock = 0
+        self.ref_time = 0.
+        self.cur_clock = 0
+        # Clock of the first timed message (config messages are untimed)
+        self.start_clock = None
+        self.full_clocks = False
+        self.messages = self.total_bytes = 0
+        self.min_lead = None
+        self.block_fill = 0
+        # Simulated move queue (the time each slot becomes available)
+        self.move_clocks = [0] * options.move_count
+        # Per window stats: {window: [bytes, queue_steps, min_lead], ...}
+        self.windows = {}
+    def set_time_reference(self, clock, print_time):
+        # Use the full (64-bit) clocks of a data_logger log
+        self.ref_clock = self.cur_clock = clock
+        self.ref_time = print_time
+        self.full_clocks = True
+    def lookup_stepper(self, name):
+        s = self.steppers.get(name)
+        if s is None:
+            s = self.steppers[name] = StepperStats(self, name)
+            self.stepper_order.append(name)
+        return s
+    def clock_to_time(self, clock):
+        return (clock - self.ref_clock) / self.freq + self.ref_time
+    def get_window(self, clock):
+        return int(self.clock_to_time(clock) // self.window)
+    def get_window_clock(self, window):
+        return (int((window * self.window - self.ref_time) * self.freq)
+                + self.ref_clock)
+    def _get_window_stats(self, clock):
+        w = self.get_window(clock)
+        ws = self.windows.get(w)
+        if ws is None:
+            ws = self.windows[w] = [0, 0, None]
+        return ws
+    def resolve_clock(self, clock):
+        # Find the full clock matching the lower 32 bits of 'clock'
+        if self.full_clocks:
+            return clock
+        base = self.cur_clock - CLOCK_BACKTRACK
+        return base + ((clock - base) & 0xffffffff)
+    def note_clock(self, clock32):
+        if not clock32:
+            return
+        self._note_timed(self.resolve_clock(clock32))
+    def _note_timed(self, clock):
+        self.cur_clock = max(self.cur_clock, clock)
+        if self.start_clock is None:
+            self.start_clock = clock
+    def add_message(self, size, clock=None):
+        if clock is None:
+            clock = self.cur_clock
+        self.messages += 1
+        self.total_bytes += size
+        ws = self._get_window_stats(clock)
+        ws[0] += size
+        return ws
+    def add_estimated_message(self, msglen, clock=None):
+        # Estimate block framing overhead (assumes full blocks)
+        if self.block_fill + msglen > msgproto.MESSAGE_PAYLOAD_MAX:
+            self.block_fill = 0
+        size = msglen
+        if not self.block_fill:
+            size += msgproto.MESSAGE_MIN
+        self.block_fill += msglen
+        return self.add_message(size, clock)
+    def queue_step(self, stepper, interval, count, add, size, estimated=False):
+        start_clock, first_clock = stepper.queue_step(interval, count, add)
+        self._note_timed(first_clock)
+        if estimated:
+            ws = self.add_estimated_message(size, first_clock)
+        else:
+            ws = self.add_message(size, first_clock)
+        ws[1] += 1
+        # A queue_step can't be sent until a move queue slot is free (the
+        # slot of a move is freed when the move starts)
+        next_avail = heapq.heapreplace(self.move_clocks, start_clock)
+        if next_avail:
+            lead = (first_clock - next_avail) / self.freq
+            if ws[2] is None or lead < ws[2]:
+                ws[2] = lead
+            if self.min_lead is None or lead < self.min_lead:
+                self.min_lead = lead
+    def get_duration(self):
+        if self.start_clock is None:
+            return 0.
+        start_window = self.get_window(self.start_clock)
+        return (max(self.windows) - start_window + 1) * self.window
+    def get_peak(self, idx):
+        if not self.windows:
+            return 0.
+        return max([ws[idx] for ws in self.windows.values()]) / self.window
+
+
+######################################################################
+# Input parsing
+######################################################################
+
+# Process a binary data dump (as produced by batch mode)
+def read_binary_dump(mcu, mp, f):
+    decoder = parsedump.DumpDecoder(mp)
+    names = {msgid: d[0] for msgid, d in decoder.decoders.items()}
+    params = {msgid: [n for i, n in enumerate(d[1]) if i != d[3]]
+              for msgid, d in decoder.decoders.items()}
+    qs_id = mp.lookup_command("queue_step oid=%c interval=%u count=%hu"
+                              " add=%hi").msgid
+    for msgid, oid, vals, size in decoder.iter_file(f):
+        if msgid == qs_id:
+            interval, count, add = vals
+            mcu.queue_step(mcu.lookup_stepper(oid), interval, count, add,
+                           size)
+            continue
+        name = names[msgid]
+        if name == 'set_next_step_dir':
+            mcu.lookup_stepper(oid).set_dir(vals[0])
+        elif name == 'reset_step_clock':
+            mcu.lookup_stepper(oid).reset_step_clock(vals[0])
+        elif 'clock' in params[msgid]:
+            mcu.note_clock(vals[params[msgid].index('clock')])
+        mcu.add_message(size)
+
+# Process a text dump (as produced by parsedump.py)
+def read_text_dump(mcu, mp, f):
+    for line in f:
+        parts = line.split()
+        if not parts or '=' in parts[0]:
+            continue
+        try:
+            args = dict([p.split('=', 1) for p in parts[1:]])
+        except ValueError:
+            continue
+        size = None
+        if mp is not None:
+            try:
+                size = len(mp.create_command(line))
+            except msgproto.error:
+                pass
+        if size is None:
+            # Estimate the size of the encoded message
+            size = 1 + sum([vlq_size(int(v)) if v.lstrip('-').isdigit()
+                            else 1 for v in args.values()])
+        name = parts[0]
+        if name == 'queue_step':
+            mcu.queue_step(mcu.lookup_stepper(int(args['oid'])),
+                           int(args['interval']), int(args['count']),
+                           int(args['add']), size, estimated=True)
+            continue
+        if name == 'set_next_step_dir':
+            mcu.lookup_stepper(int(args['oid'])).set_dir(int(args['dir']))
+        elif name == 'reset_step_clock':
+            mcu.lookup_stepper(int(args['oid'])).reset_step_clock(
+                int(args['clock']))
+        elif 'clock' in args:
+            mcu.note_clock(int(args['clock']))
+        mcu.add_estimated_message(size)
+
+def is_text_file(filename):
+    with open(filename, 'rb') as f:
+        data = bytearray(f.read(512))
+    return all([c >= 0x20 or c in bytearray(b'\t\r\n') for c in data])
+
+def get_data_logger_prefix(filename):
+    for suffix in ['.json.gz', '.index.gz', '.motan']:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return None
+
+def lookup_stepper_mcu(settings, stepper_name):
+    # Find the mcu of a stepper from the prefix of its step_pin
+    for section, config in settings.items():
+        if section != stepper_name and section.split()[-1] != stepper_name:
+            continue
+        pin = config.get('step_pin', '').lstrip('!^~ ')
+        if ':' in pin:
+            return pin.split(':', 1)[0].strip()
+        return 'mcu'
+    return 'mcu'
+
+# Generate the messages of one stepq subscription in a data_logger.py log
+def iter_stepq_msgs(prefix, qid):
+    import readlog, columnlog
+    if os.path.exists(prefix + columnlog.LOG_SUFFIX):
+        lr = columnlog.ColumnLogReader(prefix + columnlog.LOG_SUFFIX)
+        for idx in range(lr.get_chunk_count(qid)):
+            header, msgs = lr.read_messages(qid, idx)
+            for params in msgs:
+                yield params
+        return
+    lr = readlog.JsonLogReader(prefix + ".json.gz")
+    while 1:
+        msg = lr.pull_msg()
+        if msg is None:
+            break
+        if msg.get('q') == qid:
+            yield msg['params']
+
+# Generate (first step time, index, stepper, move) for each move of a
+# stepper.  The first message of a stepper contains its full history,
+# so each stepper is read separately and the moves are then merged.
+def iter_stepq_moves(prefix, qid, index, lookup_stepper):
+    for msg in iter_stepq_msgs(prefix, qid):
+        data = msg.get('data')
+        if not data:
+            continue
+        stepper = lookup_stepper(qid[6:], msg)
+        mcu = stepper.mcu
+        start_clock = msg['first_clock'] - data[0][0]
+        after_marker = False
+        for interval, count, add in data:
+            if not count:
+                # Position marker (eg, after homing)
+                after_marker = True
+                continue
+            if after_marker:
+                after_marker = False
+                # If the step clock was reset then the interval is
+                # relative to clock zero - use the nearest interpretation
+                gap = (interval - start_clock) & 0xffffffff
+                if gap < interval:
+                    yield (mcu.clock_to_time(start_clock), index, stepper,
+                           start_clock, 0, 0, 0)
+                    start_clock += gap - interval
+            yield (mcu.clock_to_time(start_clock + interval), index, stepper,
+                   start_clock, interval, count, add)
+            count = abs(count)
+            start_clock += count * interval + add * count * (count - 1) // 2
+
+# Process the stepq messages of a data_logger.py log
+def read_data_logger(prefix, mcus, options):
+    sys.path.append(MOTAN_DIR)
+    import readlog
+    lmanager = readlog.LogManager(prefix)
+    lmanager.setup_index()
+    status = lmanager.get_initial_status()
+    settings = status.get('configfile', {}).get('settings', {})
+    stepper_mcus = {}
+    def lookup_stepper(stepper_name, msg):
+        s = stepper_mcus.get(stepper_name)
+        if s is not None:
+            return s
+        mcu_name = lookup_stepper_mcu(settings, stepper_name)
+        mcu = mcus.get(mcu_name)
+        if mcu is None:
+            mcu_obj = 'mcu' if mcu_name == 'mcu' else 'mcu ' + mcu_name
+            consts = status.get(mcu_obj, {}).get('mcu_constants', {})
+            freq = consts.get('CLOCK_FREQ')
+            if freq is None:
+                # Estimate frequency from the step times
+                freq = ((msg['last_clock'] - msg['first_clock'])
+                        / (msg['last_step_time'] - msg['first_step_time']))
+            mcu = mcus[mcu_name] = McuStats(mcu_name, freq, options)
+            mcu.set_time_reference(msg['first_clock'], msg['first_step_time'])
+        s = stepper_mcus[stepper_name] = mcu.lookup_stepper(stepper_name)
+        return s
+    qids = sorted([qid for qid in lmanager.log_subscriptions
+                   if qid.startswith("stepq:")])
+    moves = [iter_stepq_moves(prefix, qid, i, lookup_stepper)
+             for i, qid in enumerate(qids)]
+    for move in heapq.merge(*moves):
+        process_stepq_move(*move[2:])
+
+def process_stepq_move(stepper, start_clock, interval, count, add):
+    mcu = stepper.mcu
+    if not count:
+        # Step clock reset
+        mcu.add_estimated_message(2 + vlq_size(0), start_clock)
+        return
+    sdir = int(count >= 0)
+    if stepper.sdir != sdir:
+        stepper.set_dir(sdir)
+        mcu.add_estimated_message(3, start_clock + interval)
+    count = abs(count)
+    # Each data_logger message has absolute clocks (resync the stepper)
+    stepper.last_clock = start_clock
+    size = (1 + vlq_size(0) + vlq_size(interval) + vlq_size(count)
+            + vlq_size(add))
+    mcu.queue_step(stepper, interval, count, add, size, estimated=True)
+
+def read_dump(filename, dict_filename, mcus, options):
+    mp = None
+    freq = options.freq
+    if dict_filename is not None:
+        mp = msgproto.MessageParser()
+        mp.process_identify(parsedump.read_dictionary(dict_filename),
+                            decompress=False)
+        freq = mp.get_constant_float('CLOCK_FREQ')
+    if freq is None:
+        raise error("Unknown mcu frequency for %s - provide a data"
+                    " dictionary or --freq" % (filename,))
+    name = os.path.basename(filename)
+    mcu = mcus[name] = McuStats(name, freq, options)
+    if is_text_file(filename):
+        with open(filename, 'r') as f:
+            read_text_dump(mcu, mp, f)
+    elif mp is None:
+        raise error("A data dictionary is required to parse %s"
+                    % (filename,))
+    else:
+        with open(filename, 'rb') as f:
+            read_binary_dump(mcu, mp, f)
+
+
+######################################################################
+# Reporting
+######################################################################
+
+def get_steppers(mcus):
+    return [(mcu, mcu.steppers[name])
+            for mcu in mcus.values() for name in mcu.stepper_order]
+
+def format_name(mcu, stepper):
+    if isinstance(stepper.name, int):
+        return "%s oid=%d" % (mcu.name, stepper.name)
+    return stepper.name
+
+def report_steppers(mcus):
+    header = ["stepper", "queue_step", "+steps", "-steps", "dir_changes",
+              "steps/msg", "max_rate", "peak_rate"]
+    rows = []
+    for mcu, s in get_steppers(mcus):
+        steps = sum(s.steps)
+        rows.append([format_name(mcu, s), "%d" % (s.queue_steps,),
+                     "%d" % (s.steps[1],), "%d" % (s.steps[0],),
+                     "%d" % (s.dir_changes,),
+                     "%.1f" % (steps / float(max(s.queue_steps, 1)),),
+                     "%.0f" % (s.get_max_rate(),),
+                     "%.0f" % (s.get_peak_rate(),)])
+    return psdcache.format_table(header, rows)
+
+def report_mcus(mcus):
+    header = ["mcu", "messages", "bytes", "duration", "bytes/s",
+              "peak_bytes/s", "bandwidth", "peak_queue_step/s", "min_lead"]
+    rows = []
+    for mcu in mcus.values():
+        duration = mcu.get_duration()
+        min_lead = "-"
+        if mcu.min_lead is not None:
+            min_lead = "%.3f" % (mcu.min_lead,)
+        rows.append([mcu.name, "%d" % (mcu.messages,),
+                     "%d" % (mcu.total_bytes,), "%.1f" % (duration,),
+                     "%.0f" % (mcu.total_bytes / max(duration, mcu.window),),
+                     "%.0f" % (mcu.get_peak(0),), "%.0f" % (mcu.bandwidth,),
+                     "%.0f" % (mcu.get_peak(1),), min_lead])
+    return psdcache.format_table(header, rows)
+
+# Find consecutive windows matching a check
+def find_segments(windows, window, check):
+    segments = []
+    for w in sorted(windows):
+        val = check(windows[w])
+        if val is None:
+            continue
+        if segments and segments[-1][1] == w:
+            seg = segments[-1]
+            seg[1] = w + 1
+            seg[2] = max(seg[2], val)
+        else:
+            segments.append([w, w + 1, val])
+    return [(start * window, end * window, val)
+            for start, end, val in segments]
+
+def report_segments(mcus, options):
+    out = []
+    for mcu in mcus.values():
+        bw = mcu.bandwidth
+        for start, end, val in find_segments(
+                mcu.windows, mcu.window,
+                lambda ws: ws[0] / mcu.window
+                           if ws[0] / mcu.window > bw else None):
+            out.append((start, end, "mcu '%s' requires %.0f bytes/s"
+                        " (bandwidth %.0f bytes/s)" % (mcu.name, val, bw)))
+        for start, end, val in find_segments(
+                mcu.windows, mcu.window,
+                lambda ws: -ws[2] if ws[2] is not None
+                                  and ws[2] < mcu.min_lead_time else None):
+            out.append((start, end, "mcu '%s' move queue only allows"
+                        " %.3fs lead time" % (mcu.name, -val)))
+    if options.max_step_rate:
+        for mcu, s in get_steppers(mcus):
+            for start, end, val in find_segments(
+                    s.window_steps, mcu.window,
+                    lambda c: c / mcu.window
+                              if c / mcu.window > options.max_step_rate
+                              else None):
+                out.append((start, end, "%s reaches %.0f steps/s" % (
+                    format_name(mcu, s), val)))
+    return ["%.3f-%.3f: %s" % seg for seg in sorted(out)]
+
+def write_timeline(mcus, output):
+    mcu_list = list(mcus.values())
+    steppers = get_steppers(mcus)
+    window = mcu_list[0].window
+    all_windows = set()
+    for mcu in mcu_list:
+        all_windows.update(mcu.windows)
+    f = open(output, "w")
+    header = ["time"]
+    for mcu in mcu_list:
+        header += ["%s:bytes/s" % (mcu.name,),
+                   "%s:queue_step/s" % (mcu.name,),
+                   "%s:min_lead" % (mcu.name,)]
+    header += ["%s:steps/s" % (format_name(mcu, s),) for mcu, s in steppers]
+    f.write(",".join(header) + "\n")
+    if not all_windows:
+        f.close()
+        return
+    for w in range(min(all_windows), max(all_windows) + 1):
+        row = ["%.3f" % (w * window,)]
+        for mcu in mcu_list:
+            ws = mcu.windows.get(w, [0, 0, None])
+            row += ["%.0f" % (ws[0] / window,), "%.0f" % (ws[1] / window,),
+                    "" if ws[2] is None else "%.6f" % (ws[2],)]
+        row += ["%.0f" % (s.window_steps.get(w, 0) / window,)
+                for mcu, s in steppers]
+        f.write(",".join(row) + "\n")
+    f.close()
+
+
+######################################################################
+# Startup
+######################################################################
 
 def main():
-    usage = "%prog [options] <comms file>"
+    usage = "%prog [options] <comms file or data_logger log>..."
     opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictionary", type="string", action="append",
+                    dest="dictionaries", default=[],
+                    help="data dictionary of the mcu (in order of the"
+                    " dump files)")
+    opts.add_option("-f", "--freq", type="float", dest="freq",
+                    help="mcu frequency of a text dump without dictionary")
+    opts.add_option("-w", "--window", type="float", dest="window",
+                    default=0.5, help="length of each time window (seconds)")
+    opts.add_option("-b", "--baud", type="string", action="append",
+                    dest="baud", default=[],
+                    help="serial baud rate of the mcus (or NAME=BAUD)")
+    opts.add_option("-m", "--move-count", type="int", dest="move_count",
+                    default=MOVE_COUNT, help="size of the mcu move queue")
+    opts.add_option("-l", "--min-lead", type="float", dest="min_lead",
+                    default=MIN_LEAD_TIME,
+                    help="report move queue lead times below this (seconds)")
+    opts.add_option("-r", "--max-step-rate", type="float",
+                    dest="max_step_rate",
+                    help="report steppers exceeding this step rate")
+    opts.add_option("-o", "--output", type="string", dest="output",
+                    help="write a csv timeline to the given file")
     options, args = opts.parse_args()
-    if len(args) != 1:
+    if len(args) < 1:
         opts.error("Incorrect number of arguments")
-    filename = args[0]
+    bauds = {}
+    for b in options.baud:
+        name, rate = 'default', b
+        if '=' in b:
+            name, rate = b.split('=', 1)
+        try:
+            bauds[name] = float(rate)
+        except ValueError:
+            opts.error("Invalid baud rate '%s'" % (b,))
+    options.get_bandwidth = lambda name: bauds.get(
+        name, bauds.get('default', BAUD)) / 10.
 
-    steppers = {}
-    f = open(filename, 'rb')
-    for line in f:
-        parts = line.split()
-        if not parts:
-            continue
-        args = dict([p.split('=', 1) for p in parts[1:]])
-        if parts[0] == 'config_stepper':
-            # steppers[oid] = [dir_cmds, dir, queue_cmds, pos steps, neg steps]
-            steppers[args['oid']] = [0, 0, 0, 0, 0]
-        elif parts[0] == 'set_next_step_dir':
-            so = steppers[args['oid']]
-            so[0] += 1
-            so[1] = args['dir']
-        elif parts[0] == 'queue_step':
-            so = steppers[args['oid']]
-            so[2] += 1
-            so[{'0': 3, '1': 4}[so[1]]] += int(args['count'])
-    for oid, so in sorted([(int(i[0]), i[1]) for i in steppers.items()]):
-        print "oid:%3d dir_cmds:%6d queue_cmds:%7d (%8d -%8d = %8d)" % (
-            oid, so[0], so[2], so[4], so[3], so[4]-so[3])
+    # Process each input
+    mcus = collections.OrderedDict()
+    dicts = list(options.dictionaries)
+    try:
+        for filename in args:
+            prefix = get_data_logger_prefix(filename)
+            if prefix is not None:
+                read_data_logger(prefix, mcus, options)
+                continue
+            dict_filename = None
+            if dicts:
+                dict_filename = dicts.pop(0) if len(dicts) > 1 else dicts[0]
+            read_dump(filename, dict_filename, mcus, options)
+    except (IOError, OSError) as e:
+        opts.error(str(e))
+    except error as e:
+        opts.error(str(e))
+
+    # Report results
+    out = report_mcus(mcus) + [""] + report_steppers(mcus)
+    segments = report_segments(mcus, options)
+    if segments:
+        out += ["", "Flagged segments:"] + segments
+    sys.stdout.write("\n".join(out) + "\n")
+    if options.output:
+        write_timeline(mcus, options.output)
 
 if __name__ == '__main__':
     main()
@@ -3,11 +3,15 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, optparse, logging, subprocess
+import sys, os, optparse, logging, subprocess, tempfile, shutil, traceback
+import hashlib, json, glob, multiprocessing
 
 TEMP_GCODE_FILE = "_test_.gcode"
 TEMP_LOG_FILE = "_test_.log"
 TEMP_OUTPUT_FILE = "_test_output"
+TEMP_STDOUT_FILE = "_test_.out"
+KLIPPY_DIR = "./klippy"
+CACHE_VERSION = 1
 
 
 ######################################################################
@@ -17,18 +21,76 @@ TEMP_OUTPUT_FILE = "_test_output"
 class error(Exception):
     pass
 
+# A single klippy invocation (one config within a test file)
+class TestRun:
+    def __init__(self, fname, config_fname, dict_fnames, gcode_fname, gcode,
+                 should_fail):
+        self.fname = fname
+        self.config_fname = config_fname
+        self.dict_fnames = dict_fnames
+        self.gcode_fname = gcode_fname
+        self.gcode = gcode
+        self.should_fail = should_fail
+    def get_name(self):
+        return "%s (%s)" % (self.fname, os.path.basename(self.config_fname))
+    def get_cache_key(self, source_hash):
+        h = hashlib.sha1()
+        for data in [source_hash, self.fname, str(self.should_fail),
+                     '\n'.join(self.gcode)]:
+            h.update(data.encode() + b'\0')
+        fnames = config_files(self.config_fname)
+        fnames += [df.split('=', 1)[-1] for df in self.dict_fnames]
+        if self.gcode_fname is not None:
+            fnames.append(self.gcode_fname)
+        for fname in fnames:
+            hash_file(h, fname)
+        return h.hexdigest()
+    def launch(self, rundir, verbose, capture):
+        # Run klippy with all temporary files in the given directory.
+        # Returns the test result and any output to report.
+        gcode_fname = self.gcode_fname
+        if gcode_fname is None:
+            gcode_fname = os.path.join(rundir, TEMP_GCODE_FILE)
+            f = open(gcode_fname, 'w')
+            f.write('\n'.join(self.gcode + ['']))
+            f.close()
+        log_fname = os.path.join(rundir, TEMP_LOG_FILE)
+        sys.stderr.write("    Starting %s\n" % (self.get_name(),))
+        args = [ sys.executable, os.path.join(KLIPPY_DIR, 'klippy.py'),
+                 self.config_fname, '-i', gcode_fname,
+                 '-o', os.path.join(rundir, TEMP_OUTPUT_FILE), '-v' ]
+        for df in self.dict_fnames:
+            args += ['-d', df]
+        if not verbose:
+            args += ['-l', log_fname]
+        output = ""
+        if capture:
+            # Parallel runs collect the output so it isn't interleaved
+            stdout_fname = os.path.join(rundir, TEMP_STDOUT_FILE)
+            f = open(stdout_fname, 'w')
+            res = subprocess.call(args, stdout=f, stderr=subprocess.STDOUT)
+            f.close()
+            output = read_file(stdout_fname)
+        else:
+            res = subprocess.call(args)
+        if bool(res) == self.should_fail:
+            if verbose:
+                output += '\n'
+            return "success", output
+        if not verbose:
+            output += read_file(log_fname)
+        if self.should_fail:
+            return "Test failed to raise an error", output
+        return "Error during test", output
+
+# Parse a test file into a list of klippy invocations
 class TestCase:
-    def __init__(self, fname, dictdir, tempdir, verbose, keepfiles):
+    def __init__(self, fname, dictdir):
         self.fname = fname
         self.dictdir = dictdir
-        self.tempdir = tempdir
-        self.verbose = verbose
-        self.keepfiles = keepfiles
     def relpath(self, fname, rel='test'):
         if rel == 'dict':
             reldir = self.dictdir
-        elif rel == 'temp':
-            reldir = self.tempdir
         else:
             reldir = os.path.dirname(self.fname)
         return os.path.join(reldir, fname)
@@ -37,6 +99,7 @@ class TestCase:
         config_fname = gcode_fname = dict_fnames = None
         should_fail = multi_tests = False
         gcode = []
+        test_runs = []
         f = open(self.fname, 'r')
         for line in f:
             cpos = line.find('#')
@@ -50,12 +113,14 @@ class TestCase:
                     # Multiple tests in same file
                     if not multi_tests:
                         multi_tests = True
-                        self.launch_test(config_fname, dict_fnames,
-                                         gcode_fname, gcode, should_fail)
+                        test_runs.append(self.build_run(
+                            config_fname, dict_fnames, gcode_fname, gcode,
+                            should_fail))
                 config_fname = self.relpath(parts[1])
                 if multi_tests:
-                    self.launch_test(config_fname, dict_fnames,
-                                     gcode_fname, gcode, should_fail)
+                    test_runs.append(self.build_run(
+                        config_fname, dict_fnames, gcode_fname, gcode,
+                        should_fail))
             elif parts[0] == "DICTIONARY":
                 dict_fnames = [self.relpath(parts[1], 'dict')]
                 for mcu_dict in parts[2:]:
@@ -70,66 +135,130 @@ class TestCase:
                 gcode.append(line.strip())
         f.close()
         if not multi_tests:
-            self.launch_test(config_fname, dict_fnames,
-                             gcode_fname, gcode, should_fail)
-    def launch_test(self, config_fname, dict_fnames, gcode_fname, gcode,
-                    should_fail):
-        gcode_is_temp = False
-        if gcode_fname is None:
-            gcode_fname = self.relpath(TEMP_GCODE_FILE, 'temp')
-            gcode_is_temp = True
-            f = open(gcode_fname, 'w')
-            f.write('\n'.join(gcode + ['']))
-            f.close()
-        elif gcode:
+            test_runs.append(self.build_run(config_fname, dict_fnames,
+                                            gcode_fname, gcode, should_fail))
+        return test_runs
+    def build_run(self, config_fname, dict_fnames, gcode_fname, gcode,
+                  should_fail):
+        if gcode_fname is not None and gcode:
             raise error("Can't specify both a gcode file and gcode commands")
         if config_fname is None:
             raise error("config file not specified")
         if dict_fnames is None:
             raise error("data dictionary file not specified")
-        # Call klippy
-        sys.stderr.write("    Starting %s (%s)\n" % (
-            self.fname, os.path.basename(config_fname)))
-        args = [ sys.executable, './klippy/klippy.py', config_fname,
-                 '-i', gcode_fname, '-o', TEMP_OUTPUT_FILE, '-v' ]
-        for df in dict_fnames:
-            args += ['-d', df]
-        if not self.verbose:
-            args += ['-l', TEMP_LOG_FILE]
-        res = subprocess.call(args)
-        is_fail = (should_fail and not res) or (not should_fail and res)
-        if is_fail:
-            if not self.verbose:
-                self.show_log()
-            if should_fail:
-                raise error("Test failed to raise an error")
-            raise error("Error during test")
-        # Do cleanup
-        if self.keepfiles:
-            return
-        for fname in os.listdir(self.tempdir):
-            if fname.startswith(TEMP_OUTPUT_FILE):
-                os.unlink(fname)
-        if not self.verbose:
-            os.unlink(TEMP_LOG_FILE)
-        else:
-            sys.stderr.write('\n')
-        if gcode_is_temp:
-            os.unlink(gcode_fname)
-    def run(self):
-        try:
-            self.parse_test()
-        except error as e:
-            return str(e)
-        except Exception:
-            logging.exception("Unhandled exception during test run")
-            return "internal error"
-        return "success"
-    def show_log(self):
-        f = open(TEMP_LOG_FILE, 'r')
+        return TestRun(self.fname, config_fname, list(dict_fnames),
+                       gcode_fname, list(gcode), should_fail)
+
+def read_file(fname):
+    try:
+        f = open(fname, 'r')
         data = f.read()
         f.close()
-        sys.stdout.write(data)
+    except IOError:
+        return ""
+    return data
+
+# Run a single klippy invocation (may be called from a pool process)
+def run_test(args):
+    test_run, tempdir, verbose, keepfiles, capture = args
+    rundir = tempfile.mkdtemp(prefix="test_klippy_", dir=tempdir)
+    try:
+        res, output = test_run.launch(rundir, verbose, capture)
+    except Exception:
+        res, output = "internal error", traceback.format_exc()
+    if keepfiles:
+        output += "    Test files for %s kept in %s\n" % (
+            test_run.get_name(), rundir)
+    else:
+        shutil.rmtree(rundir, ignore_errors=True)
+    return test_run, res, output
+
+def run_tests(test_runs, options):
+    capture = options.jobs > 1
+    args = [(tr, options.tempdir, options.verbose, options.keepfiles, capture)
+            for tr in test_runs]
+    if options.jobs <= 1:
+        for a in args:
+            yield run_test(a)
+        return
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        for res in pool.imap_unordered(run_test, args, 1):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def build_chelper():
+    # Build the C helper once (parallel klippy instances would race)
+    code = ("import sys; sys.path.insert(0, %r); import chelper;"
+            " chelper.get_ffi()" % (KLIPPY_DIR,))
+    if subprocess.call([sys.executable, '-c', code]):
+        raise error("Unable to build C code module")
+
+
+######################################################################
+# Result cache
+######################################################################
+
+def hash_file(h, fname):
+    try:
+        f = open(fname, 'rb')
+        data = f.read()
+        f.close()
+    except IOError:
+        data = b'missing'
+    h.update(fname.encode() + b'\0' + data + b'\0')
+
+# Return a list of a config file and all the files it includes
+def config_files(fname, depth=0):
+    fnames = [fname]
+    if depth > 10:
+        return fnames
+    dirname = os.path.dirname(fname)
+    for line in read_file(fname).split('\n'):
+        line = line.strip()
+        if line.startswith('[include ') and line.endswith(']'):
+            pattern = os.path.join(dirname, line[9:-1].strip())
+            for include_fname in sorted(glob.glob(pattern)):
+                fnames += config_files(include_fname, depth + 1)
+    return fnames
+
+# Hash of the klippy host code (a change invalidates all cached results)
+def get_source_hash():
+    h = hashlib.sha1()
+    h.update(sys.version.encode() + b'\0')
+    for dirpath, dirnames, filenames in os.walk(KLIPPY_DIR):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if os.path.splitext(fname)[1] in ('.py', '.c', '.h'):
+                hash_file(h, os.path.join(dirpath, fname))
+    return h.hexdigest()
+
+# Track the test runs that passed on a previous invocation
+class ResultCache:
+    def __init__(self, fname):
+        self.fname = fname
+        self.source_hash = get_source_hash()
+        self.passed = {}
+        try:
+            f = open(fname, 'r')
+            data = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return
+        if data.get('version') == CACHE_VERSION:
+            self.passed = dict.fromkeys(data.get('passed', []), 1)
+    def check(self, test_run):
+        return test_run.get_cache_key(self.source_hash) in self.passed
+    def note_pass(self, test_run):
+        self.passed[test_run.get_cache_key(self.source_hash)] = 1
+    def save(self):
+        data = {'version': CACHE_VERSION, 'passed': sorted(self.passed)}
+        f = open(self.fname, 'w')
+        json.dump(data, f)
+        f.close()
 
 
 ######################################################################
@@ -148,20 +277,71 @@ def main():
                     help="do not remove temporary files")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="show all output from tests")
+    opts.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                    help="number of tests to run in parallel")
+    opts.add_option("-c", "--cache", dest="cache",
+                    help="skip tests that passed in an earlier run"
+                    " (results are stored in the given file)")
     options, args = opts.parse_args()
     if len(args) < 1:
         opts.error("Incorrect number of arguments")
     logging.basicConfig(level=logging.DEBUG)
 
-    # Run each test
+    # Parse each test
+    test_runs = []
     for fname in args:
-        tc = TestCase(fname, options.dictdir, options.tempdir, options.verbose,
-                      options.keepfiles)
-        res = tc.run()
-        if res != 'success':
-            sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n" % (fname, res))
+        tc = TestCase(fname, options.dictdir)
+        try:
+            test_runs += tc.parse_test()
+        except error as e:
+            res = str(e)
+        except Exception:
+            logging.exception("Unhandled exception during test parse")
+            res = "internal error"
+        else:
+            continue
+        sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n" % (fname, res))
+        sys.exit(-1)
+    cache = None
+    if options.cache:
+        cache = ResultCache(options.cache)
+        pending = [tr for tr in test_runs if not cache.check(tr)]
+        if len(pending) < len(test_runs):
+            sys.stderr.write("    Skipping %d unchanged tests\n" % (
+                len(test_runs) - len(pending),))
+        test_runs = pending
+    if options.jobs > 1 and test_runs:
+        try:
+            build_chelper()
+        except error as e:
+            sys.stderr.write("\n\n%s\n\n" % (str(e),))
             sys.exit(-1)
 
+    # Run each test
+    failures = []
+    for test_run, res, output in run_tests(test_runs, options):
+        sys.stdout.write(output)
+        sys.stdout.flush()
+        if res == 'success':
+            if cache is not None:
+                cache.note_pass(test_run)
+            continue
+        failures.append((test_run, res))
+        sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n" % (
+            test_run.get_name(), res))
+        if options.jobs <= 1:
+            break
+    if cache is not None:
+        cache.save()
+    if failures:
+        if options.jobs > 1:
+            sys.stderr.write("\n    %d of %d tests FAILED:\n" % (
+                len(failures), len(test_runs)))
+            for test_run, res in failures:
+                sys.stderr.write("      %s (%s)\n" % (test_run.get_name(),
+                                                     res))
+        sys.exit(-1)
+
     sys.stderr.write("\n    All %d test cases passed\n" % (len(args),))
 
 if __name__ == '__main__':